@@ -0,0 +1,233 @@
+"""
+Generatore deterministico di un incarico sintetico: workbook schema (formato
+Civilistico.xlsx), un TB per entità ed esercizio (formato TB23.xlsx) e il
+workbook di mapping (formato export pagina 03).
+
+    python -m benchmarks.generate OUT_DIR --scale medium
+    python -m benchmarks.generate OUT_DIR --entities 10 --years 3 --accounts 50000
+
+Stessi parametri e stesso seed producono gli stessi file.
+"""
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Profili di scala: entità x esercizi x conti, più numero di sublead dello schema
+SCALES = {
+    "small": {"entities": 2, "years": 2, "accounts": 2000, "subleads": 190},
+    "medium": {"entities": 5, "years": 3, "accounts": 20000, "subleads": 400},
+    "large": {"entities": 20, "years": 3, "accounts": 100000, "subleads": 800},
+}
+
+LAST_YEAR = 2025
+CHART_OF_ACCOUNTS = "COA"
+
+# Lead skeleton of Civilistico.xlsx: (tipo, gruppo, group lead, lead, sublead prefix, segno, weight).
+# Lead names match the default materiality benchmarks (U0100, L Patrimonio netto, YF).
+LEAD_SKELETON = [
+    ("Attivo", 10, "AA - Crediti verso soci", "A Crediti verso soci", "A", 1, 1),
+    ("Attivo", 20, "AB - Immobilizzazioni", "B Immobilizzazioni immateriali", "B", 1, 8),
+    ("Attivo", 20, "AB - Immobilizzazioni", "C Immobilizzazioni materiali", "C", 1, 9),
+    ("Attivo", 20, "AB - Immobilizzazioni", "D Immobilizzazioni finanziarie", "D", 1, 24),
+    ("Attivo", 30, "AC - Attivo circolante", "E Rimanenze", "E", 1, 5),
+    ("Attivo", 30, "AC - Attivo circolante", "F Crediti", "F", 1, 23),
+    ("Attivo", 30, "AC - Attivo circolante", "G Attività finanziarie", "G", 1, 7),
+    ("Attivo", 30, "AC - Attivo circolante", "H Disponibilità liquide", "H", 1, 3),
+    ("Attivo", 40, "AD - Ratei e risconti attivi", "I Ratei e risconti attivi", "I", 1, 3),
+    ("Passivo", 100, "PA - Patrimonio netto", "L Patrimonio netto", "L", -1, 10),
+    ("Passivo", 100, "PA - Patrimonio netto", "L Patrimonio netto terzi", "LT", -1, 2),
+    ("Passivo", 110, "PB - Fondo rischi e oneri", "M Fondo rischi e oneri", "M", -1, 4),
+    ("Passivo", 120, "PC - Trattamento di fine rapporto", "N Trattamento di fine rapporto", "N", -1, 1),
+    ("Passivo", 130, "PD - Debiti", "P Debiti", "P", -1, 45),
+    ("Passivo", 140, "PE - Ratei e risconti passivi", "Q Ratei e risconti passivi", "Q", -1, 1),
+    ("CE", 200, "UA - Valore della produzione", "YA Valore della produzione", "U0", -1, 5),
+    ("CE", 210, "UB - Costi della produzione", "YB Costi della produzione", "UB", -1, 18),
+    ("CE", 220, "UC - Proventi e Oneri finanziari", "YC Proventi Oneri finanziari", "UC", -1, 6),
+    ("CE", 230, "UD - Rettifiche di valore", "YD Rettifiche di valore", "UD", -1, 11),
+    ("CE", 240, "UE - Imposte", "YF IMPOSTE", "UF", -1, 1),
+]
+
+# Sublead codes are prefix + 100, 101, ...: the first sublead of YA is U0100
+SUBLEAD_FIRST_NO = 100
+MAX_SUBLEADS_PER_LEAD = 900
+
+# Share of the chart each entity uses in a year, and of accounts left unmapped
+ENTITY_ACCOUNT_SHARE = 0.9
+UNMAPPED_SHARE = 0.02
+
+
+def scale_params(scale):
+    if scale not in SCALES:
+        raise ValueError(f"Scala non valida: {scale}. Ammesse: {sorted(SCALES)}")
+    return dict(SCALES[scale])
+
+
+def fiscal_years(years):
+    return list(range(LAST_YEAR - years + 1, LAST_YEAR + 1))
+
+
+def entity_codes(entities):
+    return [f"ENT{i:03d}" for i in range(1, entities + 1)]
+
+
+def build_schema(subleads):
+    """
+    Schema con `subleads` righe distribuite sulle lead dello scheletro in proporzione
+    al peso (almeno una per lead), nel formato di Civilistico.xlsx.
+    """
+    if subleads < len(LEAD_SKELETON):
+        raise ValueError(f"Servono almeno {len(LEAD_SKELETON)} sublead (una per lead).")
+    weights = np.array([row[-1] for row in LEAD_SKELETON], dtype=float)
+    counts = np.maximum(1, np.floor(weights / weights.sum() * subleads)).astype(int)
+    # Remainder to the heaviest leads, so the total is exactly `subleads`
+    for idx in np.argsort(-weights, kind="stable")[: subleads - counts.sum()]:
+        counts[idx] += 1
+    if counts.max() > MAX_SUBLEADS_PER_LEAD:
+        raise ValueError(f"Troppe sublead per lead (massimo {MAX_SUBLEADS_PER_LEAD}).")
+
+    rows = []
+    for (tipo, gruppo, group_lead, lead, prefix, segno, _), count in zip(LEAD_SKELETON, counts):
+        for i in range(count):
+            rows.append({
+                "Gruppo": gruppo,
+                "GroupLead": group_lead,
+                "Lead": lead,
+                "Sublead": f"{prefix}{SUBLEAD_FIRST_NO + i}",
+                "DescrizioneCEE": f"{lead} - voce {i + 1}",
+                "Tipo": tipo,
+                "SegnoRpt": segno,
+            })
+    return pd.DataFrame(rows)
+
+
+def build_chart(df_schema, accounts, seed):
+    """
+    Piano dei conti: codice, descrizione, sublead di mapping, segno e saldo base.
+    """
+    rng = np.random.default_rng([seed, 0])
+    sublead_idx = rng.integers(0, len(df_schema), accounts)
+    schema = df_schema.iloc[sublead_idx].reset_index(drop=True)
+    # Numeric codes without leading zeros, as in the sample TBs (Excel reads them back as numbers)
+    codes = [f"{int(g)}{i:06d}" for g, i in zip(schema["Gruppo"], range(1, accounts + 1))]
+    # Attivo has debit balances, Passivo credit; CE costs (UB/UD/UF) debit, revenues credit
+    sign = np.where(schema["Tipo"].eq("Attivo") | schema["Sublead"].str.match(r"U[BDF]"), 1.0, -1.0)
+    return pd.DataFrame({
+        "account_code": codes,
+        "account_name": "Conto " + pd.Series(codes) + " " + schema["DescrizioneCEE"].str.slice(0, 40),
+        "sublead": schema["Sublead"],
+        "sign": sign,
+        "base": rng.lognormal(mean=9.0, sigma=1.8, size=accounts).round(2),
+    })
+
+
+def build_trial_balance(df_chart, entity_no, year, seed):
+    """
+    TB di un'entità per un esercizio (colonne conto, descrizione, dare, avere):
+    un sottoinsieme stabile dei conti, con saldi che variano di anno in anno.
+    """
+    entity_rng = np.random.default_rng([seed, entity_no])
+    in_entity = entity_rng.random(len(df_chart)) < ENTITY_ACCOUNT_SHARE
+    entity_scale = entity_rng.lognormal(0.0, 0.5)
+    year_rng = np.random.default_rng([seed, entity_no, year])
+
+    df = df_chart[in_entity]
+    # Noise around a 3% yearly trend
+    growth = year_rng.normal(1.0, 0.15, len(df)) * 1.03 ** (year - LAST_YEAR)
+    closing = (df["sign"] * df["base"] * entity_scale * growth).round(2)
+    turnover = (df["base"] * year_rng.random(len(df))).round(2)
+    return pd.DataFrame({
+        "conto": df["account_code"].to_numpy(),
+        "descrizione": df["account_name"].to_numpy(),
+        "dare": (closing.clip(lower=0) + turnover).to_numpy(),
+        "avere": ((-closing).clip(lower=0) + turnover).to_numpy(),
+    })
+
+
+def build_mapping(df_chart, seed):
+    """
+    Mapping conto -> sublead (formato import pagina 03); una piccola quota di conti
+    resta senza sublead, come in un incarico reale ancora da completare.
+    """
+    rng = np.random.default_rng([seed, 1])
+    unmapped = rng.random(len(df_chart)) < UNMAPPED_SHARE
+    return pd.DataFrame({
+        "account_code": df_chart["account_code"].to_numpy(),
+        "sublead": df_chart["sublead"].where(~unmapped, "").to_numpy(),
+        "note": None,
+    })
+
+
+def _write_excel(df, path):
+    with pd.ExcelWriter(path, engine="xlsxwriter") as writer:
+        df.to_excel(writer, index=False)
+
+
+def generate_engagement(out_dir, entities, years, accounts, subleads=400, seed=0):
+    """
+    Scrive schema.xlsx, mapping.xlsx, tb/<entità>_<anno>.xlsx e manifest.json in
+    `out_dir`. Ritorna il manifest (parametri e percorsi dei file).
+    """
+    out_dir = Path(out_dir)
+    (out_dir / "tb").mkdir(parents=True, exist_ok=True)
+
+    df_schema = build_schema(subleads)
+    df_chart = build_chart(df_schema, accounts, seed)
+    _write_excel(df_schema, out_dir / "schema.xlsx")
+
+    trial_balances = []
+    used_codes = set()
+    for entity_no, entity_code in enumerate(entity_codes(entities), start=1):
+        for year in fiscal_years(years):
+            path = out_dir / "tb" / f"{entity_code}_{year}.xlsx"
+            df_tb = build_trial_balance(df_chart, entity_no, year, seed)
+            _write_excel(df_tb, path)
+            used_codes.update(df_tb["conto"])
+            trial_balances.append({
+                "entity_code": entity_code,
+                "fiscal_year": year,
+                "path": str(path.relative_to(out_dir)),
+                "rows": len(df_tb),
+            })
+
+    # Only accounts some TB created can be mapped (the import rejects unknown ones)
+    df_used = df_chart[df_chart["account_code"].isin(used_codes)]
+    _write_excel(build_mapping(df_used, seed), out_dir / "mapping.xlsx")
+
+    manifest = {
+        "params": {
+            "entities": entities, "years": years, "accounts": accounts,
+            "subleads": len(df_schema), "seed": seed,
+        },
+        "chart_of_accounts": CHART_OF_ACCOUNTS,
+        "schema": "schema.xlsx",
+        "mapping": "mapping.xlsx",
+        "trial_balances": trial_balances,
+    }
+    (out_dir / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera un incarico sintetico (schema, TB, mapping).")
+    parser.add_argument("out_dir", help="Cartella di destinazione")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--entities", type=int, help="Numero di entità (sovrascrive la scala)")
+    parser.add_argument("--years", type=int, help="Numero di esercizi fino al 2025 (sovrascrive la scala)")
+    parser.add_argument("--accounts", type=int, help="Conti del piano dei conti (sovrascrive la scala)")
+    parser.add_argument("--subleads", type=int, help="Sublead dello schema (sovrascrive la scala)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    params = scale_params(args.scale)
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    manifest = generate_engagement(args.out_dir, seed=args.seed, **params)
+    print(f"Incarico generato in {args.out_dir}: {len(manifest['trial_balances'])} TB, {params}")
+
+
+if __name__ == "__main__":
+    main()
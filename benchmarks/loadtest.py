@@ -0,0 +1,343 @@
+"""
+Test di carico con più sessioni concorrenti sulle pagine 02-05, guidate da
+streamlit.testing.v1.AppTest su un incarico sintetico.
+
+Ogni sessione è un utente con le sue pagine aperte (session_state propri) ed esegue
+un mix casuale di azioni: import di un TB (pagina 02), modifica del mapping (03),
+consultazione di bilancio e materialità (04, 05). Per ogni numero di sessioni
+riporta latenza dei rerun (p50/p95), errori di lock SQLite e memoria (RSS):
+
+    python -m benchmarks.loadtest --sessions 1 2 4 8 --actions 6
+    python -m benchmarks.loadtest --sessions 4 --scale medium --out loadtest.json
+
+Ogni sessione gira in un processo proprio: AppTest installa a ogni rerun un Runtime
+globale del processo, quindi due sessioni nello stesso processo non possono girare
+insieme. Le cache st.cache_data non sono quindi condivise tra sessioni come nel server:
+la memoria per sessione è un limite superiore.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.generate import generate_engagement, scale_params
+from modules.lead_numeric import db
+from modules.lead_numeric.export_pdf import _pool_context
+from modules.lead_numeric.import_schema import import_schema_from_excel
+from modules.lead_numeric.import_tb import import_trial_balance_from_excel
+from modules.lead_numeric.mapping import import_mapping_from_excel
+
+PAGES_DIR = Path(__file__).resolve().parent.parent / "pages"
+PAGES = {
+    "02": "02_Import_TB.py",
+    "03": "03_Mapping_Conti.py",
+    "04": "04_Bilancio_Riepilogo.py",
+    "05": "05_Materialita.py",
+}
+
+# Action mix of a session: relative weights
+ACTION_WEIGHTS = {"report": 6, "mapping": 3, "import": 1}
+RERUN_TIMEOUT = 600
+# Waiting for all sessions of a level to start (imports included)
+START_TIMEOUT = 300
+
+QUIET_LOGGERS = ("streamlit.deprecation_util", "streamlit.runtime.scriptrunner_utils.script_run_context")
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def prepare_database(work_dir, params, seed=0):
+    """
+    Genera l'incarico in work_dir e lo importa in un database nuovo
+    (work_dir/loadtest.db): schema, tutti i TB e mapping. Ritorna il manifest.
+    """
+    work_dir = Path(work_dir)
+    manifest = generate_engagement(work_dir, seed=seed, **params)
+    db_path = work_dir / "loadtest.db"
+    if db_path.exists():
+        db_path.unlink()
+    db.DB_PATH = db_path
+
+    import_schema_from_excel(work_dir / manifest["schema"], schema_name="Loadtest", version="1")
+    for tb in manifest["trial_balances"]:
+        import_trial_balance_from_excel(
+            work_dir / tb["path"],
+            entity_code=tb["entity_code"],
+            entity_name=tb["entity_code"],
+            fiscal_year=tb["fiscal_year"],
+            chart_of_accounts=manifest["chart_of_accounts"],
+            source_file_name=Path(tb["path"]).name,
+        )
+    import_mapping_from_excel(work_dir / manifest["mapping"], manifest["chart_of_accounts"])
+    return manifest
+
+
+def _rss_mb():
+    # Current resident set size (Linux /proc), else the process peak
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _by_label(widgets, label):
+    return next((w for w in widgets if w.label == label), None)
+
+
+class Session:
+    """
+    Un utente: una AppTest per pagina, aperta al primo uso e poi riusata come una
+    scheda del browser. Ogni rerun è misurato e classificato (ok, lock, errore).
+    """
+
+    def __init__(self, session_no, manifest, work_dir, seed):
+        self.session_no = session_no
+        self.manifest = manifest
+        self.work_dir = Path(work_dir)
+        self.rng = random.Random(seed * 1000 + session_no)
+        self.apps = {}
+        self.records = []
+
+    def _rerun(self, page, action, operation):
+        start = time.perf_counter()
+        status, message = "ok", ""
+        try:
+            at = operation()
+            messages = [str(getattr(e, "message", "") or e.value) for e in at.exception]
+            messages += [str(e.value) for e in at.error]
+        except Exception as e:
+            # AppTest timeout or a failure outside the page's own error handling
+            messages = [f"{type(e).__name__}: {e}"]
+        if messages:
+            message = messages[0][:300]
+            status = "lock" if any("locked" in m.lower() for m in messages) else "error"
+        self.records.append({
+            "session": self.session_no,
+            "page": page,
+            "action": action,
+            "seconds": time.perf_counter() - start,
+            "status": status,
+            "message": message,
+        })
+
+    def page(self, key):
+        # First use opens the page (a full first run, timed as such)
+        if key not in self.apps:
+            from streamlit.testing.v1 import AppTest
+
+            at = AppTest.from_file(str(PAGES_DIR / PAGES[key]), default_timeout=RERUN_TIMEOUT)
+            self.apps[key] = at
+            self._rerun(key, "apertura", at.run)
+        return self.apps[key]
+
+    def report(self):
+        at = self.page("04")
+        view = _by_label(at.sidebar.radio, "Vista Bilancio Riepilogo")
+        if view is not None:
+            self._rerun("04", "vista", lambda: view.set_value(self.rng.choice(view.options)).run())
+        unit = _by_label(at.sidebar.radio, "Unità importi")
+        if unit is not None and self.rng.random() < 0.3:
+            self._rerun("04", "unita_importi", lambda: unit.set_value(self.rng.choice(unit.options)).run())
+        at = self.page("05")
+        self._rerun("05", "rerun", at.run)
+
+    def mapping(self):
+        # Removes an account from its sublead, then maps it back: the database ends as it started
+        at = self.page("03")
+        remove = _by_label(at.multiselect, "Seleziona conti da rimuovere da questa Sublead")
+        if remove is None or not remove.options:
+            self._rerun("03", "rerun", at.run)
+            return
+        label = self.rng.choice(remove.options)
+        self._rerun("03", "seleziona_conti", lambda: remove.set_value([label]).run())
+        button = _by_label(at.button, "Rimuovi conti selezionati da Sublead")
+        if button is None:
+            return
+        self._rerun("03", "rimuovi_mapping", lambda: button.click().run())
+
+        accounts = _by_label(at.multiselect, "Conti")
+        if accounts is None or label not in accounts.options:
+            return
+        self._rerun("03", "seleziona_conti", lambda: accounts.set_value([label]).run())
+        button = _by_label(at.button, "Allinea conti selezionati alla Sublead")
+        if button is not None:
+            self._rerun("03", "allinea_mapping", lambda: button.click().run())
+
+    def import_tb(self):
+        # Re-imports one of the generated TBs: same entity/year, lines replaced
+        at = self.page("02")
+        tb = self.rng.choice(self.manifest["trial_balances"])
+        _by_label(at.text_input, "Entity code").set_value(tb["entity_code"])
+        _by_label(at.text_input, "Entity name").set_value(tb["entity_code"])
+        _by_label(at.text_input, "Chart of accounts").set_value(self.manifest["chart_of_accounts"])
+        _by_label(at.number_input, "Fiscal year").set_value(tb["fiscal_year"])
+        path = self.work_dir / tb["path"]
+        at.file_uploader[0].set_value((path.name, path.read_bytes(), XLSX_MIME))
+        self._rerun("02", "carica_file", at.run)
+        button = _by_label(at.button, "📥 Importa TB")
+        if button is not None:
+            self._rerun("02", "importa_tb", lambda: button.click().run())
+
+    def run(self, actions):
+        handlers = {"report": self.report, "mapping": self.mapping, "import": self.import_tb}
+        names = list(ACTION_WEIGHTS)
+        weights = [ACTION_WEIGHTS[n] for n in names]
+        for _ in range(actions):
+            handlers[self.rng.choices(names, weights)[0]]()
+        return self.records
+
+
+def _session_process(task, barrier, results):
+    # One session per process; all sessions of the level start together
+    try:
+        from streamlit.testing.v1 import AppTest  # noqa: F401  (import cost before the start)
+
+        # Notices logged on every rerun (AppTest resets logger levels, so disable them)
+        for name in QUIET_LOGGERS:
+            logging.getLogger(name).disabled = True
+        session = Session(**task["session"])
+        rss_start = _rss_mb()
+        barrier.wait(START_TIMEOUT)
+        started = time.time()
+        records = session.run(task["actions"])
+        results.put({
+            "records": records,
+            "rss_start_mb": rss_start,
+            "rss_peak_mb": _peak_rss_mb(),
+            "started": started,
+            "finished": time.time(),
+            "error": None,
+        })
+    except Exception as e:
+        barrier.abort()
+        results.put({"records": [], "error": f"{type(e).__name__}: {e}"})
+
+
+def run_level(sessions, manifest, work_dir, actions, seed=0):
+    """
+    Un livello di carico: `sessions` sessioni concorrenti (un processo ciascuna),
+    `actions` azioni ciascuna. Ritorna (record dei rerun, metriche del livello).
+    """
+    ctx = _pool_context()
+    barrier = ctx.Barrier(sessions)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=_session_process,
+            args=(
+                {"session": {"session_no": i, "manifest": manifest, "work_dir": str(work_dir), "seed": seed}, "actions": actions},
+                barrier,
+                results,
+            ),
+        )
+        for i in range(sessions)
+    ]
+    for process in processes:
+        process.start()
+    outcomes = []
+    try:
+        for _ in processes:
+            outcomes.append(results.get(timeout=START_TIMEOUT + RERUN_TIMEOUT * actions * 4))
+    except queue.Empty:
+        raise RuntimeError(f"Sessioni non terminate entro il tempo massimo ({sessions} sessioni).")
+    finally:
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    failed = [o["error"] for o in outcomes if o["error"]]
+    if failed:
+        raise RuntimeError(f"Sessione non avviata: {failed[0]}")
+    records = [r for o in outcomes for r in o["records"]]
+    peaks = [o["rss_peak_mb"] for o in outcomes]
+    # Own memory of a session: peak minus the process right after imports
+    own = [o["rss_peak_mb"] - o["rss_start_mb"] for o in outcomes]
+    metrics = {
+        "rss_mb": round(sum(peaks), 1),
+        "rss_mb_per_session": round(sum(own) / sessions, 1),
+        "wall_seconds": round(max(o["finished"] for o in outcomes) - min(o["started"] for o in outcomes), 3),
+    }
+    return records, metrics
+
+
+def summarize(records, level_metrics):
+    """
+    Riepilogo per numero di sessioni: rerun, latenza p50/p95/max, errori di lock,
+    altri errori, RSS e durata del livello.
+    """
+    df = pd.DataFrame(records)
+    rows = []
+    for sessions, df_level in df.groupby("sessions", sort=True):
+        rows.append({
+            "sessioni": sessions,
+            "rerun": len(df_level),
+            "p50_s": round(df_level["seconds"].quantile(0.5), 3),
+            "p95_s": round(df_level["seconds"].quantile(0.95), 3),
+            "max_s": round(df_level["seconds"].max(), 3),
+            "errori_lock": int((df_level["status"] == "lock").sum()),
+            "altri_errori": int((df_level["status"] == "error").sum()),
+            **level_metrics[sessions],
+        })
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test di carico con sessioni AppTest concorrenti (pagine 02-05).")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8], help="Numeri di sessioni concorrenti da provare")
+    parser.add_argument("--actions", type=int, default=6, help="Azioni per sessione")
+    parser.add_argument("--scale", default="small", help="Profilo di scala del generatore (small, medium, large)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", help="Cartella per file generati e database (default: temporanea)")
+    parser.add_argument("--out", help="File JSON con riepilogo e record dei rerun")
+    args = parser.parse_args(argv)
+
+    params = scale_params(args.scale)
+    with tempfile.TemporaryDirectory(prefix="aap_load_") as tmp:
+        work_dir = Path(args.work_dir or tmp)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        manifest = prepare_database(work_dir, params, seed=args.seed)
+        # Pages and process workers use the generated database, never data/
+        os.environ["AAP_DB_PATH"] = str(db.DB_PATH)
+        os.environ["AAP_PROFILE_LOG"] = str(work_dir / "profiling.jsonl")
+
+        records, level_metrics = [], {}
+        for sessions in args.sessions:
+            level_records, level_metrics[sessions] = run_level(
+                sessions, manifest, work_dir, args.actions, seed=args.seed
+            )
+            records += [{**r, "sessions": sessions} for r in level_records]
+            print(f"{sessions} sessioni: {len(level_records)} rerun in {level_metrics[sessions]['wall_seconds']:.1f} s", flush=True)
+
+    df_summary = summarize(records, level_metrics)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(df_summary.to_string(index=False))
+    if args.out:
+        Path(args.out).write_text(
+            json.dumps(
+                {"params": params, "actions": args.actions, "summary": df_summary.to_dict("records"), "reruns": records},
+                indent=2,
+            ),
+            encoding="utf-8",
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
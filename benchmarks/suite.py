@@ -0,0 +1,376 @@
+"""
+Benchmark di import, mapping, reporting ed export su un incarico sintetico.
+
+Per ogni fase misura il tempo (mediana di --repeat esecuzioni) e il picco di memoria
+Python (tracemalloc, in un'esecuzione separata per non falsare i tempi), poi scrive
+i risultati in JSON e li confronta con una baseline salvata:
+
+    python -m benchmarks.suite --scale small --out results.json
+    python -m benchmarks.suite --scale small --save-baseline
+
+Il database è creato da zero in una cartella temporanea (mai data/audit.db). Esce con
+codice 1 se una fase peggiora oltre la tolleranza rispetto alla baseline.
+
+I tempi della baseline sono assoluti e valgono per la macchina che li ha prodotti:
+per default il confronto divide i tempi correnti per il rapporto mediano
+corrente/baseline delle fasi, così una macchina più lenta o più veloce non segnala
+regressioni: conta solo la fase che rallenta rispetto alle altre. Con --absolute i secondi sono confrontati così come sono: rigenerare la
+baseline con --save-baseline sulla macchina in uso.
+"""
+import argparse
+import gc
+import json
+import numbers
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.generate import generate_engagement, scale_params
+from modules.lead_numeric import db
+from modules.lead_numeric.bilancio import bilancio_excel_sheets, compute_bilancio_views, load_bilancio_dataset
+from modules.lead_numeric.export_docx import build_docx_by_lead
+from modules.lead_numeric.export_materiality import MATERIALITY_EXPORT_BUILDERS, materiality_export_frames
+from modules.lead_numeric.export_pdf import build_pdf_by_lead
+from modules.lead_numeric.export_xlsx import write_bilancio_xlsx
+from modules.lead_numeric.import_schema import import_schema_from_excel
+from modules.lead_numeric.import_tb import import_trial_balance_from_excel
+from modules.lead_numeric.mapping import (
+    export_mapping_to_excel,
+    import_mapping_from_excel,
+    load_mapping_for_chart,
+    load_tb_accounts,
+)
+from modules.lead_numeric.materiality import (
+    criteria_table,
+    load_benchmark_values,
+    load_benchmarks,
+    materiality_results,
+    materiality_scenarios,
+)
+
+BASELINE_DIR = Path(__file__).resolve().parent
+
+# A stage regresses when it is slower/larger than baseline by more than the
+# tolerance AND by more than these absolute floors (noise on very short stages)
+DEFAULT_TOLERANCE = 0.25
+MIN_SECONDS_DELTA = 0.05
+MIN_PEAK_MB_DELTA = 1.0
+
+
+def _output_size(result):
+    # Size of what a stage produced, recorded to spot stages that silently did less work
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, dict):
+        # Views (frames) or import counters (ints)
+        sizes = [_output_size(v) for v in result.values()]
+        return sum(size for size in sizes if size is not None)
+    if isinstance(result, numbers.Integral):
+        return int(result)
+    return None
+
+
+def measure(func, repeat=1):
+    """
+    Esegue `func` `repeat` volte per i tempi e una volta sotto tracemalloc per il
+    picco di memoria. Ritorna (metriche, risultato dell'ultima esecuzione).
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+
+    result = None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    metrics = {
+        "seconds": statistics.median(runs),
+        "runs": [round(r, 4) for r in runs],
+        "peak_mb": round(peak / 2**20, 2),
+        "output": _output_size(result),
+    }
+    return metrics, result
+
+
+def _stages(work_dir, manifest, repeat):
+    """
+    Fasi del benchmark nell'ordine d'uso dell'app: ogni voce è (nome, funzione,
+    ripetizioni). Le fasi successive leggono il database preparato dalle precedenti.
+    """
+    chart = manifest["chart_of_accounts"]
+    years = sorted({tb["fiscal_year"] for tb in manifest["trial_balances"]}, reverse=True)
+    latest_year, previous_year = years[0], years[min(1, len(years) - 1)]
+    latest_col, previous_col = f"importo_{latest_year}", f"importo_{previous_year}"
+    state = {"schema_runs": 0}
+
+    def import_schema():
+        # Name+version may be imported once: each run adds a new (identical) latest schema
+        state["schema_runs"] += 1
+        return import_schema_from_excel(
+            work_dir / manifest["schema"], schema_name="Benchmark", version=str(state["schema_runs"])
+        )
+
+    def import_trial_balances():
+        tb_ids = []
+        for tb in manifest["trial_balances"]:
+            tb_id, _ = import_trial_balance_from_excel(
+                work_dir / tb["path"],
+                entity_code=tb["entity_code"],
+                entity_name=tb["entity_code"],
+                fiscal_year=tb["fiscal_year"],
+                chart_of_accounts=chart,
+                source_file_name=Path(tb["path"]).name,
+            )
+            tb_ids.append(tb_id)
+        state["tb_id"] = tb_ids[0]
+        return tb_ids
+
+    def with_conn(func):
+        def run():
+            conn = db.get_conn()
+            try:
+                return func(conn)
+            finally:
+                conn.close()
+        return run
+
+    def bilancio_dataset():
+        state["dataset"] = with_conn(load_bilancio_dataset)()
+        return state["dataset"]
+
+    def bilancio_views():
+        state["views"] = compute_bilancio_views(state["dataset"], latest_year, previous_year)
+        return state["views"]
+
+    def export_xlsx():
+        return write_bilancio_xlsx(
+            bilancio_excel_sheets(state["views"]),
+            amount_cols=[latest_col, previous_col, "differenza_valore"],
+        )
+
+    def export_kwargs():
+        return {
+            "df_source": state["views"]["pivot"],
+            "latest_col": latest_col,
+            "previous_col": previous_col,
+            "latest_year": latest_year,
+            "previous_year": previous_year,
+        }
+
+    def benchmark_values(by_entity):
+        def run(conn):
+            state["benchmarks"] = load_benchmarks(conn)
+            return load_benchmark_values(conn, state["benchmarks"], by_entity=by_entity)
+        return with_conn(run)
+
+    def scenarios():
+        df_values = benchmark_values(False)()
+        state["values"] = df_values
+        return materiality_scenarios(df_values, state["benchmarks"])
+
+    def materiality_frames():
+        # Page 05 export tables for the latest year, every benchmark selected
+        benchmarks = state["benchmarks"]
+        row = state["values"].set_index("fiscal_year").loc[latest_year]
+        basi_map = {b["label"]: float(row[b["code"]] or 0) for b in benchmarks}
+        selections = [{"Voce": b["label"], "Selezione": True} for b in benchmarks]
+        df_criteria = criteria_table(benchmarks, basi_map, selections)
+        state["materiality_frames"] = materiality_export_frames(
+            df_criteria, materiality_results(df_criteria), "Materialita preliminare", latest_year, "Benchmark"
+        )
+        return state["materiality_frames"]
+
+    def materiality_export(export_format):
+        return lambda: MATERIALITY_EXPORT_BUILDERS[export_format](*state["materiality_frames"])
+
+    return [
+        ("import_schema_from_excel", import_schema, 1),
+        ("import_trial_balance_from_excel", import_trial_balances, 1),
+        ("03_import_mapping_from_excel", lambda: import_mapping_from_excel(work_dir / manifest["mapping"], chart), 1),
+        ("03_load_tb_accounts", lambda: with_conn(lambda conn: load_tb_accounts(conn, state["tb_id"]))(), repeat),
+        ("03_load_mapping_for_chart", lambda: with_conn(lambda conn: load_mapping_for_chart(conn, chart))(), repeat),
+        ("03_export_mapping_to_excel", lambda: export_mapping_to_excel(chart), repeat),
+        ("04_load_bilancio_dataset", bilancio_dataset, repeat),
+        ("04_compute_bilancio_views", bilancio_views, repeat),
+        ("04_export_xlsx", export_xlsx, repeat),
+        ("04_export_pdf", lambda: build_pdf_by_lead(**export_kwargs()), repeat),
+        ("04_export_docx", lambda: build_docx_by_lead(**export_kwargs()), repeat),
+        ("05_basi_per_anno", benchmark_values(False), repeat),
+        ("05_basi_per_entita", benchmark_values(True), repeat),
+        ("05_materiality_scenarios", scenarios, repeat),
+        ("05_materiality_export_frames", materiality_frames, repeat),
+    ] + [
+        (f"05_export_{export_format}", materiality_export(export_format), repeat)
+        for export_format in MATERIALITY_EXPORT_BUILDERS
+    ]
+
+
+def run_suite(params, repeat=3, seed=0, work_dir=None):
+    """
+    Genera l'incarico, prepara un database vuoto e misura tutte le fasi.
+    Ritorna il dict dei risultati (meta + fasi).
+    """
+    with tempfile.TemporaryDirectory(prefix="aap_bench_") as tmp:
+        work_dir = Path(work_dir or tmp)
+        manifest = generate_engagement(work_dir, seed=seed, **params)
+        db.DB_PATH = work_dir / "benchmark.db"
+        if db.DB_PATH.exists():
+            db.DB_PATH.unlink()
+
+        stages = {}
+        for name, func, stage_repeat in _stages(work_dir, manifest, repeat):
+            metrics, _ = measure(func, stage_repeat)
+            stages[name] = metrics
+            print(f"{name:<36} {metrics['seconds']:>9.3f} s {metrics['peak_mb']:>9.1f} MB", flush=True)
+
+    return {
+        "meta": {
+            "params": params,
+            "seed": seed,
+            "repeat": repeat,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+        },
+        "stages": stages,
+    }
+
+
+def _time_scale(results, baseline):
+    # Inverse of the median current/baseline time ratio over the shared stages:
+    # rescales current timings to the baseline machine. The median, not the totals,
+    # so one noisy single-run stage does not shift every other stage
+    ratios = [
+        current["seconds"] / baseline["stages"][name]["seconds"]
+        for name, current in results["stages"].items()
+        if baseline["stages"].get(name, {}).get("seconds") and current["seconds"]
+    ]
+    return 1 / statistics.median(ratios) if ratios else 1.0
+
+
+def compare_with_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE, normalize=True):
+    """
+    Confronto fase per fase con la baseline. Ritorna un DataFrame con rapporti e
+    flag di regressione (tempo e picco di memoria). Con normalize i tempi correnti
+    sono riscalati sulla macchina della baseline (secondi_scalati, vedi _time_scale):
+    confronta le fasi tra loro, non la velocità della macchina.
+    """
+    scale = _time_scale(results, baseline) if normalize else 1.0
+    rows = []
+    for name, current in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        seconds = current["seconds"] * scale
+        time_ratio = seconds / base["seconds"] if base["seconds"] else np.nan
+        mem_ratio = current["peak_mb"] / base["peak_mb"] if base["peak_mb"] else np.nan
+        rows.append({
+            "fase": name,
+            "secondi": current["seconds"],
+            "secondi_scalati": seconds,
+            "secondi_baseline": base["seconds"],
+            "rapporto_tempo": time_ratio,
+            "picco_mb": current["peak_mb"],
+            "picco_mb_baseline": base["peak_mb"],
+            "rapporto_memoria": mem_ratio,
+            "regressione_tempo": (
+                seconds > base["seconds"] * (1 + tolerance)
+                and seconds - base["seconds"] > MIN_SECONDS_DELTA
+            ),
+            "regressione_memoria": (
+                current["peak_mb"] > base["peak_mb"] * (1 + tolerance)
+                and current["peak_mb"] - base["peak_mb"] > MIN_PEAK_MB_DELTA
+            ),
+        })
+    return pd.DataFrame(rows)
+
+
+def baseline_path(scale):
+    return BASELINE_DIR / f"baseline_{scale}.json"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark di import, mapping, reporting ed export.")
+    parser.add_argument("--scale", default="small", help="Profilo di scala del generatore (small, medium, large)")
+    parser.add_argument("--entities", type=int)
+    parser.add_argument("--years", type=int)
+    parser.add_argument("--accounts", type=int)
+    parser.add_argument("--subleads", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Esecuzioni per i tempi delle fasi ripetibili")
+    parser.add_argument("--work-dir", help="Cartella per file generati e database (default: temporanea)")
+    parser.add_argument("--out", help="File JSON dei risultati")
+    parser.add_argument("--baseline", help="Baseline da confrontare (default: benchmarks/baseline_<scala>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Salva i risultati come baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--absolute",
+        action="store_true",
+        help="Confronta i secondi senza riscalarli (baseline generata sulla stessa macchina)",
+    )
+    args = parser.parse_args(argv)
+
+    params = scale_params(args.scale)
+    custom = False
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+            custom = True
+
+    results = run_suite(params, repeat=args.repeat, seed=args.seed, work_dir=args.work_dir)
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+    # Baselines are per scale profile: a custom size has none unless given explicitly
+    target = Path(args.baseline) if args.baseline else (None if custom else baseline_path(args.scale))
+    if args.save_baseline:
+        if target is None:
+            parser.error("Con parametri personalizzati indicare --baseline per salvare.")
+        target.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"Baseline salvata in {target}")
+        return 0
+    if target is None or not target.exists():
+        print("Nessuna baseline da confrontare.")
+        return 0
+
+    baseline = json.loads(target.read_text(encoding="utf-8"))
+    if baseline["meta"]["params"] != params:
+        print(f"Baseline {target} generata con parametri diversi: {baseline['meta']['params']}")
+        return 0
+    if args.absolute and baseline["meta"].get("platform") != results["meta"]["platform"]:
+        print(f"Baseline generata su un'altra macchina ({baseline['meta'].get('platform')}): rigenerarla con --save-baseline.")
+    df_compare = compare_with_baseline(results, baseline, args.tolerance, normalize=not args.absolute)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(df_compare.round(3).to_string(index=False))
+    regressions = df_compare[df_compare["regressione_tempo"] | df_compare["regressione_memoria"]]
+    if not regressions.empty:
+        print(f"Regressioni oltre il {args.tolerance:.0%}: {', '.join(regressions['fase'])}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
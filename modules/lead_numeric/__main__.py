@@ -0,0 +1,92 @@
+"""
+Generazione dei report senza Streamlit, per entità e in parallelo:
+
+    python -m modules.lead_numeric report --entity ENT001 ENT002 --years 2025 2024 --format pdf,xlsx
+    python -m modules.lead_numeric report --out-dir reports --materialita preliminare
+
+Senza --entity sono incluse tutte le entità; senza --years i due esercizi più recenti.
+Esce con codice 1 se il report di almeno un'entità non è stato generato.
+"""
+import argparse
+import sys
+from pathlib import Path
+
+from modules.lead_numeric import db
+from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.formatting import AMOUNT_UNITS
+from modules.lead_numeric.report import MATERIALITY_SECTIONS, load_report_years, parse_formats, run_reports
+
+
+def _report(args, parser):
+    try:
+        formats = parse_formats(args.format)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.db:
+        db.DB_PATH = Path(args.db)
+    if not db.DB_PATH.exists():
+        parser.error(f"Database non trovato: {db.DB_PATH}")
+    init_db()
+
+    if args.years:
+        latest_year, previous_year = args.years
+    else:
+        conn = db.get_conn()
+        try:
+            years = load_report_years(conn)
+        finally:
+            conn.close()
+        if not years:
+            print("Nessun dato di bilancio disponibile.")
+            return 1
+        latest_year, previous_year = years[0], years[min(1, len(years) - 1)]
+
+    results = run_reports(
+        latest_year,
+        previous_year,
+        formats,
+        args.out_dir,
+        entity_codes=args.entity,
+        amount_unit=args.amount_unit,
+        sections=args.materialita or (),
+        max_workers=args.workers,
+    )
+    if not results:
+        print("Nessuna entità da elaborare.")
+        return 1
+
+    failed = 0
+    for result in results:
+        if result["error"]:
+            failed += 1
+            print(f"{result['entity_code']}: ERRORE {result['error']}")
+            continue
+        print(f"{result['entity_code']}: {len(result['files'])} file")
+        for note in result["skipped"]:
+            print(f"  saltato {note}")
+    print(f"Report {latest_year} vs {previous_year} in {args.out_dir}: {len(results) - failed}/{len(results)} entità.")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m modules.lead_numeric", description="Strumenti da riga di comando.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    report = commands.add_parser("report", help="Report di bilancio (e materialità) per entità")
+    report.add_argument("--entity", nargs="+", help="Codici entità (default: tutte)")
+    report.add_argument("--years", nargs=2, type=int, metavar=("ULTIMO", "PRECEDENTE"), help="Esercizi a confronto")
+    report.add_argument("--format", default="xlsx", help="Formati separati da virgola: xlsx, pdf, docx")
+    report.add_argument("--out-dir", default="reports", help="Cartella di destinazione (una sottocartella per entità)")
+    report.add_argument("--workers", type=int, help="Processi in parallelo (default: numero di CPU)")
+    report.add_argument("--amount-unit", choices=sorted(AMOUNT_UNITS), default="euro")
+    report.add_argument("--materialita", nargs="+", choices=sorted(MATERIALITY_SECTIONS), help="Sezioni di materialità salvate da includere")
+    report.add_argument("--db", help="Database SQLite (default: AAP_DB_PATH o data/audit.db)")
+    args = parser.parse_args(argv)
+
+    if args.command == "report":
+        return _report(args, parser)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
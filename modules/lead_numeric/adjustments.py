@@ -0,0 +1,248 @@
+from datetime import datetime
+
+import pandas as pd
+
+from modules.lead_numeric.db import bump_data_version
+from modules.lead_numeric.entries import AMOUNT_TOLERANCE, clean_text
+from modules.lead_numeric.mapping import MAPPING_CTE
+
+# ISA 450 A6: factual, judgmental and projected misstatements
+ADJUSTMENT_TYPES = {"fattuale": "Fattuale", "giudizio": "Di giudizio", "proiettato": "Proiettato"}
+ADJUSTMENT_STATUSES = {
+    "proposta": "Proposta",
+    "registrata": "Registrata dalla direzione",
+    "non_registrata": "Non registrata",
+}
+ADJUSTMENT_COLS = ["entry_ref", "account_code", "amount", "adj_type", "status", "description"]
+ADJUSTED_AMOUNT_COLS = ["saldo", "rettifiche_registrate", "saldo_rettificato", "rettifiche_non_registrate"]
+SUD_AMOUNT_COLS = ["attivo", "passivo", "conto_economico", "non_mappato", "effetto_risultato"]
+
+# Group columns of the adjusted TB per level (unmapped accounts: empty sublead)
+ADJUSTED_LEVELS = {
+    "account": ["ga.account_code", "ga.account_name", "vm.sublead", "ls.lead", "ls.tipo"],
+    "sublead": ["ls.tipo", "ls.group_lead", "ls.lead", "vm.sublead", "ls.descrizione_cee"],
+}
+
+
+def tb_line_cte(adjusted=False):
+    """
+    CTE `tb_line` (trial_balance_id, gl_account_id, closing_balance) al posto di
+    trial_balance_line: con adjusted le rettifiche registrate si aggiungono come
+    righe, senza copiare il TB. Le query di report aggregano comunque per conto
+    o sublead, quindi più righe per conto non cambiano la loro forma.
+    """
+    base = "SELECT trial_balance_id, gl_account_id, closing_balance FROM trial_balance_line"
+    if not adjusted:
+        return f"tb_line AS ({base})"
+    return f"""tb_line AS (
+            {base}
+            UNION ALL
+            SELECT trial_balance_id, gl_account_id, amount FROM audit_adjustment WHERE status = 'registrata'
+        )"""
+
+
+def load_adjustments(conn, trial_balance_id) -> pd.DataFrame:
+    return pd.read_sql(
+        """
+        SELECT aa.entry_ref, ga.account_code, ga.account_name, aa.amount, aa.adj_type, aa.status, aa.description
+        FROM audit_adjustment aa
+        JOIN gl_account ga ON ga.id = aa.gl_account_id
+        WHERE aa.trial_balance_id = ?
+        ORDER BY aa.entry_ref, aa.id
+        """,
+        conn,
+        params=(int(trial_balance_id),),
+    )
+
+
+def save_adjustments(conn, trial_balance_id, df_adjustments) -> int:
+    """
+    Sostituisce le scritture di rettifica di un TB (colonne ADJUSTMENT_COLS, conti
+    del piano dei conti del TB). Ogni scrittura deve quadrare e avere un solo tipo
+    e stato. Ritorna il numero di righe.
+    """
+    df = df_adjustments.reindex(columns=ADJUSTMENT_COLS).copy()
+    for col in ("entry_ref", "account_code", "adj_type", "status", "description"):
+        df[col] = clean_text(df[col])
+    df["amount"] = pd.to_numeric(df["amount"], errors="coerce")
+    df = df[(df[["entry_ref", "account_code", "description"]] != "").any(axis=1) | df["amount"].notna()]
+    df["adj_type"] = df["adj_type"].replace("", "fattuale")
+    df["status"] = df["status"].replace("", "proposta")
+    if ((df["entry_ref"] == "") | (df["account_code"] == "") | df["amount"].isna()).any():
+        raise ValueError("Righe di rettifica incomplete: indicare riferimento, conto e importo.")
+    invalid_type = sorted(set(df["adj_type"]) - set(ADJUSTMENT_TYPES))
+    if invalid_type:
+        raise ValueError(f"Tipo di rettifica non valido: {invalid_type}. Ammessi: {list(ADJUSTMENT_TYPES)}")
+    invalid_status = sorted(set(df["status"]) - set(ADJUSTMENT_STATUSES))
+    if invalid_status:
+        raise ValueError(f"Stato di rettifica non valido: {invalid_status}. Ammessi: {list(ADJUSTMENT_STATUSES)}")
+    mixed = df.groupby("entry_ref")[["adj_type", "status"]].nunique()
+    mixed = mixed[(mixed > 1).any(axis=1)].index.tolist()
+    if mixed:
+        raise ValueError(f"Scritture con righe di tipo o stato diverso: {mixed[:30]}")
+    totals = df.groupby("entry_ref")["amount"].sum()
+    unbalanced = totals[totals.abs() > AMOUNT_TOLERANCE]
+    if not unbalanced.empty:
+        raise ValueError(
+            "Scritture di rettifica non quadrate: "
+            + ", ".join(f"{ref} ({amount:,.2f})" for ref, amount in unbalanced.head(30).items())
+        )
+
+    row = conn.execute(
+        "SELECT chart_of_accounts FROM trial_balance_header WHERE id = ?", (int(trial_balance_id),)
+    ).fetchone()
+    if row is None:
+        raise ValueError(f"Trial balance non trovato: {trial_balance_id}")
+    account_ids = dict(
+        conn.execute("SELECT account_code, id FROM gl_account WHERE chart_of_accounts = ?", (row[0],)).fetchall()
+    )
+    unknown = sorted(set(df["account_code"]) - set(account_ids))
+    if unknown:
+        raise ValueError(f"Conti non presenti nel piano dei conti {row[0]}: {unknown[:30]}")
+
+    created_at = datetime.now().isoformat(timespec="seconds")
+    conn.execute("DELETE FROM audit_adjustment WHERE trial_balance_id = ?", (int(trial_balance_id),))
+    conn.executemany(
+        """
+        INSERT INTO audit_adjustment
+        (trial_balance_id, gl_account_id, entry_ref, amount, adj_type, status, description, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (
+                int(trial_balance_id), int(account_ids[r.account_code]), r.entry_ref, float(r.amount),
+                r.adj_type, r.status, r.description or None, created_at,
+            )
+            for r in df.itertuples()
+        ],
+    )
+    bump_data_version(conn)
+    conn.commit()
+    return len(df)
+
+
+def adjusted_trial_balance(conn, trial_balance_id, level="account") -> pd.DataFrame:
+    """
+    TB rettificato per conto o per sublead: saldo importato, rettifiche registrate,
+    saldo rettificato e (a parte) rettifiche proposte o non registrate. Saldi e
+    rettifiche sono letti come due insiemi di righe e sommati in un'unica GROUP BY.
+    """
+    if level not in ADJUSTED_LEVELS:
+        raise ValueError(f"Livello non valido: {level}. Ammessi: {list(ADJUSTED_LEVELS)}")
+    group_cols = ADJUSTED_LEVELS[level]
+    select_cols = ", ".join(
+        f"COALESCE({col}, '') AS {col.split('.')[1]}" if col.startswith(("vm.", "ls.")) else col
+        for col in group_cols
+    )
+    df = pd.read_sql(
+        MAPPING_CTE.rstrip()
+        + """,
+        tb_amounts AS (
+            SELECT gl_account_id, closing_balance AS saldo, 0 AS registrate, 0 AS non_registrate
+            FROM trial_balance_line
+            WHERE trial_balance_id = :tb_id
+            UNION ALL
+            SELECT gl_account_id, 0,
+                   CASE WHEN status = 'registrata' THEN amount ELSE 0 END,
+                   CASE WHEN status = 'registrata' THEN 0 ELSE amount END
+            FROM audit_adjustment
+            WHERE trial_balance_id = :tb_id
+        )
+        SELECT """
+        + select_cols
+        + """,
+               SUM(t.saldo) AS saldo,
+               SUM(t.registrate) AS rettifiche_registrate,
+               SUM(t.saldo + t.registrate) AS saldo_rettificato,
+               SUM(t.non_registrate) AS rettifiche_non_registrate
+        FROM tb_amounts t
+        JOIN gl_account ga ON ga.id = t.gl_account_id
+        LEFT JOIN valid_mapping vm ON vm.gl_account_id = t.gl_account_id
+        LEFT JOIN latest_schema s ON 1=1
+        LEFT JOIN lead_structure ls
+          ON ls.schema_version_id = s.id
+         AND ls.sublead = vm.sublead
+        GROUP BY """
+        + ", ".join(group_cols)
+        + " ORDER BY "
+        + ", ".join(group_cols),
+        conn,
+        params={"tb_id": int(trial_balance_id)},
+    )
+    return df.rename(columns={"descrizione_cee": "descr_sublead"})
+
+
+def unadjusted_differences(conn, fiscal_year, legal_entity_id=None) -> pd.DataFrame:
+    """
+    Riepilogo delle differenze non rettificate (rettifiche proposte o non
+    registrate) dell'esercizio, una riga per scrittura, con l'effetto su attivo,
+    passivo e conto economico dal mapping dei conti. effetto_risultato è positivo
+    se la scrittura aumenta l'utile (dare positivo). Senza entità: tutte.
+    """
+    entity_filter = "" if legal_entity_id is None else " AND tbh.legal_entity_id = :entity_id"
+    return pd.read_sql(
+        MAPPING_CTE
+        + f"""
+        SELECT le.entity_code, aa.entry_ref, MAX(aa.description) AS description, aa.adj_type, aa.status,
+               SUM(CASE WHEN ls.tipo_key = 'ATTIVO' THEN aa.amount ELSE 0 END) AS attivo,
+               SUM(CASE WHEN ls.tipo_key = 'PASSIVO' THEN aa.amount ELSE 0 END) AS passivo,
+               SUM(CASE WHEN ls.id IS NOT NULL AND ls.tipo_key NOT IN ('ATTIVO', 'PASSIVO') THEN aa.amount ELSE 0 END)
+                   AS conto_economico,
+               SUM(CASE WHEN ls.id IS NULL THEN aa.amount ELSE 0 END) AS non_mappato,
+               -SUM(CASE WHEN ls.id IS NOT NULL AND ls.tipo_key NOT IN ('ATTIVO', 'PASSIVO') THEN aa.amount ELSE 0 END)
+                   AS effetto_risultato
+        FROM audit_adjustment aa
+        JOIN trial_balance_header tbh ON tbh.id = aa.trial_balance_id
+        JOIN legal_entity le ON le.id = tbh.legal_entity_id
+        LEFT JOIN valid_mapping vm ON vm.gl_account_id = aa.gl_account_id
+        LEFT JOIN latest_schema s ON 1=1
+        LEFT JOIN lead_structure ls
+          ON ls.schema_version_id = s.id
+         AND ls.sublead = vm.sublead
+        WHERE aa.status IN ('proposta', 'non_registrata')
+          AND tbh.fiscal_year = :fiscal_year{entity_filter}
+        GROUP BY le.entity_code, aa.trial_balance_id, aa.entry_ref, aa.adj_type, aa.status
+        ORDER BY le.entity_code, aa.entry_ref
+        """,
+        conn,
+        params={"fiscal_year": int(fiscal_year), "entity_id": legal_entity_id},
+    )
+
+
+def _threshold_outcome(value, decision):
+    value = abs(value)
+    if value > abs(decision["materialita_generale"] or 0):
+        return "Supera la materialità generale"
+    if value > abs(decision["materialita_operativa"] or 0):
+        return "Supera la materialità operativa"
+    if value > abs(decision["errori_trascurabili"] or 0):
+        return "Sopra la soglia di errore trascurabile"
+    return "Chiaramente trascurabile"
+
+
+def evaluate_unadjusted_differences(df_sud, decision) -> pd.DataFrame:
+    """
+    Totali delle differenze non rettificate confrontati con le soglie di una
+    decisione di materialità (pagina 05): una riga per area di bilancio con
+    importo, % della materialità generale ed esito (ISA 450 par. 11).
+    """
+    generale = abs(decision["materialita_generale"] or 0)
+    above_trivial = df_sud["effetto_risultato"].abs() > abs(decision["errori_trascurabili"] or 0)
+    rows = []
+    for col, label in [
+        ("effetto_risultato", "Effetto sul risultato"),
+        ("attivo", "Attivo"),
+        ("passivo", "Passivo e patrimonio netto"),
+    ]:
+        total = float(df_sud[col].sum())
+        rows.append(
+            {
+                "Area": label,
+                "Totale non rettificato": total,
+                "% materialità generale": abs(total) / generale * 100 if generale else None,
+                "Esito": _threshold_outcome(total, decision),
+            }
+        )
+    df = pd.DataFrame(rows)
+    df.attrs["scritture_sopra_trascurabile"] = int(above_trivial.sum())
+    return df
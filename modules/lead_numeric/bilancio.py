@@ -0,0 +1,356 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from modules.lead_numeric.adjustments import tb_line_cte
+from modules.lead_numeric.export_xlsx import iter_frame_rows
+from modules.lead_numeric.profiling import stage
+from modules.lead_numeric.schemas import report_schema_params, report_sublead_cte
+
+TIPO_ORDER = ["ATTIVO", "PASSIVO", "CE"]
+TIPO_LABELS = {"ATTIVO": "ATTIVO", "PASSIVO": "PASSIVO", "CE": "CONTO ECONOMICO"}
+
+# Text dimensions of the reporting dataset: held as categoricals (integer codes
+# plus one copy of each distinct label) through load, pivot and rollup
+DIMENSION_COLS = ["group_lead", "tipo", "lead", "sublead", "descr_sublead", "account_code", "account_name"]
+
+LOAD_CHUNK_ROWS = 50000
+
+BILANCIO_QUERY = """
+WITH {report_sublead},
+{tb_line},
+latest_mapping AS (
+    SELECT *
+    FROM (
+        SELECT m.*,
+               ROW_NUMBER() OVER (
+                   PARTITION BY m.gl_account_id
+                   ORDER BY m.schema_version_id DESC, m.id DESC
+               ) AS rn
+        FROM account_lead_mapping m
+        WHERE m.is_active = 1
+    )
+    WHERE rn = 1
+)
+SELECT ls.group_lead, ls.tipo, ls.lead, ls.sublead, ls.descrizione_cee AS descr_sublead, ga.account_code, ga.account_name,
+       tbl.closing_balance AS importo, tbh.fiscal_year
+FROM latest_mapping m
+JOIN gl_account ga ON ga.id = m.gl_account_id
+JOIN report_sublead ls ON ls.source_sublead = m.sublead
+LEFT JOIN tb_line tbl ON tbl.gl_account_id = ga.id
+LEFT JOIN trial_balance_header tbh ON tbl.trial_balance_id = tbh.id
+WHERE tbh.fiscal_year IS NOT NULL{entity_filter}
+ORDER BY ls.group_lead, ls.tipo, ls.lead, ga.account_code, tbh.fiscal_year
+"""
+
+
+def _encode_chunk(df):
+    for col in DIMENSION_COLS:
+        df[col] = df[col].astype("category")
+    df["importo"] = pd.to_numeric(df["importo"], errors="coerce").astype("float64")
+    df["fiscal_year"] = df["fiscal_year"].astype("int32")
+    return df
+
+
+def load_bilancio_dataset(conn, legal_entity_id=None, schema_version_id=None, adjusted=False):
+    """
+    Dati di bilancio mappati, letti a blocchi e codificati subito: le stringhe di
+    un blocco non sopravvivono alla sua lettura. Con legal_entity_id solo i TB di
+    quell'entità, altrimenti la somma di tutte. schema_version_id sceglie lo schema
+    di reporting (None = ultimo primario; uno schema derivato passa dalla crosswalk);
+    con adjusted gli importi includono le rettifiche registrate.
+    """
+    derived, schema_param = report_schema_params(conn, schema_version_id)
+    if legal_entity_id is None:
+        entity_filter = ""
+        params = (schema_param,)
+    else:
+        entity_filter = " AND tbh.legal_entity_id = ?"
+        params = (schema_param, int(legal_entity_id))
+    sql = BILANCIO_QUERY.format(
+        report_sublead=report_sublead_cte(derived), tb_line=tb_line_cte(adjusted), entity_filter=entity_filter
+    )
+    chunks = [_encode_chunk(chunk) for chunk in pd.read_sql(sql, conn, params=params, chunksize=LOAD_CHUNK_ROWS)]
+    if not chunks:
+        columns = DIMENSION_COLS + ["importo", "fiscal_year"]
+        return _encode_chunk(pd.DataFrame({c: pd.Series(dtype=object) for c in columns}))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.DataFrame({
+        col: (
+            union_categoricals([chunk[col] for chunk in chunks], sort_categories=True)
+            if col in DIMENSION_COLS
+            else np.concatenate([chunk[col].to_numpy() for chunk in chunks])
+        )
+        for col in chunks[0].columns
+    })
+
+
+def tipo_subtotale(tipo):
+    """
+    Tipo di subtotale (tipo vuoto o mancante -> CE) calcolato sulle categorie:
+    il risultato resta categorico, senza una stringa per riga.
+    """
+    tipo = tipo.astype("category")
+    labels = pd.Series(tipo.cat.categories.astype(str)).str.strip().str.upper().replace("", "CE")
+    target = pd.Index(sorted(set(labels) | {"CE"}))
+    mapped_codes = target.get_indexer(labels)
+    codes = tipo.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, mapped_codes[codes], target.get_loc("CE"))
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories=target), index=tipo.index)
+
+
+# Row kinds of the rollup, from the innermost to the outermost break
+ROLLUP_KINDS = ("detail", "lead", "group_lead", "tipo")
+
+# Rows per block when the rollup is streamed to a writer
+ROLLUP_STREAM_ROWS = 5000
+
+
+def rollup_row_kinds(df_display, label_col):
+    """
+    Tipo riga (ROLLUP_KINDS) di ogni riga di build_bilancio_with_break_subtotals,
+    dalle etichette dei subtotali: maschere vettoriali, senza callback per riga.
+    """
+    labels = df_display[label_col]
+    return np.select(
+        [
+            labels.str.startswith("Totale LEAD ", na=False).astype(bool),
+            labels.str.startswith("Totale GROUP_LEAD ", na=False).astype(bool),
+            labels.str.startswith("Totale TIPO ", na=False).astype(bool),
+        ],
+        ["lead", "group_lead", "tipo"],
+        default="detail",
+    )
+
+
+def iter_rollup_rows(df_display, label_col, block_rows=ROLLUP_STREAM_ROWS):
+    """
+    Righe del rollup già calcolato (stesso frame mostrato a video) come coppie
+    (tipo riga, dict), a blocchi: chi scrive in streaming non materializza
+    un dict per ogni riga del frame.
+    """
+    kinds = rollup_row_kinds(df_display, label_col)
+    for start in range(0, len(df_display), block_rows):
+        block = df_display.iloc[start:start + block_rows].to_dict("records")
+        yield from zip(kinds[start:start + block_rows], block)
+
+
+def _run_ends(*code_arrays):
+    # True on the last row of each run of equal keys (arrays already sorted by key)
+    n = len(code_arrays[0])
+    ends = np.zeros(n, dtype=bool)
+    if n:
+        ends[-1] = True
+        for codes in code_arrays:
+            ends[:-1] |= codes[1:] != codes[:-1]
+    return ends
+
+
+def build_bilancio_with_break_subtotals(df_pivot, ordered_cols, latest_col, previous_col, label_col):
+    """
+    Righe del bilancio con subtotali a rottura (lead, group lead, tipo) nell'ordine
+    di stampa, costruite in blocco: i dettagli sono presi per posizione dal pivot
+    e i subtotali accodati, così le colonne categoriche restano tali (nessuna
+    stringa rimaterializzata per riga). Unica fonte per pagina 04 ed export.
+    """
+    sort_cols = [c for c in ["tipo_subtotale", "group_lead", "lead", "account_code", "sublead"] if c in df_pivot.columns]
+    df_sorted = df_pivot.sort_values(sort_cols, kind="stable")
+    tipo_rank = pd.Categorical(df_sorted["tipo_subtotale"], categories=TIPO_ORDER).codes
+    order_by_tipo = np.argsort(tipo_rank, kind="stable")
+    df_sorted = df_sorted.iloc[order_by_tipo]
+    tipo_rank = tipo_rank[order_by_tipo]
+    df_sorted, tipo_rank = df_sorted[tipo_rank >= 0], tipo_rank[tipo_rank >= 0]
+
+    # Within a tipo rows are sorted by group_lead then lead, NaN last: every
+    # (tipo, group, lead) is a contiguous run and its last row closes the block
+    t = tipo_rank.astype(np.int64)
+    g = pd.factorize(df_sorted["group_lead"])[0]
+    l = pd.factorize(df_sorted["lead"])[0]
+    positions = np.arange(len(df_sorted))
+    amounts = df_sorted[[latest_col, previous_col]].fillna(0).to_numpy(dtype="float64")
+
+    def _block_totals(ends):
+        # Sum of each run closed at `ends`
+        end_pos = np.flatnonzero(ends)
+        if not len(end_pos):
+            return end_pos, np.empty((0, 2))
+        start_pos = np.concatenate([[0], end_pos[:-1] + 1])
+        return end_pos, np.add.reduceat(amounts, start_pos, axis=0)
+
+    sub_rows, sub_keys = [], []
+
+    def _add_subtotal(rank, position, kind, group_value, lead_value, label, totals):
+        latest_total, prev_total = float(totals[0]), float(totals[1])
+        row = {c: "" for c in ordered_cols}
+        row.update({
+            "tipo": TIPO_ORDER[rank],
+            "group_lead": group_value,
+            "lead": lead_value,
+            label_col: label,
+            latest_col: latest_total,
+            previous_col: prev_total,
+            "differenza_valore": latest_total - prev_total,
+            "differenza_percentuale": ((latest_total - prev_total) / prev_total * 100) if prev_total != 0 else np.nan,
+        })
+        sub_rows.append(row)
+        sub_keys.append((rank, position, kind))
+
+    group_values = df_sorted["group_lead"].to_numpy()
+    lead_values = df_sorted["lead"].to_numpy()
+    lead_ends, lead_totals = _block_totals(_run_ends(t, g, l))
+    for i, totals in zip(lead_ends, lead_totals):
+        if g[i] >= 0 and l[i] >= 0:
+            _add_subtotal(t[i], i, 1, group_values[i], lead_values[i], f"Totale LEAD {lead_values[i]}", totals)
+    group_ends, group_totals = _block_totals(_run_ends(t, g))
+    for i, totals in zip(group_ends, group_totals):
+        if g[i] >= 0:
+            _add_subtotal(t[i], i, 2, group_values[i], "", f"Totale GROUP_LEAD {group_values[i]}", totals)
+    tipo_ends, tipo_totals = _block_totals(_run_ends(t))
+    tipo_blocks = {t[i]: (i, totals) for i, totals in zip(tipo_ends, tipo_totals)}
+    for rank, tipo_value in enumerate(TIPO_ORDER):
+        position, totals = tipo_blocks.get(rank, (-1, (0.0, 0.0)))
+        _add_subtotal(rank, position, 3, "", "", f"Totale TIPO {tipo_value}", totals)
+
+    detail_mask = (g >= 0) & (l >= 0)
+    df_detail = df_sorted.loc[detail_mask, ordered_cols].reset_index(drop=True)
+    df_sub = pd.DataFrame(sub_rows, columns=ordered_cols)
+    for col in ordered_cols:
+        if isinstance(df_detail[col].dtype, pd.CategoricalDtype):
+            extra = pd.Index(df_sub[col].dropna().unique()).difference(df_detail[col].cat.categories)
+            df_detail[col] = df_detail[col].cat.add_categories(extra)
+            df_sub[col] = pd.Categorical(df_sub[col], categories=df_detail[col].cat.categories)
+
+    detail_keys = np.column_stack([t[detail_mask], positions[detail_mask], np.zeros(detail_mask.sum(), dtype=np.int64)])
+    all_keys = np.vstack([detail_keys, np.array(sub_keys, dtype=np.int64).reshape(-1, 3)])
+    order = np.lexsort((all_keys[:, 2], all_keys[:, 1], all_keys[:, 0]))
+    return pd.concat([df_detail, df_sub], ignore_index=True).iloc[order].reset_index(drop=True)
+
+
+def _pct_change(diff, previous):
+    return (diff / previous * 100).where(previous.notna() & (previous != 0))
+
+
+def _append_check_row(df_totali_tipo, latest_col, previous_col):
+    prev_total = df_totali_tipo[previous_col].fillna(0).sum()
+    latest_total = df_totali_tipo[latest_col].fillna(0).sum()
+    diff_total = df_totali_tipo["differenza_valore"].fillna(0).sum()
+    pct_total = (diff_total / prev_total * 100) if prev_total != 0 else None
+
+    check_row = {c: "" for c in df_totali_tipo.columns}
+    check_row["tipo"] = "check"
+    check_row[latest_col] = latest_total
+    check_row[previous_col] = prev_total
+    check_row["differenza_valore"] = diff_total
+    check_row["differenza_percentuale"] = pct_total
+    return pd.concat([df_totali_tipo, pd.DataFrame([check_row])], ignore_index=True)
+
+
+def _build_subtotals(df_source, group_col, latest_col, previous_col):
+    subtot = (
+        df_source
+        .groupby(group_col, as_index=False, observed=True)[[latest_col, previous_col]]
+        .sum()
+    )
+    # Few rows: plain labels, so the result reindexes and concatenates like any frame
+    subtot[group_col] = subtot[group_col].astype(str)
+    subtot["differenza_valore"] = subtot[latest_col].fillna(0) - subtot[previous_col].fillna(0)
+    subtot["differenza_percentuale"] = _pct_change(subtot["differenza_valore"], subtot[previous_col])
+    return subtot
+
+
+def compute_bilancio_views(df, latest_year, previous_year):
+    """
+    Pivot e viste (con subtotali) della pagina 04 per la coppia di esercizi, a partire
+    dal dataset di load_bilancio_dataset. Ritorna un dict vista -> DataFrame.
+    """
+    df = df[df["fiscal_year"].isin([latest_year, previous_year])]
+    latest_col = f'importo_{latest_year}'
+    previous_col = f'importo_{previous_year}'
+    index_cols = ['tipo', 'group_lead', 'lead', 'sublead', 'descr_sublead', 'account_code', 'account_name']
+
+    # Pivot per confronto anno più recente vs anno precedente
+    with stage("pivot_table"):
+        df_pivot = df.pivot_table(
+            index=index_cols,
+            columns='fiscal_year',
+            values='importo',
+            aggfunc='sum',
+            observed=True
+        ).reset_index()
+    df_pivot.columns.name = None
+    df_pivot = df_pivot.rename(columns={year: f'importo_{int(year)}' for year in [latest_year, previous_year]})
+    for col in [latest_col, previous_col]:
+        if col not in df_pivot.columns:
+            df_pivot[col] = 0
+    df_pivot['differenza_valore'] = df_pivot[latest_col].fillna(0) - df_pivot[previous_col].fillna(0)
+    df_pivot['differenza_percentuale'] = _pct_change(df_pivot['differenza_valore'], df_pivot[previous_col])
+    df_pivot['tipo_subtotale'] = tipo_subtotale(df_pivot['tipo'])
+    ordered_cols = index_cols + [latest_col, previous_col, 'differenza_valore', 'differenza_percentuale']
+    with stage("subtotali_a_rottura_conti"):
+        df_display = build_bilancio_with_break_subtotals(
+            df_pivot=df_pivot,
+            ordered_cols=ordered_cols,
+            latest_col=latest_col,
+            previous_col=previous_col,
+            label_col="account_name"
+        )
+    index_cols_no_account = ['tipo', 'group_lead', 'lead', 'sublead', 'descr_sublead']
+    df_no_account = (
+        df_pivot
+        .groupby(index_cols_no_account, as_index=False, observed=True)[[latest_col, previous_col]]
+        .sum()
+    )
+    df_no_account['differenza_valore'] = df_no_account[latest_col].fillna(0) - df_no_account[previous_col].fillna(0)
+    df_no_account['differenza_percentuale'] = _pct_change(df_no_account['differenza_valore'], df_no_account[previous_col])
+    df_no_account['tipo_subtotale'] = tipo_subtotale(df_no_account['tipo'])
+    ordered_cols_no_account = index_cols_no_account + [latest_col, previous_col, 'differenza_valore', 'differenza_percentuale']
+    with stage("subtotali_a_rottura_sublead"):
+        df_display_no_account = build_bilancio_with_break_subtotals(
+            df_pivot=df_no_account,
+            ordered_cols=ordered_cols_no_account,
+            latest_col=latest_col,
+            previous_col=previous_col,
+            label_col="descr_sublead"
+        )
+    with stage("subtotali_raggruppati"):
+        subtot_lead = _build_subtotals(df_pivot, 'lead', latest_col, previous_col)
+        subtot_group_lead = _build_subtotals(df_pivot, 'group_lead', latest_col, previous_col)
+        subtot_tipo = _build_subtotals(df_pivot, 'tipo_subtotale', latest_col, previous_col)
+        subtot_tipo = subtot_tipo.rename(columns={'tipo_subtotale': 'tipo'})
+        subtot_tipo = subtot_tipo.set_index("tipo").reindex(TIPO_ORDER, fill_value=0).reset_index()
+        subtot_tipo["tipo"] = subtot_tipo["tipo"].map(TIPO_LABELS).fillna(subtot_tipo["tipo"])
+        subtot_tipo = _append_check_row(subtot_tipo, latest_col, previous_col)
+
+    return {
+        "pivot": df_pivot,
+        "pivot_sublead": df_no_account,
+        "lead_dettaglio": df_display,
+        "lead": df_display_no_account,
+        "subtotali_lead": subtot_lead,
+        "gruppo_lead": subtot_group_lead,
+        "totali_tipo": subtot_tipo,
+    }
+
+
+def bilancio_excel_sheets(views):
+    """
+    Fogli dell'export Excel (nome, colonne, righe) per write_bilancio_xlsx: i fogli
+    con subtotali sono letti a blocchi dalle viste della pagina 04, senza copie
+    scalate, così schermo ed Excel non possono divergere.
+    """
+    return [
+        (
+            "Bilancio_Confronto",
+            list(views["lead_dettaglio"].columns),
+            iter_rollup_rows(views["lead_dettaglio"], "account_name"),
+        ),
+        (
+            "Bilancio_Senza_Conto",
+            list(views["lead"].columns),
+            iter_rollup_rows(views["lead"], "descr_sublead"),
+        ),
+        ("Subtotali_Lead", list(views["subtotali_lead"].columns), iter_frame_rows(views["subtotali_lead"])),
+        ("Subtotali_GroupLead", list(views["gruppo_lead"].columns), iter_frame_rows(views["gruppo_lead"])),
+        ("Subtotali_Tipo", list(views["totali_tipo"].columns), iter_frame_rows(views["totali_tipo"])),
+    ]
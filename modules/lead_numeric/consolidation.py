@@ -0,0 +1,379 @@
+from datetime import datetime
+
+import pandas as pd
+
+from modules.lead_numeric.db import bump_data_version
+from modules.lead_numeric.ddl import LATEST_PRIMARY_SCHEMA_SQL
+from modules.lead_numeric.entries import AMOUNT_TOLERANCE, clean_text
+from modules.lead_numeric.mapping import MAPPING_CTE
+from modules.lead_numeric.schemas import report_schema_params, report_sublead_cte
+
+CONSOLIDATION_METHODS = {"integrale": "Integrale", "proporzionale": "Proporzionale"}
+IC_PAIR_COLS = ["entity_a", "account_code_a", "entity_b", "account_code_b", "difference_sublead", "description"]
+ELIMINATION_COLS = ["entry_ref", "sublead", "amount", "description"]
+CONSOLIDATED_AMOUNT_COLS = ["aggregato", "elisioni_intercompany", "elisioni_manuali", "consolidato", "quota_terzi"]
+
+# Perimeter members with their weight: 1 for line-by-line consolidation,
+# the ownership share for proportional consolidation
+_PERIMETER_CTE = """
+perimeter AS (
+    SELECT legal_entity_id, method, ownership_pct / 100.0 AS quota,
+           CASE WHEN method = 'proporzionale' THEN ownership_pct / 100.0 ELSE 1.0 END AS factor
+    FROM consolidation_entity
+    WHERE perimeter_id = :perimeter_id
+)"""
+
+# Balance of each side of the intercompany pairs whose entities are both in the
+# perimeter, weighted and placed on the sublead of the account's valid mapping
+_IC_BALANCE_CTE = """
+ic_side AS (
+    SELECT pr.id AS pair_id, 'a' AS side, pr.entity_a_id AS legal_entity_id,
+           pr.account_code_a AS account_code, pr.difference_sublead
+    FROM consolidation_ic_pair pr
+    WHERE pr.perimeter_id = :perimeter_id
+    UNION ALL
+    SELECT pr.id, 'b', pr.entity_b_id, pr.account_code_b, pr.difference_sublead
+    FROM consolidation_ic_pair pr
+    WHERE pr.perimeter_id = :perimeter_id
+),
+ic_pair_in_perimeter AS (
+    SELECT s.pair_id
+    FROM ic_side s
+    JOIN perimeter p ON p.legal_entity_id = s.legal_entity_id
+    GROUP BY s.pair_id
+    HAVING COUNT(*) = 2
+),
+ic_balance AS (
+    SELECT s.pair_id, s.side, s.difference_sublead, vm.sublead,
+           SUM(tbl.closing_balance) AS saldo,
+           SUM(tbl.closing_balance * p.factor) AS importo
+    FROM ic_side s
+    JOIN ic_pair_in_perimeter ip ON ip.pair_id = s.pair_id
+    JOIN perimeter p ON p.legal_entity_id = s.legal_entity_id
+    JOIN trial_balance_header tbh
+      ON tbh.legal_entity_id = s.legal_entity_id
+     AND tbh.fiscal_year = :fiscal_year
+    JOIN gl_account ga
+      ON ga.account_code = s.account_code
+     AND ga.chart_of_accounts = tbh.chart_of_accounts
+    JOIN trial_balance_line tbl
+      ON tbl.trial_balance_id = tbh.id
+     AND tbl.gl_account_id = ga.id
+    JOIN valid_mapping vm ON vm.gl_account_id = ga.id
+    GROUP BY s.pair_id, s.side, s.difference_sublead, vm.sublead
+)"""
+
+
+def _primary_subleads(conn):
+    return {
+        r[0]
+        for r in conn.execute(
+            f"SELECT sublead FROM lead_structure WHERE schema_version_id = ({LATEST_PRIMARY_SCHEMA_SQL})"
+        )
+    }
+
+
+def _entity_ids(conn):
+    return {code: int(entity_id) for entity_id, code in conn.execute("SELECT id, entity_code FROM legal_entity")}
+
+
+def load_perimeters(conn) -> pd.DataFrame:
+    return pd.read_sql("SELECT id, name, note, created_at FROM consolidation_perimeter ORDER BY name", conn)
+
+
+def create_perimeter(conn, name, note="") -> int:
+    name = str(name).strip()
+    if not name:
+        raise ValueError("Indicare il nome del perimetro.")
+    if conn.execute("SELECT 1 FROM consolidation_perimeter WHERE name = ?", (name,)).fetchone():
+        raise ValueError(f"Perimetro già esistente: {name}")
+    cur = conn.execute(
+        "INSERT INTO consolidation_perimeter (name, note, created_at) VALUES (?, ?, ?)",
+        (name, note, datetime.now().isoformat(timespec="seconds")),
+    )
+    bump_data_version(conn)
+    conn.commit()
+    return int(cur.lastrowid)
+
+
+def load_perimeter_entities(conn, perimeter_id) -> pd.DataFrame:
+    """
+    Tutte le entità con appartenenza al perimetro (incluso), % di possesso e metodo;
+    le entità escluse hanno i default 100% / integrale.
+    """
+    df = pd.read_sql(
+        """
+        SELECT le.id AS legal_entity_id, le.entity_code, le.entity_name,
+               ce.id IS NOT NULL AS incluso,
+               COALESCE(ce.ownership_pct, 100.0) AS ownership_pct,
+               COALESCE(ce.method, 'integrale') AS method
+        FROM legal_entity le
+        LEFT JOIN consolidation_entity ce
+          ON ce.legal_entity_id = le.id
+         AND ce.perimeter_id = ?
+        ORDER BY le.entity_code
+        """,
+        conn,
+        params=(int(perimeter_id),),
+    )
+    df["incluso"] = df["incluso"].astype(bool)
+    return df
+
+
+def save_perimeter_entities(conn, perimeter_id, df_entities) -> int:
+    """
+    Sostituisce le entità del perimetro con le righe di df_entities
+    (legal_entity_id, ownership_pct, method). Ritorna il numero di entità.
+    """
+    df = df_entities[["legal_entity_id", "ownership_pct", "method"]].copy()
+    df["ownership_pct"] = pd.to_numeric(df["ownership_pct"], errors="coerce")
+    invalid_pct = df[df["ownership_pct"].isna() | (df["ownership_pct"] <= 0) | (df["ownership_pct"] > 100)]
+    if not invalid_pct.empty:
+        raise ValueError("La % di possesso deve essere maggiore di 0 e al massimo 100.")
+    invalid_method = sorted(set(df["method"]) - set(CONSOLIDATION_METHODS))
+    if invalid_method:
+        raise ValueError(f"Metodo di consolidamento non valido: {invalid_method}. Ammessi: {list(CONSOLIDATION_METHODS)}")
+    if df["legal_entity_id"].duplicated().any():
+        raise ValueError("Entità ripetute nel perimetro.")
+
+    conn.execute("DELETE FROM consolidation_entity WHERE perimeter_id = ?", (int(perimeter_id),))
+    conn.executemany(
+        "INSERT INTO consolidation_entity (perimeter_id, legal_entity_id, ownership_pct, method) VALUES (?, ?, ?, ?)",
+        [(int(perimeter_id), int(e), float(p), m) for e, p, m in df.itertuples(index=False)],
+    )
+    bump_data_version(conn)
+    conn.commit()
+    return len(df)
+
+
+def load_ic_pairs(conn, perimeter_id) -> pd.DataFrame:
+    return pd.read_sql(
+        """
+        SELECT ea.entity_code AS entity_a, pr.account_code_a,
+               eb.entity_code AS entity_b, pr.account_code_b,
+               pr.difference_sublead, pr.description
+        FROM consolidation_ic_pair pr
+        JOIN legal_entity ea ON ea.id = pr.entity_a_id
+        JOIN legal_entity eb ON eb.id = pr.entity_b_id
+        WHERE pr.perimeter_id = ?
+        ORDER BY pr.id
+        """,
+        conn,
+        params=(int(perimeter_id),),
+    )
+
+
+def save_ic_pairs(conn, perimeter_id, df_pairs) -> int:
+    """
+    Sostituisce le coppie intercompany del perimetro (colonne IC_PAIR_COLS, entità
+    per codice). Un conto di un'entità può stare in una sola coppia, così ogni saldo
+    è eliminato una volta. Ritorna il numero di coppie.
+    """
+    df = df_pairs.reindex(columns=IC_PAIR_COLS).apply(clean_text)
+    df = df[(df != "").any(axis=1)].reset_index(drop=True)
+    required = ["entity_a", "account_code_a", "entity_b", "account_code_b"]
+    if (df[required] == "").any(axis=1).any():
+        raise ValueError("Coppie intercompany incomplete: indicare entità e conto di entrambi i lati.")
+    if (df["entity_a"] == df["entity_b"]).any():
+        raise ValueError("Una coppia intercompany deve collegare due entità diverse.")
+
+    entity_ids = _entity_ids(conn)
+    unknown = sorted(set(df["entity_a"]).union(df["entity_b"]) - set(entity_ids))
+    if unknown:
+        raise ValueError(f"Entità non trovate: {unknown[:30]}")
+    sides = pd.concat(
+        [
+            df[["entity_a", "account_code_a"]].set_axis(["entity", "account_code"], axis=1),
+            df[["entity_b", "account_code_b"]].set_axis(["entity", "account_code"], axis=1),
+        ],
+        ignore_index=True,
+    )
+    repeated = sides[sides.duplicated()].drop_duplicates()
+    if not repeated.empty:
+        labels = [f"{r.entity}/{r.account_code}" for r in repeated.itertuples()]
+        raise ValueError(f"Conti presenti in più coppie intercompany: {labels[:30]}")
+    difference_subleads = set(df["difference_sublead"]) - {""}
+    unknown_subleads = sorted(difference_subleads - _primary_subleads(conn))
+    if unknown_subleads:
+        raise ValueError(f"Sublead differenza non presenti nello schema primario: {unknown_subleads[:30]}")
+
+    conn.execute("DELETE FROM consolidation_ic_pair WHERE perimeter_id = ?", (int(perimeter_id),))
+    conn.executemany(
+        """
+        INSERT INTO consolidation_ic_pair
+        (perimeter_id, entity_a_id, account_code_a, entity_b_id, account_code_b, difference_sublead, description)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (
+                int(perimeter_id), entity_ids[r.entity_a], r.account_code_a, entity_ids[r.entity_b],
+                r.account_code_b, r.difference_sublead or None, r.description or None,
+            )
+            for r in df.itertuples()
+        ],
+    )
+    bump_data_version(conn)
+    conn.commit()
+    return len(df)
+
+
+def load_eliminations(conn, perimeter_id, fiscal_year) -> pd.DataFrame:
+    return pd.read_sql(
+        """
+        SELECT entry_ref, sublead, amount, description
+        FROM consolidation_elimination
+        WHERE perimeter_id = ? AND fiscal_year = ?
+        ORDER BY entry_ref, id
+        """,
+        conn,
+        params=(int(perimeter_id), int(fiscal_year)),
+    )
+
+
+def save_eliminations(conn, perimeter_id, fiscal_year, df_entries) -> int:
+    """
+    Sostituisce le scritture di elisione manuali dell'esercizio (colonne
+    ELIMINATION_COLS, sublead dello schema primario). Ogni scrittura deve quadrare.
+    Ritorna il numero di righe.
+    """
+    df = df_entries.reindex(columns=ELIMINATION_COLS).copy()
+    for col in ("entry_ref", "sublead", "description"):
+        df[col] = clean_text(df[col])
+    df["amount"] = pd.to_numeric(df["amount"], errors="coerce")
+    df = df[(df[["entry_ref", "sublead", "description"]] != "").any(axis=1) | df["amount"].notna()]
+    if ((df["entry_ref"] == "") | (df["sublead"] == "") | df["amount"].isna()).any():
+        raise ValueError("Righe di elisione incomplete: indicare riferimento, sublead e importo.")
+    unknown = sorted(set(df["sublead"]) - _primary_subleads(conn))
+    if unknown:
+        raise ValueError(f"Sublead non presenti nello schema primario: {unknown[:30]}")
+    totals = df.groupby("entry_ref")["amount"].sum()
+    unbalanced = totals[totals.abs() > AMOUNT_TOLERANCE]
+    if not unbalanced.empty:
+        raise ValueError(
+            "Scritture di elisione non quadrate: "
+            + ", ".join(f"{ref} ({amount:,.2f})" for ref, amount in unbalanced.head(30).items())
+        )
+
+    created_at = datetime.now().isoformat(timespec="seconds")
+    conn.execute(
+        "DELETE FROM consolidation_elimination WHERE perimeter_id = ? AND fiscal_year = ?",
+        (int(perimeter_id), int(fiscal_year)),
+    )
+    conn.executemany(
+        """
+        INSERT INTO consolidation_elimination
+        (perimeter_id, fiscal_year, entry_ref, sublead, amount, description, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (int(perimeter_id), int(fiscal_year), r.entry_ref, r.sublead, float(r.amount), r.description or None, created_at)
+            for r in df.itertuples()
+        ],
+    )
+    bump_data_version(conn)
+    conn.commit()
+    return len(df)
+
+
+def consolidated_trial_balance(conn, perimeter_id, fiscal_year, schema_version_id=None) -> pd.DataFrame:
+    """
+    TB consolidato a livello sublead, in un'unica query su insiemi: i saldi sono
+    prima sommati per (entità, sublead), poi pesati col metodo di consolidamento;
+    elisioni intercompany e manuali si aggiungono come righe sublead e tutto è
+    raggruppato sulle sublead dello schema di reporting (None = ultimo primario).
+    """
+    derived, schema_param = report_schema_params(conn, schema_version_id)
+    sql = (
+        MAPPING_CTE.rstrip()
+        + ",\n"
+        + report_sublead_cte(derived, param=":schema_version_id")
+        + ",\n"
+        + _PERIMETER_CTE
+        + ",\n"
+        + """
+entity_sublead AS (
+    SELECT tbh.legal_entity_id, vm.sublead, SUM(tbl.closing_balance) AS importo
+    FROM perimeter p
+    JOIN trial_balance_header tbh
+      ON tbh.legal_entity_id = p.legal_entity_id
+     AND tbh.fiscal_year = :fiscal_year
+    JOIN trial_balance_line tbl ON tbl.trial_balance_id = tbh.id
+    JOIN valid_mapping vm ON vm.gl_account_id = tbl.gl_account_id
+    GROUP BY tbh.legal_entity_id, vm.sublead
+),"""
+        + _IC_BALANCE_CTE
+        + """,
+sublead_amounts AS (
+    SELECT es.sublead,
+           SUM(es.importo * p.factor) AS aggregato,
+           0 AS elisioni_intercompany,
+           0 AS elisioni_manuali,
+           SUM(CASE WHEN p.method = 'integrale' THEN es.importo * (1 - p.quota) ELSE 0 END) AS quota_terzi
+    FROM entity_sublead es
+    JOIN perimeter p ON p.legal_entity_id = es.legal_entity_id
+    GROUP BY es.sublead
+    UNION ALL
+    SELECT sublead, 0, -SUM(importo), 0, 0
+    FROM ic_balance
+    GROUP BY sublead
+    UNION ALL
+    SELECT difference_sublead, 0, SUM(importo), 0, 0
+    FROM ic_balance
+    WHERE difference_sublead IS NOT NULL
+    GROUP BY difference_sublead
+    UNION ALL
+    SELECT sublead, 0, 0, SUM(amount), 0
+    FROM consolidation_elimination
+    WHERE perimeter_id = :perimeter_id
+      AND fiscal_year = :fiscal_year
+    GROUP BY sublead
+)
+SELECT rs.tipo, rs.group_lead, rs.lead, rs.sublead, rs.descrizione_cee AS descr_sublead,
+       SUM(sa.aggregato) AS aggregato,
+       SUM(sa.elisioni_intercompany) AS elisioni_intercompany,
+       SUM(sa.elisioni_manuali) AS elisioni_manuali,
+       SUM(sa.aggregato + sa.elisioni_intercompany + sa.elisioni_manuali) AS consolidato,
+       SUM(sa.quota_terzi) AS quota_terzi
+FROM sublead_amounts sa
+JOIN report_sublead rs ON rs.source_sublead = sa.sublead
+GROUP BY rs.tipo, rs.group_lead, rs.lead, rs.sublead, rs.descrizione_cee
+ORDER BY rs.tipo, rs.group_lead, rs.lead, rs.sublead
+"""
+    )
+    return pd.read_sql(
+        sql,
+        conn,
+        params={"perimeter_id": int(perimeter_id), "fiscal_year": int(fiscal_year), "schema_version_id": schema_param},
+    )
+
+
+def intercompany_reconciliation(conn, perimeter_id, fiscal_year) -> pd.DataFrame:
+    """
+    Quadratura delle coppie intercompany nell'esercizio: saldi dei due lati e
+    differenza (pesata col metodo di consolidamento). Le coppie con un'entità fuori
+    perimetro non sono eliminate e non compaiono.
+    """
+    return pd.read_sql(
+        MAPPING_CTE.rstrip()
+        + ",\n"
+        + _PERIMETER_CTE
+        + ",\n"
+        + _IC_BALANCE_CTE
+        + """
+SELECT ea.entity_code AS entity_a, pr.account_code_a,
+       SUM(CASE WHEN b.side = 'a' THEN b.saldo ELSE 0 END) AS saldo_a,
+       eb.entity_code AS entity_b, pr.account_code_b,
+       SUM(CASE WHEN b.side = 'b' THEN b.saldo ELSE 0 END) AS saldo_b,
+       SUM(b.importo) AS differenza,
+       pr.difference_sublead, pr.description
+FROM ic_pair_in_perimeter ip
+JOIN consolidation_ic_pair pr ON pr.id = ip.pair_id
+JOIN legal_entity ea ON ea.id = pr.entity_a_id
+JOIN legal_entity eb ON eb.id = pr.entity_b_id
+LEFT JOIN ic_balance b ON b.pair_id = pr.id
+GROUP BY pr.id
+ORDER BY ABS(SUM(b.importo)) DESC, pr.id
+""",
+        conn,
+        params={"perimeter_id": int(perimeter_id), "fiscal_year": int(fiscal_year)},
+    )
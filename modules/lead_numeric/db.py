@@ -1,8 +1,52 @@
+import os
 import sqlite3
 from pathlib import Path
 
-DB_PATH = Path("data/audit.db")
+from modules.lead_numeric.profiling import TimedConnection
+
+# AAP_DB_PATH points the app (or the benchmark suite) at another database file
+DB_PATH = Path(os.environ.get("AAP_DB_PATH", "data/audit.db"))
+
+# Tables whose AUTOINCREMENT counter moves on every import / mapping change
+DATA_VERSION_TABLES = (
+    "lead_schema_version",
+    "lead_structure",
+    "gl_account",
+    "account_lead_mapping",
+    "schema_crosswalk",
+    "trial_balance_header",
+    "trial_balance_line",
+    "materiality_benchmark",
+    "materiality_benchmark_rule",
+    "consolidation_entity",
+    "consolidation_ic_pair",
+    "consolidation_elimination",
+    "audit_adjustment",
+    "journal_import",
+    "journal_line",
+)
 
 def get_conn():
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    return sqlite3.connect(DB_PATH)
+    # Timed connection: queries are recorded only while a page run is being profiled
+    return sqlite3.connect(DB_PATH, factory=TimedConnection)
+
+def bump_data_version(conn):
+    """
+    Incrementa il contatore data_version. Chiamata da ogni scrittura prima del
+    commit, nella stessa transazione: anche DELETE e UPDATE invalidano le cache.
+    """
+    conn.execute("UPDATE data_version SET version = version + 1 WHERE id = 1")
+
+def get_data_version(conn) -> str:
+    """
+    Impronta economica dei dati di bilancio (contatore data_version + contatori
+    AUTOINCREMENT), usata come chiave delle cache: cambia a ogni scrittura.
+    """
+    placeholders = ", ".join("?" for _ in DATA_VERSION_TABLES)
+    seq = conn.execute(
+        f"SELECT name, seq FROM sqlite_sequence WHERE name IN ({placeholders}) ORDER BY name",
+        DATA_VERSION_TABLES,
+    ).fetchall()
+    version = conn.execute("SELECT version FROM data_version WHERE id = 1").fetchone()[0]
+    return f"v{version}|" + "|".join(f"{name}:{value}" for name, value in seq)
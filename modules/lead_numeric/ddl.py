@@ -1,4 +1,4 @@
-from modules.lead_numeric.db import get_conn
+from modules.lead_numeric.db import bump_data_version, get_conn
 
 DDL = """
 -- =========================
@@ -10,7 +10,8 @@ CREATE TABLE IF NOT EXISTS lead_schema_version (
     version TEXT NOT NULL,
     import_date TEXT NOT NULL,
     source_file TEXT NOT NULL,
-    note TEXT
+    note TEXT,
+    kind TEXT NOT NULL DEFAULT 'primario'
 );
 
 CREATE TABLE IF NOT EXISTS lead_structure (
@@ -23,6 +24,10 @@ CREATE TABLE IF NOT EXISTS lead_structure (
     tipo TEXT,
     segno_rpt INTEGER,
     schema_version_id INTEGER NOT NULL,
+    tipo_key TEXT,
+    group_lead_key TEXT,
+    lead_key TEXT,
+    sublead_key TEXT,
     FOREIGN KEY (schema_version_id) REFERENCES lead_schema_version(id),
     UNIQUE (schema_version_id, sublead)
 );
@@ -53,6 +58,20 @@ CREATE TABLE IF NOT EXISTS account_lead_mapping (
     UNIQUE (gl_account_id, schema_version_id, is_active)
 );
 
+-- =========================
+-- CROSSWALK: SUBLEAD SCHEMA PRIMARIO -> SCHEMA DERIVATO
+-- =========================
+-- I conti sono mappati solo sullo schema primario; uno schema derivato (IFRS,
+-- gestionale) riceve le sublead primarie per codice, molte a una
+CREATE TABLE IF NOT EXISTS schema_crosswalk (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target_schema_version_id INTEGER NOT NULL,
+    source_sublead TEXT NOT NULL,
+    target_sublead TEXT NOT NULL,
+    FOREIGN KEY (target_schema_version_id) REFERENCES lead_schema_version(id),
+    UNIQUE (target_schema_version_id, source_sublead)
+);
+
 -- =========================
 -- ENTITA' / SOCIETA'
 -- =========================
@@ -91,8 +110,235 @@ CREATE TABLE IF NOT EXISTS trial_balance_line (
     FOREIGN KEY (gl_account_id) REFERENCES gl_account(id),
     UNIQUE (trial_balance_id, gl_account_id)
 );
+
+-- =========================
+-- MATERIALITA: BENCHMARK
+-- =========================
+CREATE TABLE IF NOT EXISTS materiality_benchmark (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    code TEXT NOT NULL UNIQUE,
+    label TEXT NOT NULL,
+    position INTEGER NOT NULL DEFAULT 0,
+    sign INTEGER NOT NULL DEFAULT 1,
+    pct_min INTEGER NOT NULL,
+    pct_max INTEGER NOT NULL,
+    pct_default INTEGER NOT NULL,
+    is_active INTEGER DEFAULT 1
+);
+
+-- Regole di un benchmark: fallback_rank ordina la catena di fallback; a parita
+-- di rank, campi diversi sono in AND e valori dello stesso campo in alternativa
+CREATE TABLE IF NOT EXISTS materiality_benchmark_rule (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    benchmark_id INTEGER NOT NULL,
+    fallback_rank INTEGER NOT NULL DEFAULT 0,
+    field TEXT NOT NULL CHECK (field IN ('tipo', 'lead', 'sublead')),
+    operator TEXT NOT NULL DEFAULT 'include' CHECK (operator IN ('include', 'exclude')),
+    value TEXT NOT NULL,
+    FOREIGN KEY (benchmark_id) REFERENCES materiality_benchmark(id)
+);
+
+-- Decisioni di materialita salvate: una nuova versione a ogni salvataggio per
+-- (entita, esercizio, sezione); legal_entity_id NULL = tutte le entita.
+-- Basi calcolate nello schema schema_version_id (NULL = schema primario, altrimenti
+-- lo schema derivato) e, con adjusted = 1, al netto delle rettifiche
+CREATE TABLE IF NOT EXISTS materiality_decision (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    legal_entity_id INTEGER,
+    fiscal_year INTEGER NOT NULL,
+    section TEXT NOT NULL CHECK (section IN ('preliminare', 'definitiva')),
+    version INTEGER NOT NULL,
+    criteria_json TEXT NOT NULL,
+    bases_json TEXT NOT NULL,
+    materialita_generale INTEGER,
+    pct_materialita_operativa INTEGER,
+    materialita_operativa INTEGER,
+    pct_errori_trascurabili INTEGER,
+    errori_trascurabili INTEGER,
+    note TEXT,
+    data_version TEXT,
+    schema_version_id INTEGER,
+    adjusted INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (legal_entity_id) REFERENCES legal_entity(id),
+    FOREIGN KEY (schema_version_id) REFERENCES lead_schema_version(id),
+    UNIQUE (legal_entity_id, fiscal_year, section, version)
+);
+
+-- =========================
+-- CONSOLIDAMENTO
+-- =========================
+CREATE TABLE IF NOT EXISTS consolidation_perimeter (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    note TEXT,
+    created_at TEXT NOT NULL
+);
+
+-- Entita nel perimetro: integrale = 100% dei saldi (quota terzi evidenziata),
+-- proporzionale = saldi alla percentuale di possesso
+CREATE TABLE IF NOT EXISTS consolidation_entity (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    perimeter_id INTEGER NOT NULL,
+    legal_entity_id INTEGER NOT NULL,
+    ownership_pct REAL NOT NULL CHECK (ownership_pct > 0 AND ownership_pct <= 100),
+    method TEXT NOT NULL DEFAULT 'integrale' CHECK (method IN ('integrale', 'proporzionale')),
+    FOREIGN KEY (perimeter_id) REFERENCES consolidation_perimeter(id),
+    FOREIGN KEY (legal_entity_id) REFERENCES legal_entity(id),
+    UNIQUE (perimeter_id, legal_entity_id)
+);
+
+-- Coppie di conti intercompany (credito/debito, ricavo/costo) eliminate per
+-- intero; la differenza di quadratura va su difference_sublead, se indicata
+CREATE TABLE IF NOT EXISTS consolidation_ic_pair (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    perimeter_id INTEGER NOT NULL,
+    entity_a_id INTEGER NOT NULL,
+    account_code_a TEXT NOT NULL,
+    entity_b_id INTEGER NOT NULL,
+    account_code_b TEXT NOT NULL,
+    difference_sublead TEXT,
+    description TEXT,
+    FOREIGN KEY (perimeter_id) REFERENCES consolidation_perimeter(id),
+    FOREIGN KEY (entity_a_id) REFERENCES legal_entity(id),
+    FOREIGN KEY (entity_b_id) REFERENCES legal_entity(id)
+);
+
+-- Scritture di elisione manuali a livello sublead (schema primario): ogni
+-- scrittura (entry_ref) quadra a zero
+CREATE TABLE IF NOT EXISTS consolidation_elimination (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    perimeter_id INTEGER NOT NULL,
+    fiscal_year INTEGER NOT NULL,
+    entry_ref TEXT NOT NULL,
+    sublead TEXT NOT NULL,
+    amount REAL NOT NULL,
+    description TEXT,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (perimeter_id) REFERENCES consolidation_perimeter(id)
+);
+
+-- =========================
+-- RETTIFICHE DI REVISIONE (ISA 450)
+-- =========================
+-- Scritture proposte sul TB importato, che resta invariato: i report rettificati
+-- sommano le righe 'registrata' ai saldi; 'proposta' e 'non_registrata' formano
+-- il riepilogo delle differenze non rettificate. Ogni entry_ref quadra a zero.
+CREATE TABLE IF NOT EXISTS audit_adjustment (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    trial_balance_id INTEGER NOT NULL,
+    gl_account_id INTEGER NOT NULL,
+    entry_ref TEXT NOT NULL,
+    amount REAL NOT NULL,
+    adj_type TEXT NOT NULL DEFAULT 'fattuale' CHECK (adj_type IN ('fattuale', 'giudizio', 'proiettato')),
+    status TEXT NOT NULL DEFAULT 'proposta' CHECK (status IN ('proposta', 'registrata', 'non_registrata')),
+    description TEXT,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (trial_balance_id) REFERENCES trial_balance_header(id),
+    FOREIGN KEY (gl_account_id) REFERENCES gl_account(id)
+);
+
+-- =========================
+-- LIBRO GIORNALE
+-- =========================
+-- Un import per entità, esercizio e piano dei conti (sostituito a ogni re-import).
+-- journal_line è compatta: data come intero AAAAMMGG, ora in secondi dalla
+-- mezzanotte (NULL se assente), importo con segno (dare positivo).
+CREATE TABLE IF NOT EXISTS journal_import (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    legal_entity_id INTEGER NOT NULL,
+    fiscal_year INTEGER NOT NULL,
+    chart_of_accounts TEXT NOT NULL,
+    source_file TEXT,
+    line_count INTEGER NOT NULL DEFAULT 0,
+    imported_at TEXT NOT NULL,
+    UNIQUE (legal_entity_id, fiscal_year, chart_of_accounts),
+    FOREIGN KEY (legal_entity_id) REFERENCES legal_entity(id)
+);
+
+CREATE TABLE IF NOT EXISTS journal_line (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    journal_import_id INTEGER NOT NULL,
+    entry_no TEXT NOT NULL,
+    posting_date INTEGER NOT NULL,
+    posting_time INTEGER,
+    gl_account_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    user_code TEXT,
+    description TEXT,
+    FOREIGN KEY (journal_import_id) REFERENCES journal_import(id),
+    FOREIGN KEY (gl_account_id) REFERENCES gl_account(id)
+);
+
+-- =========================
+-- VERSIONE DEI DATI
+-- =========================
+-- Contatore a riga singola, incrementato da ogni scrittura nella sua stessa
+-- transazione (bump_data_version): chiave delle cache delle pagine.
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0);
 """
 
+# Indexes for the node-scoped report queries (drill-down explorer). Created after
+# the lead_structure migration, which rebuilds that table and drops its indexes.
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_lead_structure_node
+    ON lead_structure (schema_version_id, group_lead, lead, sublead);
+CREATE INDEX IF NOT EXISTS idx_mapping_sublead_active
+    ON account_lead_mapping (sublead, is_active);
+CREATE INDEX IF NOT EXISTS idx_mapping_account_latest
+    ON account_lead_mapping (gl_account_id, is_active, schema_version_id, id);
+CREATE INDEX IF NOT EXISTS idx_tb_line_account
+    ON trial_balance_line (gl_account_id, trial_balance_id);
+CREATE INDEX IF NOT EXISTS idx_tb_header_year
+    ON trial_balance_header (fiscal_year);
+CREATE INDEX IF NOT EXISTS idx_lead_structure_tipo_key
+    ON lead_structure (schema_version_id, tipo_key);
+CREATE INDEX IF NOT EXISTS idx_lead_structure_group_lead_key
+    ON lead_structure (schema_version_id, group_lead_key);
+CREATE INDEX IF NOT EXISTS idx_lead_structure_lead_key
+    ON lead_structure (schema_version_id, lead_key);
+CREATE INDEX IF NOT EXISTS idx_lead_structure_sublead_key
+    ON lead_structure (schema_version_id, sublead_key);
+CREATE INDEX IF NOT EXISTS idx_schema_crosswalk_target
+    ON schema_crosswalk (target_schema_version_id, target_sublead);
+CREATE INDEX IF NOT EXISTS idx_consolidation_ic_pair_perimeter
+    ON consolidation_ic_pair (perimeter_id);
+CREATE INDEX IF NOT EXISTS idx_consolidation_elimination_year
+    ON consolidation_elimination (perimeter_id, fiscal_year);
+CREATE INDEX IF NOT EXISTS idx_audit_adjustment_tb
+    ON audit_adjustment (trial_balance_id, status);
+CREATE INDEX IF NOT EXISTS idx_audit_adjustment_account
+    ON audit_adjustment (gl_account_id, status);
+CREATE INDEX IF NOT EXISTS idx_journal_line_account
+    ON journal_line (journal_import_id, gl_account_id, amount);
+CREATE INDEX IF NOT EXISTS idx_journal_line_entry
+    ON journal_line (journal_import_id, entry_no);
+-- NULLs are distinct in UNIQUE: the aggregate (NULL entity) needs the expression index
+CREATE UNIQUE INDEX IF NOT EXISTS idx_materiality_decision_version
+    ON materiality_decision (COALESCE(legal_entity_id, 0), fiscal_year, section, version);
+"""
+
+# Normalized hierarchy keys (trimmed, upper case, NULL -> ''): stored so that
+# filters compare plain indexed columns instead of UPPER(TRIM(...)) per row
+LEAD_KEY_COLUMNS = {
+    "tipo_key": "tipo",
+    "group_lead_key": "group_lead",
+    "lead_key": "lead",
+    "sublead_key": "sublead",
+}
+
+# Latest primary schema version: the one accounts are mapped to (derived
+# schemas are reached through schema_crosswalk)
+LATEST_PRIMARY_SCHEMA_SQL = "SELECT MAX(id) FROM lead_schema_version WHERE kind = 'primario'"
+
+def latest_primary_schema_id(conn):
+    value = conn.execute(LATEST_PRIMARY_SCHEMA_SQL).fetchone()[0]
+    return None if value is None else int(value)
+
 def _migrate_lead_structure_unique_constraint(conn):
     cur = conn.cursor()
     cur.execute("PRAGMA table_info(lead_structure)")
@@ -148,9 +394,85 @@ def _migrate_lead_structure_unique_constraint(conn):
         """
     )
 
+def backfill_lead_structure_keys(conn):
+    """
+    Calcola le chiavi normalizzate delle righe che ne sono prive (righe legacy o
+    appena importate). Stessa espressione SQL per migrazione e import.
+    """
+    assignments = ", ".join(
+        f"{key_col} = UPPER(TRIM(COALESCE({source_col}, '')))" for key_col, source_col in LEAD_KEY_COLUMNS.items()
+    )
+    missing = " OR ".join(f"{key_col} IS NULL" for key_col in LEAD_KEY_COLUMNS)
+    if conn.execute(f"UPDATE lead_structure SET {assignments} WHERE {missing}").rowcount:
+        bump_data_version(conn)
+
+def _migrate_lead_structure_keys(conn):
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(lead_structure)")
+    cols = {row[1] for row in cur.fetchall()}
+    for key_col in LEAD_KEY_COLUMNS:
+        if key_col not in cols:
+            cur.execute(f"ALTER TABLE lead_structure ADD COLUMN {key_col} TEXT")
+    backfill_lead_structure_keys(conn)
+
+def _migrate_schema_kind(conn):
+    # Before derived schemas every version was primary: the default covers them
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(lead_schema_version)")
+    cols = {row[1] for row in cur.fetchall()}
+    if "kind" not in cols:
+        cur.execute("ALTER TABLE lead_schema_version ADD COLUMN kind TEXT NOT NULL DEFAULT 'primario'")
+
+def _migrate_materiality_decision_settings(conn):
+    # Decisions saved before the schema/adjusted selectors used the primary
+    # schema and unadjusted amounts: the NULL / 0 defaults describe them
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(materiality_decision)")
+    cols = {row[1] for row in cur.fetchall()}
+    if "schema_version_id" not in cols:
+        cur.execute(
+            "ALTER TABLE materiality_decision ADD COLUMN schema_version_id INTEGER REFERENCES lead_schema_version(id)"
+        )
+    if "adjusted" not in cols:
+        cur.execute("ALTER TABLE materiality_decision ADD COLUMN adjusted INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_materiality_decision_versions(conn):
+    # Aggregate decisions saved before the unique index may share a version:
+    # renumber them in save order so the index can be created
+    conn.execute(
+        """
+        UPDATE materiality_decision
+        SET version = (
+            SELECT COUNT(*) FROM materiality_decision d
+            WHERE d.legal_entity_id IS NULL
+              AND d.fiscal_year = materiality_decision.fiscal_year
+              AND d.section = materiality_decision.section
+              AND d.id <= materiality_decision.id
+        )
+        WHERE legal_entity_id IS NULL
+          AND EXISTS (
+            SELECT 1 FROM materiality_decision d
+            WHERE d.legal_entity_id IS NULL
+              AND d.fiscal_year = materiality_decision.fiscal_year
+              AND d.section = materiality_decision.section
+            GROUP BY d.version
+            HAVING COUNT(*) > 1
+          )
+        """
+    )
+
 def init_db():
     conn = get_conn()
     conn.executescript(DDL)
     _migrate_lead_structure_unique_constraint(conn)
+    _migrate_lead_structure_keys(conn)
+    _migrate_schema_kind(conn)
+    _migrate_materiality_decision_settings(conn)
+    _migrate_materiality_decision_versions(conn)
+    conn.executescript(INDEXES)
+    # Imported here: materiality -> mapping -> ddl would otherwise be circular
+    from modules.lead_numeric.materiality import ensure_default_benchmarks
+
+    ensure_default_benchmarks(conn)
     conn.commit()
     conn.close()
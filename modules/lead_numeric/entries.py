@@ -0,0 +1,12 @@
+# Shared by the three kinds of entries: audit adjustments, manual consolidation
+# eliminations and journal entries
+
+# Residual allowed on a balanced entry (rounding of the amounts typed in or imported)
+AMOUNT_TOLERANCE = 0.01
+
+
+def clean_text(series):
+    """
+    Colonna di testo da file o editor: vuoti al posto dei mancanti, spazi rimossi.
+    """
+    return series.fillna("").astype(str).str.strip()
@@ -0,0 +1,113 @@
+import pandas as pd
+
+from modules.lead_numeric.adjustments import tb_line_cte
+from modules.lead_numeric.schemas import report_schema_params, report_sublead_cte
+
+# Drill-down levels: each one groups the rows of its parent node one step deeper
+EXPLORER_LEVELS = ("group_lead", "lead", "sublead", "account")
+
+# Node path columns, in drill-down order; a node is a prefix of these values
+NODE_COLS = ("tipo_key", "group_lead", "lead", "sublead")
+
+# Length of the node that identifies the parent of each level
+NODE_DEPTH = {"group_lead": 0, "lead": 2, "sublead": 3, "account": 4}
+
+_LEVEL_COLUMNS = {
+    "group_lead": ["na.tipo_key", "na.group_lead"],
+    "lead": ["na.tipo_key", "na.group_lead", "na.lead"],
+    "sublead": ["na.tipo_key", "na.group_lead", "na.lead", "na.sublead", "na.descr_sublead"],
+    "account": ["na.sublead", "ga.account_code", "ga.account_name"],
+}
+
+# Stesso tipo di subtotale della pagina 04: tipo vuoto -> CE
+_TIPO_KEY_SQL = "CASE WHEN ls.tipo_key = '' THEN 'CE' ELSE ls.tipo_key END"
+
+
+def _node_query(level, node, derived=False, adjusted=False):
+    """
+    Query di un livello per un nodo. Parte dalle sublead del nodo nello schema di
+    reporting e risale ai conti con il mapping attivo più recente (NOT EXISTS su
+    indice), così il costo dipende dalla dimensione del nodo e non dall'intero TB.
+    """
+    if level not in EXPLORER_LEVELS:
+        raise ValueError(f"Livello esploratore non valido: {level}")
+    depth = NODE_DEPTH[level]
+    if len(node) != depth:
+        raise ValueError(f"Il livello {level} richiede un nodo di {depth} elementi, ricevuti {len(node)}")
+
+    # IS instead of = so that a NULL group_lead/lead is still a reachable node
+    node_filter = "".join(f" AND ns.{col} IS ?" for col in NODE_COLS[:len(node)])
+    group_cols = _LEVEL_COLUMNS[level]
+    select_cols = ", ".join(f"{col} AS {col.split('.')[1]}" for col in group_cols)
+    account_join = "JOIN gl_account ga ON ga.id = na.gl_account_id" if level == "account" else ""
+    return f"""
+        WITH {report_sublead_cte(derived)},
+        {tb_line_cte(adjusted)},
+        schema_sublead AS (
+            SELECT {_TIPO_KEY_SQL} AS tipo_key,
+                   ls.group_lead, ls.lead, ls.sublead, ls.descrizione_cee AS descr_sublead, ls.source_sublead
+            FROM report_sublead ls
+        ),
+        node_sublead AS (
+            SELECT ns.*
+            FROM schema_sublead ns
+            WHERE 1 = 1{node_filter}
+        ),
+        node_account AS (
+            SELECT ns.*, m.gl_account_id
+            FROM node_sublead ns
+            JOIN account_lead_mapping m
+              ON m.sublead = ns.source_sublead
+             AND m.is_active = 1
+            WHERE NOT EXISTS (
+                  SELECT 1
+                  FROM account_lead_mapping newer
+                  WHERE newer.gl_account_id = m.gl_account_id
+                    AND newer.is_active = 1
+                    AND (newer.schema_version_id > m.schema_version_id
+                         OR (newer.schema_version_id = m.schema_version_id AND newer.id > m.id))
+              )
+        )
+        SELECT {select_cols},
+               SUM(CASE WHEN tbh.fiscal_year = ? THEN tbl.closing_balance END) AS importo_latest,
+               SUM(CASE WHEN tbh.fiscal_year = ? THEN tbl.closing_balance END) AS importo_previous
+        FROM node_account na
+        JOIN tb_line tbl ON tbl.gl_account_id = na.gl_account_id
+        JOIN trial_balance_header tbh
+          ON tbh.id = tbl.trial_balance_id
+         AND tbh.fiscal_year IN (?, ?)
+        {account_join}
+        GROUP BY {", ".join(group_cols)}
+        ORDER BY {", ".join(group_cols)}
+    """
+
+
+def load_explorer_level(conn, level, node, latest_year, previous_year, schema_version_id=None, adjusted=False):
+    """
+    Righe del livello `level` sotto il nodo `node` (tupla prefisso di NODE_COLS),
+    con importi dei due esercizi e differenze, nello schema di reporting indicato
+    (None = ultimo primario). Con adjusted include le rettifiche registrate.
+    """
+    node = tuple(node)
+    derived, schema_param = report_schema_params(conn, schema_version_id)
+    latest_col = f"importo_{latest_year}"
+    previous_col = f"importo_{previous_year}"
+    df = pd.read_sql(
+        _node_query(level, node, derived, adjusted),
+        conn,
+        params=(schema_param, *node, latest_year, previous_year, latest_year, previous_year),
+    ).rename(columns={"importo_latest": latest_col, "importo_previous": previous_col})
+    df["differenza_valore"] = df[latest_col].fillna(0) - df[previous_col].fillna(0)
+    previous = df[previous_col]
+    df["differenza_percentuale"] = (df["differenza_valore"] / previous * 100).where(previous.notna() & (previous != 0))
+    return df
+
+
+def child_node(level_row, child_level):
+    """
+    Nodo (tupla) da passare al livello figlio per una riga del livello corrente.
+    """
+    return tuple(
+        None if pd.isna(level_row[col]) else level_row[col]
+        for col in NODE_COLS[:NODE_DEPTH[child_level]]
+    )
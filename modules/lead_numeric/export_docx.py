@@ -0,0 +1,191 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from modules.lead_numeric.formatting import format_number, format_percent
+
+DOCX_COLS = ["lead", "sublead", "descr_sublead", "account_code", "account_name"]
+
+# Columns from index 2 on (amounts, %) are right aligned, as in the python-docx version
+RIGHT_ALIGNED_FROM = 2
+
+_INVALID_XML_CHARS = r"[\x00-\x08\x0b\x0c\x0e-\x1f]"
+
+
+def _xml_text(series):
+    # Same escaping python-docx applies on cell.text, done on the whole column
+    return (
+        series.astype("string").fillna("")
+        .str.replace(_INVALID_XML_CHARS, "", regex=True)
+        .str.replace(r"[\t\n\r]", " ", regex=True)
+        .str.replace("&", "&amp;", regex=False)
+        .str.replace("<", "&lt;", regex=False)
+        .str.replace(">", "&gt;", regex=False)
+        .to_numpy(dtype=str)
+    )
+
+
+def _cell_template(width, right, bold):
+    p_pr = '<w:pPr><w:jc w:val="right"/></w:pPr>' if right else ""
+    r_pr = "<w:rPr><w:b/></w:rPr>" if bold else ""
+    head = f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr><w:p>{p_pr}'
+    return head, f'<w:r>{r_pr}<w:t xml:space="preserve">', "</w:t></w:r></w:p></w:tc>", "</w:p></w:tc>"
+
+
+def _cells_xml(texts, width, right, bold):
+    """
+    XML delle celle di una colonna: il template della riga è riempito in blocco;
+    le celle vuote non hanno run, come con cell.text = "".
+    """
+    head, run_open, run_close, empty_close = _cell_template(width, right, bold)
+    filled = np.char.add(np.char.add(head + run_open, texts), run_close)
+    return np.where(texts == "", head + empty_close, filled)
+
+
+def _rows_xml(column_texts, width, bold=False):
+    rows = np.full(len(column_texts[0]), "<w:tr>", dtype=object)
+    for col_idx, texts in enumerate(column_texts):
+        rows = rows + _cells_xml(texts, width, col_idx >= RIGHT_ALIGNED_FROM, bold).astype(object)
+    return rows + "</w:tr>"
+
+
+def _table_xml(rows_xml, n_cols, width):
+    from docx.oxml.ns import nsdecls
+
+    grid = "".join(f'<w:gridCol w:w="{width}"/>' for _ in range(n_cols))
+    return (
+        f"<w:tbl {nsdecls('w')}>"
+        '<w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/>'
+        '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" '
+        'w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+        f"<w:tblGrid>{grid}</w:tblGrid>"
+        f"{rows_xml}</w:tbl>"
+    )
+
+
+def _pct_change(latest, previous):
+    latest = np.asarray(latest, dtype="float64")
+    previous = np.asarray(previous, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(previous != 0, (latest - previous) / previous * 100, np.nan)
+
+
+def build_docx_by_lead(df_source, latest_col, previous_col, latest_year, previous_year, amount_scale=1, amount_decimals=2):
+    """
+    Word lead per lead con tabelle per sublead, scritte come XML in blocco nel
+    document part (nessun add_row/cell.text per cella). Stesso layout della
+    versione python-docx. Ritorna None se python-docx non è installato o mancano colonne.
+    """
+    try:
+        from docx import Document
+        from docx.oxml import parse_xml
+        from docx.shared import Pt
+    except ImportError:
+        return None
+
+    word_cols = DOCX_COLS + [latest_col, previous_col, "differenza_valore", "differenza_percentuale"]
+    if any(c not in df_source.columns for c in word_cols):
+        return None
+
+    df_word = (
+        df_source[word_cols]
+        .dropna(subset=["lead", "sublead"])
+        .sort_values(["lead", "sublead", "account_code"], kind="stable")
+        .reset_index(drop=True)
+    )
+
+    headers = [
+        "Account Code",
+        "Account Name",
+        f"Importo {latest_year}",
+        f"Importo {previous_year}",
+        "Diff valore",
+        "Diff %",
+    ]
+
+    doc = Document()
+    section = doc.sections[-1]
+    cell_width = int((section.page_width - section.left_margin - section.right_margin) / len(headers) / 635)
+    header_xml = _rows_xml([np.array([_xml_text(pd.Series([h]))[0]]) for h in headers], cell_width, bold=True)[0]
+
+    # Detail rows: every column formatted and turned into cell XML in one pass
+    detail_xml = _rows_xml(
+        [
+            _xml_text(df_word["account_code"]),
+            _xml_text(df_word["account_name"]),
+            format_number(df_word[latest_col], amount_scale, amount_decimals),
+            format_number(df_word[previous_col], amount_scale, amount_decimals),
+            format_number(df_word["differenza_valore"], amount_scale, amount_decimals),
+            format_percent(df_word["differenza_percentuale"]),
+        ],
+        cell_width,
+    )
+
+    # Sublead totals (bold row closing each table)
+    sublead_totals = (
+        df_word.groupby(["lead", "sublead"], sort=False, observed=True)[[latest_col, previous_col]]
+        .sum(min_count=0)
+        .reset_index()
+    )
+    sub_latest = sublead_totals[latest_col].to_numpy(dtype="float64")
+    sub_previous = sublead_totals[previous_col].to_numpy(dtype="float64")
+    total_xml = _rows_xml(
+        [
+            np.full(len(sublead_totals), ""),
+            np.full(len(sublead_totals), "Totale Sublead"),
+            format_number(sub_latest, amount_scale, amount_decimals),
+            format_number(sub_previous, amount_scale, amount_decimals),
+            format_number(sub_latest - sub_previous, amount_scale, amount_decimals),
+            format_percent(_pct_change(sub_latest, sub_previous)),
+        ],
+        cell_width,
+        bold=True,
+    )
+
+    group_ids = df_word.groupby(["lead", "sublead"], sort=False, observed=True).ngroup().to_numpy()
+    bounds = np.flatnonzero(np.diff(group_ids)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(df_word)]])
+    body = doc.element.body
+
+    sub_idx = 0
+    for lead_idx, (lead_value, df_lead) in enumerate(df_word.groupby("lead", sort=False, observed=True)):
+        if lead_idx > 0:
+            doc.add_page_break()
+
+        doc.add_heading(f"Lead: {lead_value}", level=2)
+        p_confronto = doc.add_paragraph(f"Confronto periodi: {latest_year} vs {previous_year}")
+        p_confronto.runs[0].font.size = Pt(10)
+
+        n_subleads = df_lead["sublead"].nunique(dropna=False)
+        for _ in range(n_subleads):
+            start, end = starts[sub_idx], ends[sub_idx]
+            sublead_value = df_word.at[start, "sublead"]
+            descr_value = str(df_word.at[start, "descr_sublead"] or "")
+            doc.add_heading(f"Sublead: {sublead_value} - {descr_value}", level=3)
+
+            rows_xml = header_xml + "".join(detail_xml[start:end]) + total_xml[sub_idx]
+            body._insert_tbl(parse_xml(_table_xml(rows_xml, len(headers), cell_width)))
+            doc.add_paragraph("")
+            sub_idx += 1
+
+        latest_lead_total = df_lead[latest_col].fillna(0).sum()
+        prev_lead_total = df_lead[previous_col].fillna(0).sum()
+        diff_lead_total = latest_lead_total - prev_lead_total
+        lead_amounts = format_number([latest_lead_total, prev_lead_total, diff_lead_total], amount_scale, amount_decimals)
+        lead_pct = format_percent(_pct_change([latest_lead_total], [prev_lead_total]))[0]
+
+        p_total_lead = doc.add_paragraph(
+            "Totale Lead | "
+            f"Importo {latest_year}: {lead_amounts[0]} | "
+            f"Importo {previous_year}: {lead_amounts[1]} | "
+            f"Diff valore: {lead_amounts[2]} | "
+            f"Diff %: {lead_pct}"
+        )
+        for run in p_total_lead.runs:
+            run.bold = True
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
@@ -0,0 +1,140 @@
+import io
+
+import pandas as pd
+
+from modules.lead_numeric.formatting import format_int
+
+
+def materiality_export_frames(df_criteria, results, section_label, fiscal_year, note):
+    """
+    Tabelle dell'export materialità: criteri (Selezione come Si/No) e riepilogo
+    con sezione, esercizio, importi calcolati (results di materiality_results) e nota.
+    """
+    df_export = df_criteria.copy()
+    df_export["Selezione"] = df_export["Selezione"].map(lambda x: "Si" if bool(x) else "No")
+    for col in ["Valore base", "Importo calcolato"]:
+        df_export[col] = df_export[col].astype(int)
+
+    results = results or {}
+
+    def _amount(key):
+        return format_int(abs(results[key])) if results.get(key) is not None else ""
+
+    def _pct(key):
+        return f"{results[key]}%" if results.get(key) is not None else ""
+
+    df_summary = pd.DataFrame(
+        [
+            {"Voce": "Sezione", "Valore": section_label},
+            {"Voce": "Esercizio selezionato", "Valore": int(fiscal_year)},
+            {"Voce": "Materialita generale", "Valore": _amount("materialita_generale")},
+            {"Voce": "% Materialita operativa", "Valore": _pct("pct_materialita_operativa")},
+            {"Voce": "Materialita operativa", "Valore": _amount("materialita_operativa")},
+            {"Voce": "% Errori trascurabili", "Valore": _pct("pct_errori_trascurabili")},
+            {"Voce": "Errori trascurabili", "Valore": _amount("errori_trascurabili")},
+            {"Voce": "Nota", "Valore": note},
+        ]
+    )
+    return df_export, df_summary
+
+
+def _criteria_text(df_export):
+    # Word/PDF: importi come testo formattato; l'Excel resta numerico
+    df_text = df_export.astype(str)
+    for col in ["Valore base", "Importo calcolato"]:
+        if col in df_text.columns:
+            df_text[col] = format_int(df_export[col])
+    return df_text
+
+
+def build_materiality_xlsx(df_export, df_summary):
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        df_export.to_excel(writer, index=False, sheet_name="Criteri")
+        df_summary.to_excel(writer, index=False, sheet_name="Riepilogo")
+    return output.getvalue()
+
+
+def build_materiality_docx(df_export, df_summary):
+    try:
+        from docx import Document
+    except ImportError:
+        return None
+
+    doc = Document()
+    doc.add_heading("Determinazione Materialita", level=1)
+
+    doc.add_heading("Riepilogo", level=2)
+    for _, row in df_summary.iterrows():
+        doc.add_paragraph(f"{row['Voce']}: {row['Valore']}")
+
+    doc.add_heading("Criteri", level=2)
+    table = doc.add_table(rows=1, cols=len(df_export.columns))
+    table.style = "Table Grid"
+    for i, c in enumerate(df_export.columns):
+        table.rows[0].cells[i].text = str(c)
+    for values in _criteria_text(df_export).itertuples(index=False):
+        cells = table.add_row().cells
+        for i, value in enumerate(values):
+            cells[i].text = value
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def build_materiality_pdf(df_export, df_summary):
+    try:
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+        from reportlab.lib.styles import getSampleStyleSheet
+    except ImportError:
+        return None
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=landscape(A4))
+    styles = getSampleStyleSheet()
+    elements = [Paragraph("Determinazione Materialita", styles["Heading2"]), Spacer(1, 8)]
+
+    elements.append(Paragraph("Riepilogo", styles["Heading3"]))
+    summary_data = [["Voce", "Valore"]]
+    for _, row in df_summary.iterrows():
+        voce_text = Paragraph(str(row["Voce"]), styles["BodyText"])
+        valore_text = Paragraph(str(row["Valore"]), styles["BodyText"])
+        summary_data.append([voce_text, valore_text])
+    summary_table = Table(summary_data, colWidths=[220, 420])
+    summary_table.setStyle(TableStyle([
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ("LEFTPADDING", (0, 0), (-1, -1), 4),
+        ("RIGHTPADDING", (0, 0), (-1, -1), 4),
+        ("TOPPADDING", (0, 0), (-1, -1), 3),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
+    ]))
+    elements.append(summary_table)
+    elements.append(Spacer(1, 10))
+
+    elements.append(Paragraph("Criteri", styles["Heading3"]))
+    criteria_data = [df_export.columns.tolist()] + _criteria_text(df_export).values.tolist()
+    criteria_table = Table(criteria_data, repeatRows=1)
+    criteria_table.setStyle(TableStyle([
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ]))
+    elements.append(criteria_table)
+
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+# Export format -> builder(df_export, df_summary); Word/PDF return None without their package
+MATERIALITY_EXPORT_BUILDERS = {
+    "xlsx": build_materiality_xlsx,
+    "docx": build_materiality_docx,
+    "pdf": build_materiality_pdf,
+}
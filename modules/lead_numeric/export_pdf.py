@@ -0,0 +1,264 @@
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from modules.lead_numeric.formatting import format_number, format_percent
+
+# Below this many detail rows the process pool start-up costs more than it saves
+PARALLEL_MIN_ROWS = 3000
+
+PDF_COLS = ["lead", "sublead", "descr_sublead", "account_code", "account_name"]
+
+
+def _new_doc(buffer):
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.platypus import SimpleDocTemplate
+
+    return SimpleDocTemplate(
+        buffer,
+        pagesize=landscape(A4),
+        leftMargin=18,
+        rightMargin=18,
+        topMargin=18,
+        bottomMargin=18,
+    )
+
+
+def _lead_elements(lead_value, df_lead, latest_col, previous_col, latest_year, previous_year, amount_scale, amount_decimals):
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import Paragraph, Spacer, Table, TableStyle
+
+    styles = getSampleStyleSheet()
+    headers = [
+        "Account Code",
+        "Account Name",
+        f"Importo {latest_year}",
+        f"Importo {previous_year}",
+        "Diff valore",
+        "Diff %",
+    ]
+    elements = [
+        Paragraph(f"Lead: {lead_value}", styles["Heading3"]),
+        Paragraph(f"Confronto periodi: {latest_year} vs {previous_year}", styles["Normal"]),
+        Spacer(1, 6),
+    ]
+
+    for sublead_value, df_sublead in df_lead.groupby("sublead", sort=False, observed=True):
+        descr_value = str(df_sublead["descr_sublead"].iloc[0] or "")
+        elements.append(Paragraph(f"Sublead: {sublead_value} - {descr_value}", styles["Heading4"]))
+        elements.append(Spacer(1, 4))
+
+        rows = [headers]
+        rows.extend(
+            [list(values) for values in zip(
+                df_sublead["account_code"].astype("string").fillna(""),
+                df_sublead["account_name"].astype("string").fillna(""),
+                format_number(df_sublead[latest_col], amount_scale, amount_decimals),
+                format_number(df_sublead[previous_col], amount_scale, amount_decimals),
+                format_number(df_sublead["differenza_valore"], amount_scale, amount_decimals),
+                format_percent(df_sublead["differenza_percentuale"]),
+            )]
+        )
+
+        prev_sublead_total = df_sublead[previous_col].fillna(0).sum()
+        latest_sublead_total = df_sublead[latest_col].fillna(0).sum()
+        diff_sublead_total = latest_sublead_total - prev_sublead_total
+        pct_sublead_total = (diff_sublead_total / prev_sublead_total * 100) if prev_sublead_total != 0 else None
+        rows.append([
+            "",
+            "Totale Sublead",
+            format_number(latest_sublead_total, amount_scale, amount_decimals),
+            format_number(prev_sublead_total, amount_scale, amount_decimals),
+            format_number(diff_sublead_total, amount_scale, amount_decimals),
+            format_percent(pct_sublead_total),
+        ])
+
+        table = Table(rows, repeatRows=1, colWidths=[80, 260, 95, 95, 95, 65])
+        table.setStyle(TableStyle([
+            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+            ("FONTNAME", (0, 1), (-1, -2), "Helvetica"),
+            ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
+            ("FONTSIZE", (0, 0), (-1, -1), 8),
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EDEDED")),
+            ("BACKGROUND", (0, -1), (-1, -1), colors.HexColor("#F5F5F5")),
+            ("TEXTCOLOR", (0, 0), (-1, 0), colors.black),
+            ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#BDBDBD")),
+            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+            ("ALIGN", (2, 1), (5, -1), "RIGHT"),
+            ("LEFTPADDING", (0, 0), (-1, -1), 4),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 4),
+            ("TOPPADDING", (0, 0), (-1, -1), 2),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 2),
+        ]))
+        elements.append(table)
+        elements.append(Spacer(1, 8))
+
+    prev_lead_total = df_lead[previous_col].fillna(0).sum()
+    latest_lead_total = df_lead[latest_col].fillna(0).sum()
+    diff_lead_total = latest_lead_total - prev_lead_total
+    pct_lead_total = (diff_lead_total / prev_lead_total * 100) if prev_lead_total != 0 else None
+
+    lead_total_table = Table(
+        [[
+            "Totale Lead",
+            format_number(latest_lead_total, amount_scale, amount_decimals),
+            format_number(prev_lead_total, amount_scale, amount_decimals),
+            format_number(diff_lead_total, amount_scale, amount_decimals),
+            format_percent(pct_lead_total),
+        ]],
+        colWidths=[340, 95, 95, 95, 65],
+    )
+    lead_total_table.setStyle(TableStyle([
+        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#E8F4FF")),
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.HexColor("#7DB5E8")),
+        ("ALIGN", (1, 0), (4, 0), "RIGHT"),
+        ("LEFTPADDING", (0, 0), (-1, -1), 4),
+        ("RIGHTPADDING", (0, 0), (-1, -1), 4),
+        ("TOPPADDING", (0, 0), (-1, -1), 3),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
+    ]))
+    elements.append(lead_total_table)
+    return elements
+
+
+def _render_lead_chunk(task):
+    """
+    Worker: rende una sezione lead in un PDF autonomo. Top-level per essere picklable.
+    """
+    lead_value, df_lead, params = task
+    buffer = io.BytesIO()
+    _new_doc(buffer).build(_lead_elements(lead_value, df_lead, **params))
+    return lead_value, buffer.getvalue()
+
+
+def _build_toc(entries, page_offset):
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import Paragraph, Spacer, Table, TableStyle
+
+    styles = getSampleStyleSheet()
+    rows = [["Lead", "Pagina"]] + [[str(lead), str(start + page_offset + 1)] for lead, start in entries]
+    table = Table(rows, repeatRows=1, colWidths=[600, 80])
+    table.setStyle(TableStyle([
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EDEDED")),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#BDBDBD")),
+        ("ALIGN", (1, 0), (1, -1), "RIGHT"),
+    ]))
+    buffer = io.BytesIO()
+    _new_doc(buffer).build([Paragraph("Indice", styles["Heading2"]), Spacer(1, 6), table])
+    return buffer.getvalue()
+
+
+def _page_number_overlay(total_pages):
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfgen import canvas
+
+    page_width, _ = landscape(A4)
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=landscape(A4))
+    for page_no in range(1, total_pages + 1):
+        c.setFont("Helvetica", 7)
+        c.drawRightString(page_width - 18, 8, f"Pagina {page_no} di {total_pages}")
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def _pool_context():
+    # forkserver avoids forking the multi-threaded Streamlit server process
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def build_pdf_by_lead(
+    df_source,
+    latest_col,
+    previous_col,
+    latest_year,
+    previous_year,
+    amount_scale=1,
+    amount_decimals=2,
+    max_workers=None,
+):
+    """
+    PDF lead per lead: ogni lead è reso in un processo separato come PDF autonomo,
+    poi i chunk sono concatenati con indice iniziale e numerazione pagine.
+    Ritorna None se reportlab non è installato o mancano colonne.
+    """
+    try:
+        import reportlab  # noqa: F401
+    except ImportError:
+        return None
+
+    cols = PDF_COLS + [latest_col, previous_col, "differenza_valore", "differenza_percentuale"]
+    if any(c not in df_source.columns for c in cols):
+        return None
+
+    df_pdf = df_source[cols].sort_values(["lead", "sublead", "account_code"], kind="stable")
+    params = {
+        "latest_col": latest_col,
+        "previous_col": previous_col,
+        "latest_year": latest_year,
+        "previous_year": previous_year,
+        "amount_scale": amount_scale,
+        "amount_decimals": amount_decimals,
+    }
+    # Each task is pickled to a worker: drop the categories its lead does not use
+    tasks = [
+        (lead_value, df_lead.apply(lambda col: col.cat.remove_unused_categories() if isinstance(col.dtype, pd.CategoricalDtype) else col), params)
+        for lead_value, df_lead in df_pdf.groupby("lead", sort=False, observed=True)
+    ]
+
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        # Without pypdf chunks cannot be merged: single in-process build, same layout
+        from reportlab.platypus import PageBreak
+
+        elements = []
+        for idx, (lead_value, df_lead, _) in enumerate(tasks):
+            if idx > 0:
+                elements.append(PageBreak())
+            elements.extend(_lead_elements(lead_value, df_lead, **params))
+        buffer = io.BytesIO()
+        _new_doc(buffer).build(elements)
+        return buffer.getvalue()
+
+    workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    if workers > 1 and len(df_pdf) >= PARALLEL_MIN_ROWS:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context()) as pool:
+            chunks = list(pool.map(_render_lead_chunk, tasks))
+    else:
+        chunks = [_render_lead_chunk(task) for task in tasks]
+
+    readers = [(lead_value, PdfReader(io.BytesIO(chunk))) for lead_value, chunk in chunks]
+    toc_entries = []
+    body_pages = 0
+    for lead_value, reader in readers:
+        toc_entries.append((lead_value, body_pages))
+        body_pages += len(reader.pages)
+
+    # TOC is built last: its own length only depends on the number of leads
+    toc_pages = len(PdfReader(io.BytesIO(_build_toc(toc_entries, 0))).pages)
+
+    writer = PdfWriter()
+    writer.append(PdfReader(io.BytesIO(_build_toc(toc_entries, toc_pages))))
+    for _, reader in readers:
+        writer.append(reader)
+    overlay = PdfReader(io.BytesIO(_page_number_overlay(len(writer.pages))))
+    for page, number_page in zip(writer.pages, overlay.pages):
+        page.merge_page(number_page)
+    for lead_value, start in toc_entries:
+        writer.add_outline_item(str(lead_value), start + toc_pages)
+
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
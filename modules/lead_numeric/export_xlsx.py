@@ -0,0 +1,107 @@
+import math
+import numbers
+import os
+import tempfile
+
+import pandas as pd
+
+# Excel outline level per rollup row kind: details are the innermost group
+OUTLINE_LEVELS = {"detail": 3, "lead": 2, "group_lead": 1, "tipo": 0, "check": 0, None: 0}
+
+# Same colours as the page 04 table
+ROW_STYLES = {
+    "lead": {"bold": True, "bg_color": "#E8F4FF", "top": 1, "top_color": "#7DB5E8"},
+    "group_lead": {"bold": True, "bg_color": "#FFF4E5", "top": 1, "top_color": "#E2A35A"},
+    "tipo": {"bold": True, "bg_color": "#EAF9EA", "top": 2, "top_color": "#63A35C", "bottom": 2, "bottom_color": "#63A35C"},
+    "check": {"bold": True, "bg_color": "#F2F2F2", "top": 2, "top_color": "#9E9E9E"},
+}
+HEADER_STYLE = {"bold": True, "bg_color": "#EDEDED", "bottom": 1}
+
+# Trailing thousands separators make Excel display the value divided by 1000 per comma
+SCALE_SUFFIX = {1: "", 1000: ","}
+
+
+def amount_number_format(amount_scale=1, amount_decimals=2):
+    if amount_scale not in SCALE_SUFFIX:
+        raise ValueError(f"Scala importi non supportata per l'export Excel: {amount_scale}")
+    decimals = "." + "0" * amount_decimals if amount_decimals else ""
+    return f"#,##0{decimals}{SCALE_SUFFIX[amount_scale]}"
+
+
+def iter_frame_rows(dataframe):
+    """
+    Righe di un DataFrame già aggregato come coppie (tipo riga, dict), senza outline.
+    """
+    for row in dataframe.to_dict("records"):
+        kind = "check" if str(row.get("tipo", "")).strip().upper() == "CHECK" else None
+        yield kind, row
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def _build_formats(workbook, amount_format, percent_format):
+    # One format per (row kind, cell type); None where a plain cell needs no format
+    number_formats = {"text": None, "amount": amount_format, "percent": percent_format}
+    formats = {}
+    for kind in [None, *ROW_STYLES]:
+        for cell_type, num_format in number_formats.items():
+            props = dict(ROW_STYLES.get(kind, {}))
+            if num_format:
+                props["num_format"] = num_format
+            formats[(kind, cell_type)] = workbook.add_format(props) if props else None
+    return formats
+
+
+def _write_sheet(workbook, formats, sheet_name, columns, rows, amount_cols, percent_cols):
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_format = workbook.add_format(HEADER_STYLE)
+    cell_types = [
+        "amount" if col in amount_cols else "percent" if col in percent_cols else "text"
+        for col in columns
+    ]
+    for col_idx, cell_type in enumerate(cell_types):
+        worksheet.set_column(col_idx, col_idx, 16 if cell_type != "text" else 14)
+    worksheet.freeze_panes(1, 0)
+
+    # constant_memory: rows must be written strictly top to bottom, one at a time
+    for col_idx, col in enumerate(columns):
+        worksheet.write_string(0, col_idx, str(col), header_format)
+
+    row_idx = 0
+    for kind, row in rows:
+        row_idx += 1
+        level = OUTLINE_LEVELS.get(kind, 0)
+        if level:
+            worksheet.set_row(row_idx, None, None, {"level": level})
+        for col_idx, col in enumerate(columns):
+            value = row.get(col)
+            cell_format = formats[(kind if kind in ROW_STYLES else None, cell_types[col_idx])]
+            if _is_number(value) and not math.isnan(value):
+                worksheet.write_number(row_idx, col_idx, float(value), cell_format)
+            elif _is_number(value) or pd.isna(value) or value == "":
+                if cell_format is not None:
+                    worksheet.write_blank(row_idx, col_idx, None, cell_format)
+            else:
+                worksheet.write_string(row_idx, col_idx, str(value), cell_format)
+    return row_idx
+
+
+def write_bilancio_xlsx(sheets, amount_cols, amount_scale=1, amount_decimals=2):
+    """
+    Scrive i fogli in streaming (xlsxwriter constant_memory) su file temporaneo e
+    ritorna i bytes. sheets: lista di (nome foglio, colonne, iterabile di (tipo riga, dict)).
+    Gli importi restano a piena precisione: la scala euro/1000 è nel formato numerico.
+    """
+    import xlsxwriter
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bilancio.xlsx")
+        workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "tmpdir": tmp_dir})
+        formats = _build_formats(workbook, amount_number_format(amount_scale, amount_decimals), '#,##0.00"%"')
+        for sheet_name, columns, rows in sheets:
+            _write_sheet(workbook, formats, sheet_name, columns, rows, amount_cols, ["differenza_percentuale"])
+        workbook.close()
+        with open(path, "rb") as fh:
+            return fh.read()
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+# Decimal and thousands separator per locale
+LOCALE_SEPARATORS = {"it": (",", "."), "en": (".", ",")}
+
+# Amount unit -> (scale factor, decimals), as offered in the page 04 sidebar
+AMOUNT_UNITS = {"euro": (1, 2), "euro_1000": (1000, 1)}
+
+# Text for infinite values; NaN stays ""
+NOT_AVAILABLE = "n.d."
+
+_SPACE = ord(" ")
+_ZERO = ord("0")
+# Scaled values from here on exceed the exact float/int64 range of the vectorized path
+_MAX_EXACT_UNITS = 9e15
+
+
+def amount_unit_params(amount_unit):
+    if amount_unit not in AMOUNT_UNITS:
+        raise ValueError(f"Unità importi non supportata: {amount_unit}")
+    return AMOUNT_UNITS[amount_unit]
+
+
+def _separators(locale):
+    if locale not in LOCALE_SEPARATORS:
+        raise ValueError(f"Locale di formattazione non supportato: {locale}")
+    return LOCALE_SEPARATORS[locale]
+
+
+def _digit_matrix(numbers, width):
+    # (n, width) matrix of code points of the zero-padded decimal digits
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return ((numbers[:, None] // powers) % 10).astype(np.uint32) + _ZERO
+
+
+def _format_python(value, decimals, decimal_sep, thousands_sep):
+    text = f"{abs(value):,.{decimals}f}".translate(str.maketrans({",": thousands_sep, ".": decimal_sep}))
+    return f"-{text}" if value < 0 else text
+
+
+def _format_fixed(values, decimals, decimal_sep, thousands_sep):
+    """
+    Formattazione a virgola fissa di un array float senza loop Python: cifre,
+    separatori e decimali sono scritti come matrice di code point e riletti come
+    stringhe. NaN -> "", infiniti -> NOT_AVAILABLE; i valori oltre la precisione
+    esatta (pochi) passano dal format di Python.
+    """
+    nan_mask = np.isnan(values)
+    inf_mask = np.isinf(values)
+    oversized = ~nan_mask & ~inf_mask & (np.abs(values) * 10 ** decimals >= _MAX_EXACT_UNITS)
+    safe = np.where(nan_mask | inf_mask | oversized, 0.0, values)
+    shifted = np.abs(safe) * 10 ** decimals
+    units = np.rint(shifted).astype(np.int64)
+    # Near-ties (e.g. 835.55 is stored as 835.5499...) are rounded on the exact
+    # binary value, as f"{x:.2f}" does; they are few, so a Python pass is cheap
+    near_tie = np.flatnonzero(np.abs(shifted - np.floor(shifted) - 0.5) < 1e-6)
+    for idx in near_tie:
+        units[idx] = int(f"{abs(safe[idx]):.{decimals}f}".replace(".", ""))
+    int_part = units // 10 ** decimals
+
+    width = len(str(int(int_part.max()))) if len(int_part) else 1
+    digits = _digit_matrix(int_part, width)
+    visible = np.maximum.accumulate(digits != _ZERO, axis=1)
+    visible[:, -1] = True
+    digits = np.where(visible, digits, _SPACE)
+
+    columns = []
+    for col in range(width):
+        from_right = width - col
+        if col > 0 and from_right % 3 == 0 and thousands_sep:
+            columns.append(np.where(visible[:, col - 1], ord(thousands_sep), _SPACE).astype(np.uint32))
+        columns.append(digits[:, col])
+    if decimals > 0:
+        columns.append(np.full(len(units), ord(decimal_sep), dtype=np.uint32))
+        fraction = _digit_matrix(units % 10 ** decimals, decimals)
+        columns.extend(fraction[:, col] for col in range(decimals))
+
+    matrix = np.ascontiguousarray(np.stack(columns, axis=1))
+    text = np.char.lstrip(matrix.view(f"U{matrix.shape[1]}").reshape(-1))
+    text = np.where(safe < 0, np.char.add("-", text), text)
+    text = np.where(nan_mask, "", text)
+    if inf_mask.any() or oversized.any():
+        text = text.astype(object)
+        for idx in np.flatnonzero(oversized):
+            text[idx] = _format_python(values[idx], decimals, decimal_sep, thousands_sep)
+        text[inf_mask] = NOT_AVAILABLE
+        text = text.astype(str)
+    return text
+
+
+def _as_float_array(values):
+    return pd.to_numeric(pd.Series(np.atleast_1d(values)), errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+
+
+def _format_values(values, scale_factor, decimals, locale, suffix=""):
+    # Scalars in -> str out, so the same call serves table columns and single metrics
+    is_scalar = np.ndim(values) == 0
+    numbers = _as_float_array(values)
+    if scale_factor and scale_factor != 1:
+        numbers = numbers / scale_factor
+    if len(numbers) == 0:
+        return np.array([], dtype=str)
+    decimal_sep, thousands_sep = _separators(locale)
+    text = _format_fixed(numbers, decimals, decimal_sep, thousands_sep)
+    if suffix:
+        text = np.where(np.isin(text, ["", NOT_AVAILABLE]), text, np.char.add(text, suffix))
+    return str(text[0]) if is_scalar else text
+
+
+def format_number(values, scale_factor=1, decimals=2, locale="it"):
+    """
+    Formatta un valore o un'intera colonna numerica (1.234,56 per "it"); NaN -> "",
+    infiniti -> "n.d.".
+    """
+    return _format_values(values, scale_factor, decimals, locale)
+
+
+def format_amount(values, amount_unit="euro", locale="it"):
+    scale_factor, decimals = amount_unit_params(amount_unit)
+    return _format_values(values, scale_factor, decimals, locale)
+
+
+def format_percent(values, decimals=2, locale="it"):
+    return _format_values(values, 1, decimals, locale, suffix="%")
+
+
+def format_int(values, locale="it"):
+    return _format_values(values, 1, 0, locale)
@@ -1,8 +1,8 @@
 import pandas as pd
 from datetime import datetime
 
-from modules.lead_numeric.db import get_conn
-from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.db import bump_data_version, get_conn
+from modules.lead_numeric.ddl import backfill_lead_structure_keys, init_db
 
 # Excel → DB columns mapping
 COLUMN_MAP = {
@@ -66,24 +66,30 @@ def _validate_schema(df: pd.DataFrame) -> None:
         raise ValueError("SegnoRpt deve contenere solo 1 o -1.")
 
 
-def import_schema_from_excel(
-    excel_path,
-    sheet_name=0,
-    schema_name="Bilancio UE",
-    version="1.0",
-    note="Import iniziale schema bilancio",
-) -> int:
+def read_schema_excel(excel_path, sheet_name=0) -> pd.DataFrame:
     """
-    Importa lo schema bilancio da Excel nel DB (una tantum per schema_name+version).
-    Ritorna schema_version_id.
+    Legge, normalizza e valida lo schema bilancio da Excel (senza scrivere nel DB).
     """
-    init_db()
-
     df = pd.read_excel(excel_path, sheet_name=sheet_name)
     df = _normalize_columns(df)
     _validate_schema(df)
+    return df
 
-    conn = get_conn()
+
+def write_schema_version(
+    conn,
+    df: pd.DataFrame,
+    schema_name,
+    version,
+    source_file="",
+    note="",
+    kind="primario",
+) -> int:
+    """
+    Inserisce versione schema e righe lead_structure sulla connessione indicata.
+    Non esegue il commit: mapping o crosswalk della nuova versione possono
+    entrare nella stessa transazione. Ritorna schema_version_id.
+    """
     cur = conn.cursor()
 
     # prevent accidental re-import
@@ -92,22 +98,70 @@ def import_schema_from_excel(
         (schema_name, version),
     )
     if cur.fetchone()[0] > 0:
-        conn.close()
         raise RuntimeError(f"Schema '{schema_name}' versione {version} già importato.")
 
     import_date = datetime.now().isoformat(timespec="seconds")
 
     cur.execute(
-        "INSERT INTO lead_schema_version (schema_name, version, import_date, source_file, note) "
-        "VALUES (?, ?, ?, ?, ?)",
-        (schema_name, version, import_date, str(excel_path), note),
+        "INSERT INTO lead_schema_version (schema_name, version, import_date, source_file, note, kind) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (schema_name, version, import_date, str(source_file), note, kind),
     )
     schema_version_id = cur.lastrowid
 
-    df["schema_version_id"] = schema_version_id
-    df.to_sql("lead_structure", conn, if_exists="append", index=False)
+    # executemany rather than DataFrame.to_sql, which commits on its own
+    cols = list(COLUMN_MAP.values())
+    rows = df[cols].astype(object).where(df[cols].notna(), None)
+    cur.executemany(
+        f"INSERT INTO lead_structure ({', '.join(cols)}, schema_version_id) VALUES ({', '.join('?' for _ in cols)}, ?)",
+        [(*row, schema_version_id) for row in rows.itertuples(index=False, name=None)],
+    )
+    backfill_lead_structure_keys(conn)
+    bump_data_version(conn)
+    return schema_version_id
+
+
+def import_schema_frame(
+    df: pd.DataFrame,
+    schema_name="Bilancio UE",
+    version="1.0",
+    source_file="",
+    note="Import iniziale schema bilancio",
+    kind="primario",
+) -> int:
+    """
+    Registra una nuova versione schema con le righe di read_schema_excel
+    (una tantum per schema_name+version). Ritorna schema_version_id.
+    """
+    init_db()
 
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    try:
+        schema_version_id = write_schema_version(
+            conn, df, schema_name, version, source_file=source_file, note=note, kind=kind
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
     return schema_version_id
+
+
+def import_schema_from_excel(
+    excel_path,
+    sheet_name=0,
+    schema_name="Bilancio UE",
+    version="1.0",
+    note="Import iniziale schema bilancio",
+) -> int:
+    """
+    Importa lo schema bilancio da Excel nel DB (una tantum per schema_name+version).
+    Ritorna schema_version_id.
+    """
+    init_db()
+
+    df = read_schema_excel(excel_path, sheet_name=sheet_name)
+    return import_schema_frame(df, schema_name=schema_name, version=version, source_file=excel_path, note=note)
@@ -1,7 +1,8 @@
 import pandas as pd
 from datetime import datetime
-from modules.lead_numeric.db import get_conn
+from modules.lead_numeric.db import bump_data_version, get_conn
 from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.mapping import MAPPING_CTE
 
 # TB columns in your file
 REQUIRED_COLS = {"conto", "descrizione", "dare", "avere"}
@@ -115,45 +116,23 @@ def import_trial_balance_from_excel(
             ),
         )
 
+    bump_data_version(conn)
     conn.commit()
 
-    unmapped_df = pd.read_sql(
-        """
-        WITH latest_schema AS (
-            SELECT MAX(id) AS id FROM lead_schema_version
-        ),
-        latest_mapping AS (
-            SELECT gl_account_id, sublead
-            FROM (
-                SELECT m.*,
-                       ROW_NUMBER() OVER (
-                           PARTITION BY m.gl_account_id
-                           ORDER BY m.schema_version_id DESC, m.id DESC
-                       ) AS rn
-                FROM account_lead_mapping m
-                WHERE m.is_active = 1
-            )
-            WHERE rn = 1
-        ),
-        valid_mapping AS (
-            SELECT lm.gl_account_id, lm.sublead
-            FROM latest_mapping lm
-            JOIN latest_schema s ON 1=1
-            JOIN lead_structure ls
-              ON ls.schema_version_id = s.id
-             AND ls.sublead = lm.sublead
-        )
-        SELECT ga.id AS gl_account_id, ga.account_code, ga.account_name
-        FROM trial_balance_line tbl
-        JOIN gl_account ga ON ga.id = tbl.gl_account_id
-        LEFT JOIN valid_mapping vm ON vm.gl_account_id = ga.id
-        WHERE tbl.trial_balance_id = ?
-          AND vm.gl_account_id IS NULL
-        ORDER BY ga.account_code
-        """,
-        conn,
-        params=(trial_balance_id,),
-    )
+    unmapped_df = pd.read_sql(
+        MAPPING_CTE
+        + """
+        SELECT ga.id AS gl_account_id, ga.account_code, ga.account_name
+        FROM trial_balance_line tbl
+        JOIN gl_account ga ON ga.id = tbl.gl_account_id
+        LEFT JOIN valid_mapping vm ON vm.gl_account_id = ga.id
+        WHERE tbl.trial_balance_id = ?
+          AND vm.gl_account_id IS NULL
+        ORDER BY ga.account_code
+        """,
+        conn,
+        params=(trial_balance_id,),
+    )
 
     conn.close()
     return trial_balance_id, unmapped_df
@@ -0,0 +1,611 @@
+import re
+from datetime import datetime
+from itertools import islice, repeat
+
+import numpy as np
+import pandas as pd
+
+from modules.lead_numeric.db import bump_data_version, get_conn
+from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.entries import AMOUNT_TOLERANCE, clean_text
+
+# Journal export columns (lower case, any order); amounts as debit/credit
+JOURNAL_REQUIRED_COLS = ["registrazione", "data", "conto", "dare", "avere"]
+JOURNAL_OPTIONAL_COLS = ["ora", "descrizione_conto", "descrizione", "utente"]
+JOURNAL_AMOUNT_COLS = ["dare", "avere"]
+
+# Rows per chunk: one chunk is parsed, validated and inserted before the next is read
+JOURNAL_CHUNK_ROWS = 100000
+
+JOURNAL_TESTS = {
+    "weekend": "Registrazioni nel fine settimana",
+    "fuori_orario": "Registrazioni fuori orario",
+    "importo_tondo": "Importi tondi",
+}
+
+# Nigrini MAD thresholds for the first-digit test
+BENFORD_MAD_THRESHOLDS = [
+    (0.006, "Conformità stretta"),
+    (0.012, "Conformità accettabile"),
+    (0.015, "Conformità marginale"),
+]
+
+_DETAIL_COLS = ["line_id", "entry_no", "posting_date", "posting_time", "account_code", "amount", "user_code", "description"]
+
+
+def _normalize_columns(columns):
+    return [str(c).strip().lower() for c in columns]
+
+
+def _check_columns(columns):
+    missing = [c for c in JOURNAL_REQUIRED_COLS if c not in columns]
+    if missing:
+        raise ValueError(f"Colonne mancanti nel giornale: {missing}. Attese: {JOURNAL_REQUIRED_COLS}")
+
+
+def _csv_chunks(file, sep, encoding, chunk_rows):
+    # Every column is read as text: amounts are checked against the file's separators
+    # by _amounts (the C reader would drop a misplaced thousands separator silently)
+    header = pd.read_csv(file, sep=sep, nrows=0, encoding=encoding).columns
+    names = dict(zip(header, _normalize_columns(header)))
+    _check_columns(list(names.values()))
+    if hasattr(file, "seek"):
+        file.seek(0)
+    reader = pd.read_csv(
+        file,
+        sep=sep,
+        encoding=encoding,
+        dtype=str,
+        keep_default_na=False,
+        na_values={raw: [""] for raw, name in names.items() if name in JOURNAL_AMOUNT_COLS},
+        chunksize=chunk_rows,
+    )
+    for chunk in reader:
+        yield chunk.rename(columns=names)
+
+
+def _xlsx_chunks(file, sheet_name, chunk_rows):
+    # openpyxl read-only mode streams the sheet row by row
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        rows = sheet.iter_rows(values_only=True)
+        columns = _normalize_columns(next(rows, ()))
+        _check_columns(columns)
+        while True:
+            block = list(islice(rows, chunk_rows))
+            if not block:
+                break
+            yield pd.DataFrame(block, columns=columns)
+    finally:
+        workbook.close()
+
+
+def read_journal_chunks(
+    file,
+    file_name,
+    sheet_name=0,
+    sep=";",
+    encoding="utf-8",
+    chunk_rows=JOURNAL_CHUNK_ROWS,
+):
+    """
+    Legge un export di libro giornale (CSV o xlsx, dall'estensione di file_name)
+    a blocchi di chunk_rows righe, con le colonne in minuscolo. Nel CSV ogni
+    colonna resta testo: gli importi li converte l'import con i separatori del file.
+    """
+    if str(file_name).lower().endswith((".xlsx", ".xlsm")):
+        return _xlsx_chunks(file, sheet_name, chunk_rows)
+    return _csv_chunks(file, sep, encoding, chunk_rows)
+
+
+def _optional_text(chunk, col):
+    if col not in chunk.columns:
+        return repeat(None)
+    values = clean_text(chunk[col])
+    return values.where(values != "", None).tolist()
+
+
+def _posting_seconds(series):
+    # "HH:MM" or "HH:MM:SS" (text or time cells) -> seconds from midnight
+    text = clean_text(series)
+    text = text.where(text.str.len() != 5, text + ":00")
+    times = pd.to_datetime(text.where(text != ""), format="%H:%M:%S", errors="coerce")
+    return times.dt.hour * 3600 + times.dt.minute * 60 + times.dt.second
+
+
+def _posting_dates(series, date_format=None):
+    # Without an explicit format: ISO dates (AAAA-MM-GG) as such, otherwise day first
+    if date_format is None:
+        first = series.dropna().astype(str).str.strip()
+        first = first[first != ""].head(1)
+        if not first.empty and first.iloc[0][:4].isdigit() and first.iloc[0][4:5] == "-":
+            date_format = "ISO8601"
+    if date_format is not None:
+        return pd.to_datetime(series, format=date_format, errors="coerce")
+    return pd.to_datetime(series, dayfirst=True, errors="coerce")
+
+
+def _amount_pattern(decimal, thousands):
+    # Plain digits, or groups of three around the thousands separator, then the
+    # decimals: "1234.50" with decimal "," and thousands "." is rejected, not read as 123450
+    integer = rf"\d{{1,3}}(?:{re.escape(thousands)}\d{{3}})+|\d+" if thousands else r"\d+"
+    return rf"[+-]?(?:{integer})(?:{re.escape(decimal)}\d+)?"
+
+
+def _amounts(series, decimal, thousands):
+    # Numeric cells (xlsx) as read; text cells (CSV, xlsx text) only when written
+    # with the file's separators. Empty cells are zero, anything else is invalid
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("float64").fillna(0.0), pd.Series(False, index=series.index)
+    is_text = series.map(type).eq(str)
+    numbers = pd.to_numeric(series.where(~is_text), errors="coerce")
+    text = series.where(is_text).str.strip()
+    wellformed = text.str.fullmatch(_amount_pattern(decimal, thousands)).fillna(False).astype(bool)
+    cleaned = text.where(wellformed)
+    if thousands:
+        cleaned = cleaned.str.replace(thousands, "", regex=False)
+    if decimal != ".":
+        cleaned = cleaned.str.replace(decimal, ".", regex=False)
+    parsed = pd.to_numeric(cleaned, errors="coerce")
+    values = numbers.where(~is_text, parsed)
+    invalid = values.isna() & series.notna() & ~(is_text & (text == ""))
+    return values.astype("float64").fillna(0.0), invalid
+
+
+def _normalize_chunk(chunk, first_row, date_format=None, decimal=",", thousands="."):
+    """
+    Blocco del giornale nelle colonne di journal_line. Righe senza registrazione,
+    conto o data valida, o con un importo non numerico, bloccano l'import (riga
+    del file nel messaggio).
+    """
+    df = pd.DataFrame(index=chunk.index)
+    df["entry_no"] = clean_text(chunk["registrazione"])
+    df["account_code"] = clean_text(chunk["conto"])
+    dates = _posting_dates(chunk["data"], date_format)
+    invalid = (df["entry_no"] == "") | (df["account_code"] == "") | dates.isna()
+    if invalid.any():
+        rows = (np.flatnonzero(invalid.to_numpy()) + first_row + 2).tolist()
+        raise ValueError(f"Righe del giornale senza registrazione, conto o data valida: {rows[:30]}")
+    df["posting_date"] = (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype("int64")
+    df["posting_time"] = (
+        _posting_seconds(chunk["ora"]) if "ora" in chunk.columns else pd.Series(np.nan, index=chunk.index)
+    ).astype("Int64")
+    debit, invalid_debit = _amounts(chunk["dare"], decimal, thousands)
+    credit, invalid_credit = _amounts(chunk["avere"], decimal, thousands)
+    invalid = invalid_debit | invalid_credit
+    if invalid.any():
+        rows = (np.flatnonzero(invalid.to_numpy()) + first_row + 2).tolist()
+        raise ValueError(
+            f"Righe del giornale con importo dare o avere non numerico o con separatori diversi da "
+            f"quelli indicati (decimali '{decimal}', migliaia '{thousands or ''}'): {rows[:30]}"
+        )
+    df["amount"] = (debit - credit).astype("float64")
+    return df
+
+
+def _account_ids(conn, chart_of_accounts, account_ids, df, chunk):
+    # New account codes are created once, with the journal's account name if given
+    new_codes = df.loc[~df["account_code"].isin(account_ids), "account_code"]
+    if not new_codes.empty:
+        names = (
+            clean_text(chunk.loc[new_codes.index, "descrizione_conto"])
+            if "descrizione_conto" in chunk.columns
+            else pd.Series("", index=new_codes.index)
+        )
+        first = pd.DataFrame({"code": new_codes, "name": names}).drop_duplicates("code")
+        conn.executemany(
+            "INSERT OR IGNORE INTO gl_account (account_code, account_name, chart_of_accounts) VALUES (?, ?, ?)",
+            [(code, name or code, chart_of_accounts) for code, name in first.itertuples(index=False)],
+        )
+        placeholders = ", ".join("?" for _ in first["code"])
+        account_ids.update(
+            conn.execute(
+                f"SELECT account_code, id FROM gl_account WHERE chart_of_accounts = ? AND account_code IN ({placeholders})",
+                (chart_of_accounts, *first["code"]),
+            ).fetchall()
+        )
+    return df["account_code"].map(account_ids).astype("int64")
+
+
+def import_journal(
+    file,
+    file_name,
+    entity_code,
+    entity_name,
+    fiscal_year,
+    chart_of_accounts="COA",
+    currency="EUR",
+    date_format=None,
+    decimal=",",
+    thousands=".",
+    **read_options,
+):
+    """
+    Importa un libro giornale a blocchi in journal_line, sostituendo l'import
+    precedente della stessa entità, esercizio e piano dei conti. Una sola
+    transazione: un blocco non valido annulla tutto. Ritorna il riepilogo
+    (journal_import_id, righe, scritture, non quadrate, fuori esercizio).
+    """
+    init_db()
+    conn = get_conn()
+    try:
+        conn.execute(
+            "INSERT OR IGNORE INTO legal_entity (entity_code, entity_name, currency) VALUES (?, ?, ?)",
+            (entity_code, entity_name, currency),
+        )
+        legal_entity_id = conn.execute(
+            "SELECT id FROM legal_entity WHERE entity_code = ?", (entity_code,)
+        ).fetchone()[0]
+        key = (legal_entity_id, int(fiscal_year), chart_of_accounts)
+        conn.execute(
+            """
+            DELETE FROM journal_line WHERE journal_import_id IN (
+                SELECT id FROM journal_import
+                WHERE legal_entity_id = ? AND fiscal_year = ? AND chart_of_accounts = ?
+            )
+            """,
+            key,
+        )
+        conn.execute(
+            "DELETE FROM journal_import WHERE legal_entity_id = ? AND fiscal_year = ? AND chart_of_accounts = ?",
+            key,
+        )
+        journal_import_id = conn.execute(
+            """
+            INSERT INTO journal_import (legal_entity_id, fiscal_year, chart_of_accounts, source_file, imported_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (*key, file_name, datetime.now().isoformat(timespec="seconds")),
+        ).lastrowid
+        account_ids = dict(
+            conn.execute(
+                "SELECT account_code, id FROM gl_account WHERE chart_of_accounts = ?", (chart_of_accounts,)
+            ).fetchall()
+        )
+
+        line_count = 0
+        for chunk in read_journal_chunks(file, file_name, **read_options):
+            chunk = chunk.reset_index(drop=True)
+            df = _normalize_chunk(
+                chunk,
+                line_count,
+                date_format,
+                decimal=decimal,
+                thousands=thousands,
+            )
+            gl_account_ids = _account_ids(conn, chart_of_accounts, account_ids, df, chunk)
+            conn.executemany(
+                """
+                INSERT INTO journal_line
+                (journal_import_id, entry_no, posting_date, posting_time, gl_account_id, amount, user_code, description)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                zip(
+                    repeat(journal_import_id),
+                    df["entry_no"].tolist(),
+                    df["posting_date"].tolist(),
+                    df["posting_time"].astype(object).where(df["posting_time"].notna(), None).tolist(),
+                    gl_account_ids.tolist(),
+                    df["amount"].tolist(),
+                    _optional_text(chunk, "utente"),
+                    _optional_text(chunk, "descrizione"),
+                ),
+            )
+            line_count += len(chunk)
+
+        conn.execute("UPDATE journal_import SET line_count = ? WHERE id = ?", (line_count, journal_import_id))
+        summary = journal_summary(conn, journal_import_id)
+        bump_data_version(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return summary
+
+
+def load_journal_imports(conn) -> pd.DataFrame:
+    return pd.read_sql(
+        """
+        SELECT ji.id, le.entity_code, ji.fiscal_year, ji.chart_of_accounts, ji.source_file, ji.line_count, ji.imported_at
+        FROM journal_import ji
+        JOIN legal_entity le ON le.id = ji.legal_entity_id
+        ORDER BY ji.fiscal_year DESC, le.entity_code, ji.chart_of_accounts
+        """,
+        conn,
+    )
+
+
+def journal_summary(conn, journal_import_id) -> dict:
+    """
+    Conteggi dell'import in due passaggi aggregati sugli indici di journal_line.
+    """
+    params = {"id": int(journal_import_id)}
+    lines, accounts, total_debit, total_credit, outside_year = conn.execute(
+        """
+        SELECT COUNT(*), COUNT(DISTINCT jl.gl_account_id),
+               COALESCE(SUM(CASE WHEN jl.amount > 0 THEN jl.amount END), 0),
+               COALESCE(SUM(CASE WHEN jl.amount < 0 THEN -jl.amount END), 0),
+               COALESCE(SUM(jl.posting_date / 10000 <> ji.fiscal_year), 0)
+        FROM journal_import ji
+        JOIN journal_line jl ON jl.journal_import_id = ji.id
+        WHERE ji.id = :id
+        """,
+        params,
+    ).fetchone()
+    entries, unbalanced = conn.execute(
+        f"""
+        SELECT COUNT(*), COALESCE(SUM(ABS(total) > {AMOUNT_TOLERANCE}), 0)
+        FROM (
+            SELECT SUM(amount) AS total
+            FROM journal_line
+            WHERE journal_import_id = :id
+            GROUP BY entry_no
+        )
+        """,
+        params,
+    ).fetchone()
+    return {
+        "journal_import_id": int(journal_import_id),
+        "righe": lines,
+        "scritture": entries,
+        "conti": accounts,
+        "totale_dare": total_debit,
+        "totale_avere": total_credit,
+        "scritture_non_quadrate": unbalanced,
+        "righe_fuori_esercizio": outside_year,
+    }
+
+
+def load_unbalanced_entries(conn, journal_import_id) -> pd.DataFrame:
+    return pd.read_sql(
+        f"""
+        SELECT entry_no, MIN(posting_date) AS posting_date, COUNT(*) AS righe, SUM(amount) AS sbilancio
+        FROM journal_line
+        WHERE journal_import_id = ?
+        GROUP BY entry_no
+        HAVING ABS(SUM(amount)) > {AMOUNT_TOLERANCE}
+        ORDER BY ABS(SUM(amount)) DESC
+        """,
+        conn,
+        params=(int(journal_import_id),),
+    )
+
+
+_JOURNAL_BALANCES_CTE = """
+    journal_balance AS (
+        SELECT gl_account_id,
+               SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END) AS debit,
+               SUM(CASE WHEN amount < 0 THEN -amount ELSE 0 END) AS credit,
+               SUM(amount) AS closing_balance
+        FROM journal_line
+        WHERE journal_import_id = :id
+        GROUP BY gl_account_id
+    )
+"""
+
+
+def reconcile_journal(conn, journal_import_id) -> pd.DataFrame:
+    """
+    Quadratura per conto tra saldo del giornale (somma dei movimenti) e saldo di
+    chiusura del TB importato per la stessa entità, esercizio e piano dei conti.
+    Conti presenti da una sola parte inclusi con l'altra a zero.
+    """
+    return pd.read_sql(
+        "WITH"
+        + _JOURNAL_BALANCES_CTE
+        + """,
+        tb_balance AS (
+            SELECT tbl.gl_account_id, tbl.closing_balance
+            FROM journal_import ji
+            JOIN trial_balance_header tbh
+              ON tbh.legal_entity_id = ji.legal_entity_id
+             AND tbh.fiscal_year = ji.fiscal_year
+             AND tbh.chart_of_accounts = ji.chart_of_accounts
+            JOIN trial_balance_line tbl ON tbl.trial_balance_id = tbh.id
+            WHERE ji.id = :id
+        ),
+        balances AS (
+            SELECT gl_account_id, closing_balance AS saldo_giornale, 0 AS saldo_tb FROM journal_balance
+            UNION ALL
+            SELECT gl_account_id, 0, closing_balance FROM tb_balance
+        )
+        SELECT ga.account_code, ga.account_name,
+               SUM(b.saldo_giornale) AS saldo_giornale,
+               SUM(b.saldo_tb) AS saldo_tb,
+               SUM(b.saldo_giornale) - SUM(b.saldo_tb) AS differenza
+        FROM balances b
+        JOIN gl_account ga ON ga.id = b.gl_account_id
+        GROUP BY ga.account_code, ga.account_name
+        ORDER BY ga.account_code
+        """,
+        conn,
+        params={"id": int(journal_import_id)},
+    )
+
+
+def derive_trial_balance(conn, journal_import_id) -> int:
+    """
+    Crea o sostituisce il TB dell'entità ed esercizio dell'import aggregando il
+    giornale per conto (dare, avere, saldo; apertura a zero come nell'import TB).
+    Ritorna trial_balance_id.
+    """
+    row = conn.execute(
+        """
+        SELECT ji.legal_entity_id, ji.fiscal_year, ji.chart_of_accounts, le.currency, ji.source_file
+        FROM journal_import ji
+        JOIN legal_entity le ON le.id = ji.legal_entity_id
+        WHERE ji.id = ?
+        """,
+        (int(journal_import_id),),
+    ).fetchone()
+    if row is None:
+        raise ValueError(f"Import del giornale non trovato: {journal_import_id}")
+    legal_entity_id, fiscal_year, chart_of_accounts, currency, source_file = row
+    try:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO trial_balance_header
+            (id, legal_entity_id, fiscal_year, chart_of_accounts, currency, import_date, source_file, note)
+            VALUES (
+                (SELECT id FROM trial_balance_header WHERE legal_entity_id=? AND fiscal_year=? AND chart_of_accounts=?),
+                ?, ?, ?, ?, ?, ?, ?
+            )
+            """,
+            (
+                legal_entity_id, fiscal_year, chart_of_accounts,
+                legal_entity_id, fiscal_year, chart_of_accounts, currency or "EUR",
+                datetime.now().isoformat(timespec="seconds"), source_file,
+                "TB derivato dal libro giornale",
+            ),
+        )
+        trial_balance_id = conn.execute(
+            "SELECT id FROM trial_balance_header WHERE legal_entity_id=? AND fiscal_year=? AND chart_of_accounts=?",
+            (legal_entity_id, fiscal_year, chart_of_accounts),
+        ).fetchone()[0]
+        conn.execute("DELETE FROM trial_balance_line WHERE trial_balance_id = ?", (trial_balance_id,))
+        conn.execute(
+            "WITH"
+            + _JOURNAL_BALANCES_CTE
+            + """
+            INSERT INTO trial_balance_line
+            (trial_balance_id, gl_account_id, opening_balance, debit, credit, closing_balance)
+            SELECT :tb_id, gl_account_id, 0, debit, credit, closing_balance
+            FROM journal_balance
+            """,
+            {"id": int(journal_import_id), "tb_id": trial_balance_id},
+        )
+        bump_data_version(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return trial_balance_id
+
+
+def load_journal_columns(conn, journal_import_id) -> pd.DataFrame:
+    """
+    Colonne numeriche del giornale per le analisi (line_id, data, ora, conto,
+    importo): nessuna stringa per riga, i test sono passaggi vettoriali.
+    """
+    # Lines of an import are inserted in one transaction, so their ids form one
+    # range: a rowid range scan, not an index lookup per line plus a sort
+    first_id, last_id = conn.execute(
+        "SELECT MIN(id), MAX(id) FROM journal_line WHERE journal_import_id = ?", (int(journal_import_id),)
+    ).fetchone()
+    df = pd.read_sql(
+        """
+        SELECT id AS line_id, posting_date, posting_time, gl_account_id, amount
+        FROM journal_line
+        WHERE id BETWEEN ? AND ? AND +journal_import_id = ?
+        ORDER BY id
+        """,
+        conn,
+        params=(first_id or 0, last_id or 0, int(journal_import_id)),
+    )
+    df["posting_date"] = df["posting_date"].astype("int64")
+    df["posting_time"] = df["posting_time"].astype("float64")
+    df["amount"] = df["amount"].astype("float64")
+    return df
+
+
+def journal_flags(df_lines, start_hour=8, end_hour=19, round_unit=1000) -> pd.DataFrame:
+    """
+    Un flag per test di JOURNAL_TESTS: data di sabato o domenica, ora fuori da
+    [start_hour, end_hour) (solo righe con ora), importo multiplo di round_unit.
+    """
+    dates = df_lines["posting_date"].to_numpy()
+    weekday = pd.to_datetime(
+        pd.DataFrame({"year": dates // 10000, "month": dates // 100 % 100, "day": dates % 100})
+    ).dt.dayofweek.to_numpy()
+    seconds = df_lines["posting_time"].to_numpy(dtype="float64")
+    with np.errstate(invalid="ignore"):
+        after_hours = (seconds < start_hour * 3600) | (seconds >= end_hour * 3600)
+    cents = np.round(np.abs(df_lines["amount"].to_numpy(dtype="float64")) * 100)
+    unit = round(round_unit * 100)
+    return pd.DataFrame(
+        {
+            "weekend": weekday >= 5,
+            "fuori_orario": after_hours & ~np.isnan(seconds),
+            "importo_tondo": (cents >= unit) & (np.mod(cents, unit) == 0),
+        },
+        index=df_lines.index,
+    )
+
+
+def flag_summary(df_lines, df_flags) -> pd.DataFrame:
+    amounts = np.abs(df_lines["amount"].to_numpy(dtype="float64"))
+    rows = []
+    for test, label in JOURNAL_TESTS.items():
+        mask = df_flags[test].to_numpy()
+        rows.append(
+            {
+                "test": test,
+                "descrizione": label,
+                "righe": int(mask.sum()),
+                "% righe": mask.mean() * 100 if len(mask) else None,
+                "importo_assoluto": float(amounts[mask].sum()),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def benford_first_digit(amounts, min_amount=10.0) -> pd.DataFrame:
+    """
+    Distribuzione della prima cifra degli importi (valore assoluto >= min_amount)
+    contro la legge di Benford. In attrs: MAD, esito (soglie di Nigrini) e righe.
+    """
+    values = np.abs(np.asarray(amounts, dtype="float64"))
+    values = values[values >= min_amount]
+    digits = np.floor(values / 10 ** np.floor(np.log10(values))).astype("int64").clip(1, 9)
+    observed = np.bincount(digits, minlength=10)[1:]
+    total = observed.sum()
+    expected = np.log10(1 + 1 / np.arange(1, 10))
+    frequency = observed / total if total else np.zeros(9)
+    df = pd.DataFrame(
+        {
+            "cifra": np.arange(1, 10),
+            "osservate": observed,
+            "frequenza": frequency,
+            "attesa": expected,
+            "scarto": frequency - expected,
+        }
+    )
+    mad = float(np.abs(frequency - expected).mean()) if total else None
+    df.attrs["righe"] = int(total)
+    df.attrs["mad"] = mad
+    df.attrs["esito"] = (
+        None if mad is None
+        else next((label for limit, label in BENFORD_MAD_THRESHOLDS if mad <= limit), "Non conformità")
+    )
+    return df
+
+
+def load_flagged_lines(conn, line_ids, limit=1000) -> pd.DataFrame:
+    """
+    Dettaglio (registrazione, conto, utente, descrizione) delle righe segnalate,
+    letto solo per i primi `limit` id tramite una tabella temporanea.
+    """
+    conn.execute("DROP TABLE IF EXISTS temp.flagged_line")
+    conn.execute("CREATE TEMP TABLE flagged_line (line_id INTEGER PRIMARY KEY)")
+    conn.executemany(
+        "INSERT INTO flagged_line (line_id) VALUES (?)",
+        ((int(line_id),) for line_id in list(line_ids)[:limit]),
+    )
+    df = pd.read_sql(
+        """
+        SELECT jl.id AS line_id, jl.entry_no, jl.posting_date, jl.posting_time, ga.account_code, jl.amount,
+               jl.user_code, jl.description
+        FROM flagged_line fl
+        JOIN journal_line jl ON jl.id = fl.line_id
+        JOIN gl_account ga ON ga.id = jl.gl_account_id
+        ORDER BY jl.id
+        """,
+        conn,
+    )
+    conn.execute("DROP TABLE temp.flagged_line")
+    return df[_DETAIL_COLS]
@@ -0,0 +1,272 @@
+import io
+
+import pandas as pd
+
+from modules.lead_numeric.db import bump_data_version, get_conn
+from modules.lead_numeric.ddl import LATEST_PRIMARY_SCHEMA_SQL, init_db, latest_primary_schema_id
+
+# Mapping valido: ultima riga attiva per conto la cui sublead esiste nell'ultimo
+# schema primario (gli schemi derivati non hanno mapping proprio)
+MAPPING_CTE = f"""
+WITH latest_schema AS (
+    SELECT ({LATEST_PRIMARY_SCHEMA_SQL}) AS id
+),
+latest_mapping AS (
+    SELECT gl_account_id, sublead
+    FROM (
+        SELECT m.*,
+               ROW_NUMBER() OVER (
+                   PARTITION BY m.gl_account_id
+                   ORDER BY m.schema_version_id DESC, m.id DESC
+               ) AS rn
+        FROM account_lead_mapping m
+        WHERE m.is_active = 1
+    )
+    WHERE rn = 1
+),
+valid_mapping AS (
+    SELECT lm.gl_account_id, lm.sublead
+    FROM latest_mapping lm
+    JOIN latest_schema s ON 1=1
+    JOIN lead_structure ls
+      ON ls.schema_version_id = s.id
+     AND ls.sublead = lm.sublead
+)
+"""
+
+# Excel columns of the mapping round-trip (export -> edit offline -> import)
+EXPORT_COLS = ["account_code", "account_name", "sublead", "lead", "descrizione_cee", "note"]
+REQUIRED_IMPORT_COLS = {"account_code", "sublead"}
+
+
+class MappingImportError(ValueError):
+    """Errore di validazione import mapping; `errors` contiene le righe scartate."""
+
+    def __init__(self, message, errors: pd.DataFrame):
+        super().__init__(message)
+        self.errors = errors
+
+
+def load_mapping_for_chart(conn, chart_of_accounts) -> pd.DataFrame:
+    """
+    Mapping completo del piano dei conti (conti non mappati con sublead vuota).
+    """
+    df = pd.read_sql(
+        MAPPING_CTE
+        + """
+        SELECT ga.account_code, ga.account_name,
+               COALESCE(vm.sublead, '') AS sublead,
+               ls.lead, ls.descrizione_cee,
+               (
+                   SELECT m.note
+                   FROM account_lead_mapping m
+                   WHERE m.gl_account_id = vm.gl_account_id
+                     AND m.sublead = vm.sublead
+                     AND m.is_active = 1
+                   ORDER BY m.schema_version_id DESC, m.id DESC
+                   LIMIT 1
+               ) AS note
+        FROM gl_account ga
+        LEFT JOIN valid_mapping vm ON vm.gl_account_id = ga.id
+        LEFT JOIN latest_schema s ON 1=1
+        LEFT JOIN lead_structure ls
+          ON ls.schema_version_id = s.id
+         AND ls.sublead = vm.sublead
+        WHERE ga.chart_of_accounts = ?
+        ORDER BY ga.account_code
+        """,
+        conn,
+        params=(chart_of_accounts,),
+    )
+    return df[EXPORT_COLS]
+
+
+def load_tb_accounts(conn, trial_balance_id) -> pd.DataFrame:
+    """
+    Conti di un TB con la sublead del mapping valido (vuota se non mappati),
+    ordinati per codice conto, con etichetta "codice - descrizione".
+    """
+    df = pd.read_sql(
+        MAPPING_CTE
+        + """
+        SELECT ga.id AS gl_account_id, ga.account_code, ga.account_name, vm.sublead AS mapped_sublead
+        FROM trial_balance_line tbl
+        JOIN gl_account ga ON ga.id = tbl.gl_account_id
+        LEFT JOIN valid_mapping vm ON vm.gl_account_id = ga.id
+        WHERE tbl.trial_balance_id = ?
+        GROUP BY ga.id, ga.account_code, ga.account_name, vm.sublead
+        ORDER BY ga.account_code
+        """,
+        conn,
+        params=(trial_balance_id,),
+    )
+    df["account_name"] = df["account_name"].fillna("")
+    df["label"] = df["account_code"] + " - " + df["account_name"]
+    return df
+
+
+def export_mapping_to_excel(chart_of_accounts) -> bytes:
+    """
+    Esporta il mapping del piano dei conti in Excel (foglio "Mapping"),
+    nello stesso formato accettato da import_mapping_from_excel.
+    """
+    conn = get_conn()
+    try:
+        df = load_mapping_for_chart(conn, chart_of_accounts)
+    finally:
+        conn.close()
+
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        df.to_excel(writer, index=False, sheet_name="Mapping")
+    return output.getvalue()
+
+
+def _normalize_import(df: pd.DataFrame) -> pd.DataFrame:
+    df.columns = [str(c).strip() for c in df.columns]
+
+    missing = [c for c in sorted(REQUIRED_IMPORT_COLS) if c not in df.columns]
+    if missing:
+        raise ValueError(f"Colonne mancanti nel file mapping: {missing}")
+
+    if "note" not in df.columns:
+        df["note"] = None
+
+    df = df[["account_code", "sublead", "note"]].copy()
+    df["account_code"] = df["account_code"].fillna("").astype(str).str.strip()
+    df["sublead"] = df["sublead"].fillna("").astype(str).str.strip()
+    df["note"] = df["note"].astype(object).where(df["note"].notna(), None)
+    # Excel row number (header = row 1) for error reporting
+    df.insert(0, "row_no", range(2, len(df) + 2))
+    return df[df["account_code"] != ""]
+
+
+def _validate_import(conn, chart_of_accounts, schema_version_id) -> pd.DataFrame:
+    # Set-based checks against the staged rows in temp.mapping_import
+    return pd.read_sql(
+        """
+        SELECT mi.row_no AS riga, mi.account_code, mi.sublead, 'Conto duplicato nel file' AS errore
+        FROM mapping_import mi
+        JOIN (
+            SELECT account_code FROM mapping_import
+            GROUP BY account_code HAVING COUNT(*) > 1
+        ) d ON d.account_code = mi.account_code
+        UNION ALL
+        SELECT mi.row_no, mi.account_code, mi.sublead, 'Conto inesistente nel piano dei conti'
+        FROM mapping_import mi
+        LEFT JOIN gl_account ga
+          ON ga.account_code = mi.account_code
+         AND ga.chart_of_accounts = ?
+        WHERE ga.id IS NULL
+        UNION ALL
+        SELECT mi.row_no, mi.account_code, mi.sublead, 'Sublead inesistente nello schema'
+        FROM mapping_import mi
+        LEFT JOIN lead_structure ls
+          ON ls.schema_version_id = ?
+         AND ls.sublead = mi.sublead
+        WHERE mi.sublead <> ''
+          AND ls.id IS NULL
+        ORDER BY 1
+        """,
+        conn,
+        params=(chart_of_accounts, schema_version_id),
+    )
+
+
+def import_mapping_from_excel(excel_file, chart_of_accounts, sheet_name=0) -> dict:
+    """
+    Importa il mapping conto -> sublead da Excel (colonne: account_code, sublead, note).
+    Tutte le righe sono validate insieme; se valide sono applicate in un'unica transazione.
+    Sublead vuota = conto da smappare. Ritorna i conteggi dell'import.
+    """
+    init_db()
+
+    df = pd.read_excel(excel_file, sheet_name=sheet_name, dtype={"account_code": str, "sublead": str})
+    df = _normalize_import(df)
+
+    conn = get_conn()
+    try:
+        schema_version_id = latest_primary_schema_id(conn)
+        if schema_version_id is None:
+            raise RuntimeError("Nessuna versione schema trovata. Importa prima lo schema in pagina 01.")
+
+        conn.execute("DROP TABLE IF EXISTS temp.mapping_import")
+        conn.execute(
+            "CREATE TEMP TABLE mapping_import (row_no INTEGER, account_code TEXT, sublead TEXT, note TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO mapping_import (row_no, account_code, sublead, note) VALUES (?, ?, ?, ?)",
+            df.itertuples(index=False, name=None),
+        )
+        conn.execute("CREATE INDEX temp.ix_mapping_import_account ON mapping_import (account_code)")
+
+        errors = _validate_import(conn, chart_of_accounts, schema_version_id)
+        if not errors.empty:
+            raise MappingImportError(
+                f"Import mapping annullato: {errors['riga'].nunique()} righe non valide.",
+                errors,
+            )
+
+        conn.execute("DROP TABLE IF EXISTS temp.mapping_plan")
+        conn.execute(
+            "CREATE TEMP TABLE mapping_plan AS "
+            + MAPPING_CTE
+            + """
+            SELECT ga.id AS gl_account_id, mi.sublead AS new_sublead, mi.note
+            FROM mapping_import mi
+            JOIN gl_account ga
+              ON ga.account_code = mi.account_code
+             AND ga.chart_of_accounts = ?
+            LEFT JOIN valid_mapping vm ON vm.gl_account_id = ga.id
+            WHERE COALESCE(vm.sublead, '') <> mi.sublead
+               OR (
+                   mi.sublead <> ''
+                   AND COALESCE(mi.note, '') <> COALESCE((
+                       SELECT m.note
+                       FROM account_lead_mapping m
+                       WHERE m.gl_account_id = ga.id
+                         AND m.sublead = mi.sublead
+                         AND m.is_active = 1
+                       ORDER BY m.schema_version_id DESC, m.id DESC
+                       LIMIT 1
+                   ), '')
+               )
+            """,
+            (chart_of_accounts,),
+        )
+
+        updated, removed = conn.execute(
+            "SELECT COALESCE(SUM(new_sublead <> ''), 0), COALESCE(SUM(new_sublead = ''), 0) FROM mapping_plan"
+        ).fetchone()
+
+        conn.execute(
+            """
+            DELETE FROM account_lead_mapping
+            WHERE is_active = 1
+              AND gl_account_id IN (SELECT gl_account_id FROM mapping_plan WHERE new_sublead = '')
+            """
+        )
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO account_lead_mapping
+            (gl_account_id, sublead, schema_version_id, is_active, note)
+            SELECT gl_account_id, new_sublead, ?, 1, note
+            FROM mapping_plan
+            WHERE new_sublead <> ''
+            """,
+            (schema_version_id,),
+        )
+        bump_data_version(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return {
+        "righe": len(df),
+        "aggiornati": updated,
+        "rimossi": removed,
+        "invariati": len(df) - updated - removed,
+    }
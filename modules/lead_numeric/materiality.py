@@ -0,0 +1,517 @@
+import json
+import re
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from modules.lead_numeric.adjustments import tb_line_cte
+from modules.lead_numeric.db import bump_data_version
+from modules.lead_numeric.schemas import report_schema_params, report_sublead_cte
+
+# Lead structure fields a benchmark rule can filter on
+BENCHMARK_FIELDS = ("tipo", "lead", "sublead")
+BENCHMARK_OPERATORS = ("include", "exclude")
+
+# Benchmarks seeded on an empty table. "fallback" is the chain of filters: the
+# first one with a non-zero total is the benchmark value. Within a filter,
+# different fields are AND-ed and the values of one field are alternatives.
+DEFAULT_BENCHMARKS = [
+    {
+        "code": "ricavi_u0100",
+        "label": "A1) Ricavi delle vendite e delle prestazioni",
+        "pct_min": 1, "pct_max": 3, "pct_default": 2,
+        "sign": 1,
+        "fallback": [{"include": {"sublead": ["U0100"]}}],
+    },
+    {
+        "code": "totale_attivo",
+        "label": "Totale attivo",
+        "pct_min": 1, "pct_max": 3, "pct_default": 2,
+        "sign": 1,
+        "fallback": [{"include": {"tipo": ["ATTIVO"]}}],
+    },
+    {
+        "code": "patrimonio_netto",
+        "label": "Patrimonio netto",
+        "pct_min": 3, "pct_max": 5, "pct_default": 4,
+        "sign": 1,
+        "fallback": [
+            {"include": {"lead": ["L PATRIMONIO NETTO"]}},
+            {"include": {"lead": ["L"]}},
+        ],
+    },
+    {
+        "code": "reddito_ante_imposte",
+        "label": "Reddito ante imposte",
+        "pct_min": 3, "pct_max": 7, "pct_default": 5,
+        "sign": 1,
+        "fallback": [{"include": {"tipo": ["CE"]}, "exclude": {"lead": ["YF"]}}],
+    },
+]
+
+# Slider ranges of page 05, the scenario axes of the sensitivity grid
+OPERATING_PCTS = tuple(range(60, 81))
+TRIVIAL_PCTS = tuple(range(5, 16))
+DEFAULT_OPERATING_PCT = 75
+DEFAULT_TRIVIAL_PCT = 10
+
+# Criteria table of page 05 (one row per benchmark)
+CRITERIA_COLUMNS = ["Voce", "Valore base", "% min", "% max", "% selezionata", "Importo calcolato", "Selezione"]
+
+SCENARIO_COLUMNS = [
+    "fiscal_year", "code", "Voce", "% selezionata", "% operativa", "% trascurabili",
+    "Materialita generale", "Materialita operativa", "Errori trascurabili",
+]
+
+# Component materiality allocation methods (ISA 600), key -> label
+ALLOCATION_METHODS = {
+    "proportional": "Proporzionale",
+    "sqrt": "Radice quadrata",
+    "fixed": "Percentuale fissa",
+}
+
+_CODE_PATTERN = re.compile(r"^[a-z][a-z0-9_]*$")
+
+
+def _norm(value):
+    return str(value or "").strip().upper()
+
+
+def validate_benchmark(benchmark):
+    code = benchmark.get("code", "")
+    if not _CODE_PATTERN.match(str(code)):
+        raise ValueError(f"Codice benchmark non valido: {code!r} (minuscole, cifre e _)")
+    if benchmark.get("sign", 1) not in (1, -1):
+        raise ValueError(f"Segno del benchmark {code} non valido: {benchmark.get('sign')}")
+    if not benchmark.get("fallback"):
+        raise ValueError(f"Il benchmark {code} non ha filtri")
+    for step in benchmark["fallback"]:
+        for operator, filters in step.items():
+            if operator not in BENCHMARK_OPERATORS:
+                raise ValueError(f"Operatore non valido nel benchmark {code}: {operator}")
+            for field, values in filters.items():
+                if field not in BENCHMARK_FIELDS:
+                    raise ValueError(f"Campo non valido nel benchmark {code}: {field}")
+                if not values:
+                    raise ValueError(f"Filtro {operator} {field} vuoto nel benchmark {code}")
+
+
+def ensure_default_benchmarks(conn):
+    """
+    Inserisce i benchmark predefiniti se la tabella è vuota.
+    """
+    if conn.execute("SELECT COUNT(*) FROM materiality_benchmark").fetchone()[0]:
+        return
+    for position, benchmark in enumerate(DEFAULT_BENCHMARKS):
+        save_benchmark(conn, benchmark, position)
+
+
+def save_benchmark(conn, benchmark, position):
+    """
+    Inserisce (o sostituisce, per codice) un benchmark con le sue regole.
+    """
+    validate_benchmark(benchmark)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM materiality_benchmark_rule WHERE benchmark_id IN (SELECT id FROM materiality_benchmark WHERE code = ?)", (benchmark["code"],))
+    cur.execute("DELETE FROM materiality_benchmark WHERE code = ?", (benchmark["code"],))
+    cur.execute(
+        """
+        INSERT INTO materiality_benchmark (code, label, position, sign, pct_min, pct_max, pct_default)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            benchmark["code"], benchmark["label"], position, benchmark.get("sign", 1),
+            benchmark["pct_min"], benchmark["pct_max"], benchmark["pct_default"],
+        ),
+    )
+    benchmark_id = cur.lastrowid
+    cur.executemany(
+        """
+        INSERT INTO materiality_benchmark_rule (benchmark_id, fallback_rank, field, operator, value)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [
+            (benchmark_id, rank, field, operator, _norm(value))
+            for rank, step in enumerate(benchmark["fallback"])
+            for operator, filters in step.items()
+            for field, values in filters.items()
+            for value in values
+        ],
+    )
+    bump_data_version(conn)
+    conn.commit()
+    return benchmark_id
+
+
+def load_benchmarks(conn):
+    """
+    Benchmark attivi in ordine di posizione, nella stessa forma di DEFAULT_BENCHMARKS.
+    """
+    df_bench = pd.read_sql(
+        """
+        SELECT id, code, label, sign, pct_min, pct_max, pct_default
+        FROM materiality_benchmark
+        WHERE is_active = 1
+        ORDER BY position, id
+        """,
+        conn,
+    )
+    df_rules = pd.read_sql(
+        """
+        SELECT benchmark_id, fallback_rank, field, operator, value
+        FROM materiality_benchmark_rule
+        ORDER BY benchmark_id, fallback_rank, id
+        """,
+        conn,
+    )
+    rules_by_benchmark = {key: df for key, df in df_rules.groupby("benchmark_id", sort=False)}
+    benchmarks = []
+    for row in df_bench.to_dict("records"):
+        fallback = []
+        df_own = rules_by_benchmark.get(row["id"], df_rules.iloc[0:0])
+        for _, df_step in df_own.groupby("fallback_rank", sort=True):
+            step = {}
+            for rule in df_step.to_dict("records"):
+                step.setdefault(rule["operator"], {}).setdefault(rule["field"], []).append(rule["value"])
+            fallback.append(step)
+        benchmarks.append({
+            "code": row["code"],
+            "label": row["label"],
+            "pct_min": int(row["pct_min"]),
+            "pct_max": int(row["pct_max"]),
+            "pct_default": int(row["pct_default"]),
+            "sign": int(row["sign"]),
+            "fallback": fallback,
+        })
+    return benchmarks
+
+
+def _step_condition(step, params):
+    # Condition on the stored normalized keys (ddl.LEAD_KEY_COLUMNS); values are bound, not inlined
+    clauses = []
+    for operator, filters in step.items():
+        for field, values in filters.items():
+            placeholders = ", ".join("?" for _ in values)
+            keyword = "IN" if operator == "include" else "NOT IN"
+            clauses.append(f"ls.{field}_key {keyword} ({placeholders})")
+            params.extend(_norm(v) for v in values)
+    return " AND ".join(clauses) or "1 = 1"
+
+
+def compile_benchmark_query(benchmarks, by_entity=False, schema_version_id=None, derived=False, adjusted=False):
+    """
+    Una sola query per tutti i benchmark: le condizioni sono valutate una volta
+    per sublead dello schema di reporting (flag 0/1; con derived le condizioni
+    usano i codici dello schema derivato, riportati alle sublead primarie) e le righe TB sono lette in un
+    unico passaggio come SUM(importo * flag). Con by_entity il raggruppamento è
+    per (entità, esercizio) nello stesso passaggio; con adjusted le righe TB
+    includono le rettifiche registrate. Ritorna (sql, params).
+    """
+    if not benchmarks:
+        raise ValueError("Nessun benchmark di materialità definito")
+    params = [schema_version_id]
+    flag_cols, total_cols, value_cols = [], [], []
+    for benchmark in benchmarks:
+        validate_benchmark(benchmark)
+        code = benchmark["code"]
+        step_totals = []
+        for rank, step in enumerate(benchmark["fallback"]):
+            flag = f"{code}__{rank}"
+            flag_cols.append(f"CASE WHEN {_step_condition(step, params)} THEN 1 ELSE 0 END AS {flag}")
+            total_cols.append(f"SUM(tbl.closing_balance * f.{flag}) AS {flag}")
+            step_totals.append(f"NULLIF({flag}, 0)")
+        value_cols.append(f"{benchmark['sign']} * COALESCE({', '.join(step_totals)}, 0) AS {code}")
+
+    entity_cols = "totals.legal_entity_id, le.entity_code, le.entity_name, " if by_entity else ""
+    entity_join = "JOIN legal_entity le ON le.id = totals.legal_entity_id" if by_entity else ""
+    # Flags drive the join (CROSS JOIN keeps them outermost): each sublead reaches
+    # its accounts through the active-mapping indexes, as in the drill-down explorer
+    sql = f"""
+        WITH {report_sublead_cte(derived)},
+        {tb_line_cte(adjusted)},
+        sublead_flags AS MATERIALIZED (
+            SELECT ls.source_sublead AS sublead,
+                   {", ".join(flag_cols)}
+            FROM report_sublead ls
+        ),
+        totals AS (
+            SELECT {"tbh.legal_entity_id, " if by_entity else ""}tbh.fiscal_year,
+                   {", ".join(total_cols)}
+            FROM sublead_flags f
+            CROSS JOIN account_lead_mapping m
+            JOIN tb_line tbl ON tbl.gl_account_id = m.gl_account_id
+            JOIN trial_balance_header tbh ON tbh.id = tbl.trial_balance_id
+            WHERE m.sublead = f.sublead
+              AND m.is_active = 1
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM account_lead_mapping newer
+                  WHERE newer.gl_account_id = m.gl_account_id
+                    AND newer.is_active = 1
+                    AND (newer.schema_version_id > m.schema_version_id
+                         OR (newer.schema_version_id = m.schema_version_id AND newer.id > m.id))
+              )
+            GROUP BY {"tbh.legal_entity_id, " if by_entity else ""}tbh.fiscal_year
+        )
+        SELECT {entity_cols}fiscal_year,
+               {", ".join(value_cols)}
+        FROM totals
+        {entity_join}
+        ORDER BY fiscal_year DESC{", le.entity_code" if by_entity else ""}
+    """
+    return sql, params
+
+
+def load_benchmark_values(conn, benchmarks, by_entity=False, schema_version_id=None, adjusted=False):
+    """
+    Valore di ogni benchmark per esercizio (o per entità ed esercizio con
+    by_entity): una colonna per codice, anni decrescenti. schema_version_id
+    sceglie lo schema di reporting (None = ultimo primario); adjusted aggiunge
+    le rettifiche registrate.
+    """
+    derived, schema_param = report_schema_params(conn, schema_version_id)
+    sql, params = compile_benchmark_query(
+        benchmarks, by_entity=by_entity, schema_version_id=schema_param, derived=derived, adjusted=adjusted
+    )
+    return pd.read_sql(sql, conn, params=params)
+
+
+def _to_int_series(series, default_value):
+    return pd.to_numeric(series, errors="coerce").fillna(default_value).round(0).astype(int)
+
+
+def default_criteria(benchmarks):
+    """
+    Una riga criteri per benchmark, nell'ordine configurato, con la % di default.
+    """
+    return pd.DataFrame(
+        [
+            {
+                "Voce": b["label"],
+                "Valore base": 0,
+                "% min": b["pct_min"],
+                "% max": b["pct_max"],
+                "% selezionata": b["pct_default"],
+                "Importo calcolato": 0,
+                "Selezione": False,
+            }
+            for b in benchmarks
+        ],
+        columns=CRITERIA_COLUMNS,
+    )
+
+
+def normalize_criteria(df_criteria, basi_map):
+    """
+    Riallinea la tabella criteri: % selezionata intera entro i limiti, Selezione
+    booleana, valore base (assoluto, intero) e importo calcolato dalle basi.
+    """
+    df = df_criteria.copy()
+    df["% min"] = _to_int_series(df["% min"], 0)
+    df["% max"] = _to_int_series(df["% max"], 100)
+    df["% selezionata"] = pd.to_numeric(df["% selezionata"], errors="coerce")
+    df["% selezionata"] = df["% selezionata"].fillna(df["% min"])
+    df["% selezionata"] = df["% selezionata"].clip(lower=df["% min"], upper=df["% max"]).round(0).astype(int)
+    df["Selezione"] = df["Selezione"].fillna(False).astype(bool)
+    df["Valore base"] = df["Voce"].map(basi_map).fillna(0.0).abs().round(0).astype(int)
+    df["Importo calcolato"] = (df["Valore base"] * df["% selezionata"] / 100).round(0).astype(int)
+    return df[CRITERIA_COLUMNS]
+
+
+def criteria_table(benchmarks, basi_map, selections=None):
+    """
+    Tabella criteri per i benchmark: le scelte salvate (righe Voce, % selezionata,
+    Selezione, es. da editor o decisione) sostituiscono i default, poi normalize_criteria.
+    """
+    df = default_criteria(benchmarks)
+    if selections is not None:
+        df_selections = pd.DataFrame(selections)
+        if not df_selections.empty and "Voce" in df_selections.columns:
+            df_selections = df_selections.set_index("Voce")
+            for col in ["% selezionata", "Selezione"]:
+                if col in df_selections.columns:
+                    df[col] = df["Voce"].map(df_selections[col]).fillna(df[col])
+    return normalize_criteria(df, basi_map)
+
+
+def materiality_results(df_criteria, pct_operativa=DEFAULT_OPERATING_PCT, pct_trascurabili=DEFAULT_TRIVIAL_PCT):
+    """
+    Materialità generale (media degli importi dei criteri selezionati), operativa ed
+    errori trascurabili, con le chiavi di save_decision. None se nessun criterio è selezionato.
+    """
+    importi_selezionati = df_criteria.loc[df_criteria["Selezione"], "Importo calcolato"]
+    if importi_selezionati.empty:
+        return None
+    media_materialita = int(round(importi_selezionati.mean(), 0))
+    materialita_operativa = int(round(media_materialita * pct_operativa / 100, 0))
+    return {
+        "materialita_generale": media_materialita,
+        "pct_materialita_operativa": pct_operativa,
+        "materialita_operativa": materialita_operativa,
+        "pct_errori_trascurabili": pct_trascurabili,
+        "errori_trascurabili": int(round(materialita_operativa * pct_trascurabili / 100, 0)),
+    }
+
+
+def materiality_scenarios(df_values, benchmarks, operating_pcts=OPERATING_PCTS, trivial_pcts=TRIVIAL_PCTS):
+    """
+    Griglia completa degli scenari in un solo passaggio vettoriale: esercizio x
+    benchmark x % ammessa x % operativa x % trascurabili. Stessi arrotondamenti
+    della pagina 05 (base e importi interi, arrotondamento al pari come round()).
+    Ritorna un DataFrame lungo con le sole % ammesse per ciascun benchmark.
+    """
+    if not benchmarks or df_values.empty:
+        return pd.DataFrame(columns=SCENARIO_COLUMNS)
+    codes = [b["code"] for b in benchmarks]
+    pct_min = np.array([b["pct_min"] for b in benchmarks])
+    pct_max = np.array([b["pct_max"] for b in benchmarks])
+    pcts = np.arange(pct_min.min(), pct_max.max() + 1)
+    operating = np.asarray(operating_pcts)
+    trivial = np.asarray(trivial_pcts)
+
+    # Axes: (year, benchmark, pct, operating, trivial)
+    base = np.rint(np.abs(df_values[codes].fillna(0).to_numpy(dtype="float64")))
+    general = np.rint(base[:, :, None] * pcts / 100)
+    operating_amount = np.rint(general[..., None] * operating / 100)
+    trivial_amount = np.rint(operating_amount[..., None] * trivial / 100)
+
+    shape = trivial_amount.shape
+    allowed = (pcts >= pct_min[:, None]) & (pcts <= pct_max[:, None])
+    keep = np.broadcast_to(allowed[None, :, :, None, None], shape).ravel()
+    idx = [axis.ravel()[keep] for axis in np.indices(shape)]
+    labels = np.array([b["label"] for b in benchmarks], dtype=object)
+    return pd.DataFrame({
+        "fiscal_year": df_values["fiscal_year"].to_numpy()[idx[0]],
+        "code": np.array(codes, dtype=object)[idx[1]],
+        "Voce": labels[idx[1]],
+        "% selezionata": pcts[idx[2]],
+        "% operativa": operating[idx[3]],
+        "% trascurabili": trivial[idx[4]],
+        "Materialita generale": np.broadcast_to(general[..., None, None], shape).ravel()[keep].astype("int64"),
+        "Materialita operativa": np.broadcast_to(operating_amount[..., None], shape).ravel()[keep].astype("int64"),
+        "Errori trascurabili": trivial_amount.ravel()[keep].astype("int64"),
+    })
+
+
+def allocate_component_materiality(df_components, base_col, group_materiality, method="proportional", cap_pct=100, fixed_pct=50):
+    """
+    Materialità delle componenti, vettoriale su tutte le righe (componente x esercizio):
+    - proportional: materialità di gruppo x quota della base della componente;
+    - sqrt: materialità di gruppo x radice della quota (più alta per le componenti piccole);
+    - fixed: percentuale fissa della materialità di gruppo.
+    Ogni importo è limitato a cap_pct% della materialità di gruppo.
+    group_materiality: scalare o valori allineati alle righe.
+    """
+    if method not in ALLOCATION_METHODS:
+        raise ValueError(f"Metodo di allocazione non valido: {method}")
+    if not 0 < cap_pct <= 100:
+        raise ValueError(f"Tetto della materialità di componente non valido: {cap_pct}")
+
+    base = df_components[base_col].fillna(0).abs().to_numpy(dtype="float64")
+    period = df_components["fiscal_year"] if "fiscal_year" in df_components.columns else pd.Series(0, index=df_components.index)
+    total = pd.Series(base, index=df_components.index).groupby(period.to_numpy()).transform("sum").to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = np.where(total > 0, base / total, 0.0)
+    group = np.broadcast_to(np.asarray(group_materiality, dtype="float64"), base.shape)
+
+    if method == "proportional":
+        allocated = group * share
+    elif method == "sqrt":
+        allocated = group * np.sqrt(share)
+    else:
+        allocated = group * fixed_pct / 100
+    cap = group * cap_pct / 100
+
+    result = df_components.copy()
+    result["Quota %"] = share * 100
+    result["Materialita di gruppo"] = np.rint(group).astype("int64")
+    result["Materialita componente"] = np.rint(np.minimum(allocated, cap)).astype("int64")
+    result["Limitata dal tetto"] = allocated > cap
+    return result
+
+
+def _decision_schema_id(conn, schema_version_id):
+    # Stored on the decision: the derived schema id, NULL for the primary schema
+    derived, schema_param = report_schema_params(conn, schema_version_id)
+    return schema_param if derived else None
+
+
+def save_decision(
+    conn, legal_entity_id, fiscal_year, section, criteria, bases, results, note,
+    data_version=None, schema_version_id=None, adjusted=False,
+):
+    """
+    Salva una nuova versione della decisione per (entità, esercizio, sezione).
+    criteria: righe dell'editor (Voce, % selezionata, Selezione); bases: {voce: valore};
+    results: importi e percentuali calcolati; schema_version_id e adjusted: schema
+    di reporting (None = primario) e rettifiche con cui sono state calcolate le basi.
+    Ritorna il numero di versione.
+    """
+    schema_id = _decision_schema_id(conn, schema_version_id)
+    cur = conn.cursor()
+    # Next version computed inside the INSERT: concurrent saves cannot pick the same one
+    cur.execute(
+        """
+        INSERT INTO materiality_decision (
+            legal_entity_id, fiscal_year, section, version, criteria_json, bases_json,
+            materialita_generale, pct_materialita_operativa, materialita_operativa,
+            pct_errori_trascurabili, errori_trascurabili, note, data_version,
+            schema_version_id, adjusted, created_at
+        )
+        SELECT ?, ?, ?, COALESCE(MAX(version), 0) + 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+        FROM materiality_decision
+        WHERE legal_entity_id IS ? AND fiscal_year = ? AND section = ?
+        """,
+        (
+            legal_entity_id, int(fiscal_year), section,
+            json.dumps(criteria), json.dumps(bases),
+            results.get("materialita_generale"), results.get("pct_materialita_operativa"),
+            results.get("materialita_operativa"), results.get("pct_errori_trascurabili"),
+            results.get("errori_trascurabili"), note, data_version,
+            schema_id, int(bool(adjusted)),
+            datetime.now().isoformat(timespec="seconds"),
+            legal_entity_id, int(fiscal_year), section,
+        ),
+    )
+    version = conn.execute("SELECT version FROM materiality_decision WHERE id = ?", (cur.lastrowid,)).fetchone()[0]
+    conn.commit()
+    return version
+
+
+def load_latest_decision(conn, legal_entity_id, fiscal_year, section, schema_version_id=None, adjusted=False):
+    """
+    Ultima versione della decisione calcolata nello schema di reporting indicato
+    (None = primario) e con o senza rettifiche, o None: le basi salvate valgono
+    solo per quelle impostazioni.
+    """
+    cur = conn.execute(
+        """
+        SELECT *
+        FROM materiality_decision
+        WHERE legal_entity_id IS ? AND fiscal_year = ? AND section = ?
+          AND schema_version_id IS ? AND adjusted = ?
+        ORDER BY version DESC
+        LIMIT 1
+        """,
+        (legal_entity_id, int(fiscal_year), section, _decision_schema_id(conn, schema_version_id), int(bool(adjusted))),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    decision = dict(zip([d[0] for d in cur.description], row))
+    decision["criteria"] = json.loads(decision.pop("criteria_json"))
+    decision["bases"] = json.loads(decision.pop("bases_json"))
+    return decision
+
+
+def load_reference_decision(conn, legal_entity_id, fiscal_year):
+    """
+    Decisione di riferimento per le fasi successive: la definitiva se salvata,
+    altrimenti la preliminare, o None. Come nei report, basi sullo schema
+    primario senza rettifiche.
+    """
+    decision = load_latest_decision(conn, legal_entity_id, fiscal_year, "definitiva")
+    if decision is None:
+        decision = load_latest_decision(conn, legal_entity_id, fiscal_year, "preliminare")
+    return decision
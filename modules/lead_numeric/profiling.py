@@ -0,0 +1,279 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+# Rolling log of the slowest reruns, kept per page
+PROFILE_LOG_PATH = Path(os.environ.get("AAP_PROFILE_LOG", "data/profiling.jsonl"))
+SLOWEST_RERUNS_PER_PAGE = 20
+# Per rerun: how many queries the log keeps, and how much of their SQL text
+LOGGED_QUERIES = 10
+SQL_TEXT_CHARS = 400
+
+_local = threading.local()
+_log_lock = threading.Lock()
+_WHITESPACE = re.compile(r"\s+")
+
+
+class PageRun:
+    """
+    Misure di un rerun di pagina: tempo totale, fasi (stage) e query SQL eseguite
+    dalle connessioni di get_conn nello stesso thread.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.seconds = None
+        self.stages = []
+        self.queries = []
+        self._start = time.perf_counter()
+        self._open_stages = []
+        self._previous = None
+
+    def current_stage(self):
+        return self._open_stages[-1]["stage"] if self._open_stages else None
+
+    def add_query(self, sql, seconds, rows):
+        entry = {
+            "sql": _WHITESPACE.sub(" ", sql).strip()[:SQL_TEXT_CHARS],
+            "seconds": seconds,
+            "rows": max(rows, 0),
+            "stage": self.current_stage(),
+        }
+        self.queries.append(entry)
+        return entry
+
+    def to_record(self, max_queries=LOGGED_QUERIES):
+        slowest = sorted(self.queries, key=lambda q: q["seconds"], reverse=True)[:max_queries]
+        return {
+            "page": self.page,
+            "started": self.started,
+            "seconds": round(self.seconds if self.seconds is not None else time.perf_counter() - self._start, 4),
+            "sql_seconds": round(sum(q["seconds"] for q in self.queries), 4),
+            "n_queries": len(self.queries),
+            "stages": [{**s, "seconds": round(s["seconds"], 4)} for s in self.stages],
+            "queries": [{**q, "seconds": round(q["seconds"], 4)} for q in slowest],
+        }
+
+
+def current_run():
+    return getattr(_local, "run", None)
+
+
+def start_page_run(page):
+    """
+    Apre le misure del rerun corrente della pagina (thread dello script).
+    """
+    run = PageRun(page)
+    run._previous = current_run()
+    _local.run = run
+    return run
+
+
+def finish_page_run(run):
+    """
+    Chiude le misure del rerun e le registra nel log dei rerun più lenti.
+    """
+    if run.seconds is None:
+        run.seconds = time.perf_counter() - run._start
+        _local.run = run._previous
+        try:
+            log_rerun(run)
+        except OSError:
+            # Diagnostics must never break the page
+            pass
+    return run
+
+
+@contextmanager
+def profiled_run(page):
+    """
+    Rerun a sé stante, per lavoro eseguito fuori dallo script della pagina
+    (es. i dati dei download generati al clic).
+    """
+    run = start_page_run(page)
+    try:
+        yield run
+    finally:
+        finish_page_run(run)
+
+
+@contextmanager
+def stage(name):
+    """
+    Fase misurata del rerun corrente; senza rerun attivo non misura nulla.
+    """
+    run = current_run()
+    if run is None:
+        yield
+        return
+    entry = {"stage": name, "depth": len(run._open_stages), "seconds": 0.0}
+    run.stages.append(entry)
+    run._open_stages.append(entry)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry["seconds"] = time.perf_counter() - start
+        run._open_stages.pop()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursore che registra testo SQL, durata e righe nel rerun corrente. SQLite lavora
+    anche durante il fetch: il suo tempo e le righe lette vanno alla stessa query.
+    """
+
+    _entry = None
+
+    def _timed(self, method, sql, *args):
+        run = current_run()
+        if run is None:
+            self._entry = None
+            return method(sql, *args)
+        start = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            self._entry = run.add_query(sql, time.perf_counter() - start, self.rowcount)
+
+    def _fetched(self, start, rows):
+        if self._entry is not None:
+            self._entry["seconds"] += time.perf_counter() - start
+            self._entry["rows"] += rows
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._timed(super().executescript, sql_script)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connessione SQLite (resta un sqlite3.Connection per pandas) i cui cursori
+    sono TimedCursor, anche per le scorciatoie execute della connessione.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def _read_log():
+    if not PROFILE_LOG_PATH.exists():
+        return []
+    records = []
+    with PROFILE_LOG_PATH.open(encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def log_rerun(run):
+    """
+    Aggiunge il rerun al log JSONL se è tra i SLOWEST_RERUNS_PER_PAGE più lenti
+    della sua pagina; il file è riscritto per intero (poche righe per pagina).
+    """
+    record = run.to_record()
+    with _log_lock:
+        records = _read_log()
+        same_page = sorted(
+            (r for r in records if r.get("page") == run.page),
+            key=lambda r: r.get("seconds", 0),
+            reverse=True,
+        )
+        if len(same_page) >= SLOWEST_RERUNS_PER_PAGE and record["seconds"] <= same_page[-1].get("seconds", 0):
+            return False
+        kept = [r for r in records if r.get("page") != run.page]
+        kept += sorted(same_page + [record], key=lambda r: r.get("seconds", 0), reverse=True)[:SLOWEST_RERUNS_PER_PAGE]
+
+        PROFILE_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = PROFILE_LOG_PATH.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as fh:
+            for r in kept:
+                fh.write(json.dumps(r, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, PROFILE_LOG_PATH)
+    return True
+
+
+def load_slowest_reruns(page=None):
+    """
+    Rerun registrati nel log, dal più lento; con `page` solo quelli della pagina.
+    """
+    with _log_lock:
+        records = _read_log()
+    if page is not None:
+        records = [r for r in records if r.get("page") == page]
+    return sorted(records, key=lambda r: r.get("seconds", 0), reverse=True)
+
+
+def render_diagnostics_panel(run):
+    """
+    Pannello "Diagnostica" nella sidebar (attivabile): fasi e query del rerun
+    corrente e rerun più lenti registrati per la pagina.
+    """
+    import streamlit as st
+
+    if not st.sidebar.toggle("Diagnostica", key="diagnostica_attiva"):
+        return
+    record = run.to_record(max_queries=len(run.queries))
+    with st.sidebar.expander("Diagnostica rerun", expanded=True):
+        st.caption(
+            f"Totale {record['seconds']:.3f} s — SQL {record['sql_seconds']:.3f} s "
+            f"in {record['n_queries']} query"
+        )
+        if record["stages"]:
+            df_stages = pd.DataFrame(record["stages"])
+            df_stages["stage"] = ["  " * d + s for d, s in zip(df_stages["depth"], df_stages["stage"])]
+            st.dataframe(df_stages[["stage", "seconds"]], hide_index=True)
+        if record["queries"]:
+            st.dataframe(pd.DataFrame(record["queries"])[["seconds", "rows", "stage", "sql"]], hide_index=True)
+
+        slowest = load_slowest_reruns(run.page)
+        if slowest:
+            st.markdown("**Rerun più lenti**")
+            st.dataframe(
+                pd.DataFrame(slowest)[["started", "seconds", "sql_seconds", "n_queries"]],
+                hide_index=True,
+            )
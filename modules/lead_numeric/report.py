@@ -0,0 +1,202 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from modules.lead_numeric import db
+from modules.lead_numeric.bilancio import bilancio_excel_sheets, compute_bilancio_views, load_bilancio_dataset
+from modules.lead_numeric.export_docx import build_docx_by_lead
+from modules.lead_numeric.export_materiality import MATERIALITY_EXPORT_BUILDERS, materiality_export_frames
+from modules.lead_numeric.export_pdf import _pool_context, build_pdf_by_lead
+from modules.lead_numeric.export_xlsx import write_bilancio_xlsx
+from modules.lead_numeric.formatting import amount_unit_params
+from modules.lead_numeric.materiality import criteria_table, load_benchmarks, load_latest_decision
+
+REPORT_FORMATS = ("xlsx", "pdf", "docx")
+
+# Materiality sections as in page 05 (key -> label)
+MATERIALITY_SECTIONS = {
+    "preliminare": "Materialita preliminare",
+    "definitiva": "Materialita definitiva",
+}
+
+
+def _bilancio_xlsx(views, latest_year, previous_year, amount_scale, amount_decimals):
+    return write_bilancio_xlsx(
+        bilancio_excel_sheets(views),
+        amount_cols=[f'importo_{latest_year}', f'importo_{previous_year}', "differenza_valore"],
+        amount_scale=amount_scale,
+        amount_decimals=amount_decimals,
+    )
+
+
+def _bilancio_by_lead(builder, **extra):
+    def build(views, latest_year, previous_year, amount_scale, amount_decimals):
+        return builder(
+            df_source=views["pivot"],
+            latest_col=f'importo_{latest_year}',
+            previous_col=f'importo_{previous_year}',
+            latest_year=latest_year,
+            previous_year=previous_year,
+            amount_scale=amount_scale,
+            amount_decimals=amount_decimals,
+            **extra,
+        )
+    return build
+
+
+# Format -> builder(views, latest_year, previous_year, amount_scale, amount_decimals).
+# The PDF renders in the worker process itself: the fan-out is already per entity.
+BILANCIO_REPORT_BUILDERS = {
+    "xlsx": _bilancio_xlsx,
+    "pdf": _bilancio_by_lead(build_pdf_by_lead, max_workers=1),
+    "docx": _bilancio_by_lead(build_docx_by_lead),
+}
+
+
+def parse_formats(value):
+    """
+    Formati da una lista separata da virgole (es. "pdf,xlsx"), senza duplicati.
+    """
+    formats = []
+    for fmt in str(value).split(","):
+        fmt = fmt.strip().lower()
+        if not fmt:
+            continue
+        if fmt not in REPORT_FORMATS:
+            raise ValueError(f"Formato non supportato: {fmt}. Ammessi: {', '.join(REPORT_FORMATS)}")
+        if fmt not in formats:
+            formats.append(fmt)
+    if not formats:
+        raise ValueError("Indicare almeno un formato.")
+    return formats
+
+
+def load_entities(conn):
+    return [(int(r[0]), r[1]) for r in conn.execute("SELECT id, entity_code FROM legal_entity ORDER BY entity_code")]
+
+
+def load_report_years(conn):
+    return [int(r[0]) for r in conn.execute("SELECT DISTINCT fiscal_year FROM trial_balance_header ORDER BY fiscal_year DESC")]
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def _materiality_report(decision, benchmarks, section):
+    # The saved decision as page 05 shows it: its criteria on its own snapshot of the bases
+    df_criteria = criteria_table(benchmarks, decision["bases"], selections=decision["criteria"])
+    results = {
+        key: decision[key]
+        for key in (
+            "materialita_generale", "pct_materialita_operativa", "materialita_operativa",
+            "pct_errori_trascurabili", "errori_trascurabili",
+        )
+    }
+    return materiality_export_frames(
+        df_criteria, results, MATERIALITY_SECTIONS[section], decision["fiscal_year"], decision["note"] or ""
+    )
+
+
+def build_entity_report(entity_code, latest_year, previous_year, formats, out_dir, amount_unit="euro", sections=(), db_path=None):
+    """
+    Report di un'entità in out_dir/<entità>/: riepilogo di bilancio nei formati
+    richiesti e, per le sezioni indicate, la decisione di materialità salvata.
+    Ritorna {"files": [...], "skipped": [...]}; ValueError se l'entità non ha dati.
+    """
+    if db_path is not None:
+        db.DB_PATH = Path(db_path)
+    amount_scale, amount_decimals = amount_unit_params(amount_unit)
+
+    conn = db.get_conn()
+    try:
+        row = conn.execute("SELECT id FROM legal_entity WHERE entity_code = ?", (entity_code,)).fetchone()
+        if row is None:
+            raise ValueError(f"Entità non trovata: {entity_code}")
+        legal_entity_id = int(row[0])
+        df = load_bilancio_dataset(conn, legal_entity_id)
+        decisions = {section: load_latest_decision(conn, legal_entity_id, latest_year, section) for section in sections}
+        benchmarks = load_benchmarks(conn) if sections else []
+    finally:
+        conn.close()
+
+    if not df["fiscal_year"].isin([latest_year, previous_year]).any():
+        raise ValueError(f"Nessun dato di bilancio per {entity_code} negli esercizi {latest_year}/{previous_year}.")
+
+    entity_dir = Path(out_dir) / entity_code
+    files, skipped = [], []
+    views = compute_bilancio_views(df, latest_year, previous_year)
+    for fmt in formats:
+        data = BILANCIO_REPORT_BUILDERS[fmt](views, latest_year, previous_year, amount_scale, amount_decimals)
+        name = f"bilancio_riepilogo_{latest_year}_vs_{previous_year}.{fmt}"
+        if data is None:
+            skipped.append(f"{name}: libreria di export non installata")
+        else:
+            files.append(_write(entity_dir / name, data))
+
+    for section, decision in decisions.items():
+        if decision is None:
+            skipped.append(f"materialita {section} {latest_year}: nessuna decisione salvata")
+            continue
+        df_export, df_summary = _materiality_report(decision, benchmarks, section)
+        for fmt in formats:
+            data = MATERIALITY_EXPORT_BUILDERS[fmt](df_export, df_summary)
+            name = f"materialita_{section}_{latest_year}.{fmt}"
+            if data is None:
+                skipped.append(f"{name}: libreria di export non installata")
+            else:
+                files.append(_write(entity_dir / name, data))
+    return {"files": files, "skipped": skipped}
+
+
+def _report_task(kwargs):
+    # Pool worker: one entity's failure is reported, it does not stop the others
+    try:
+        result = build_entity_report(**kwargs)
+        result["error"] = None
+    except Exception as e:
+        result = {"files": [], "skipped": [], "error": f"{type(e).__name__}: {e}"}
+    result["entity_code"] = kwargs["entity_code"]
+    return result
+
+
+def run_reports(latest_year, previous_year, formats, out_dir, entity_codes=None, amount_unit="euro", sections=(), max_workers=None):
+    """
+    Report di più entità (default: tutte), una per processo del pool. Ritorna un
+    risultato per entità nell'ordine richiesto (file scritti, saltati, errore).
+    """
+    amount_unit_params(amount_unit)
+    unknown = [s for s in sections if s not in MATERIALITY_SECTIONS]
+    if unknown:
+        raise ValueError(f"Sezione di materialità non valida: {', '.join(unknown)}")
+
+    if entity_codes is None:
+        conn = db.get_conn()
+        try:
+            entity_codes = [code for _, code in load_entities(conn)]
+        finally:
+            conn.close()
+
+    tasks = [
+        {
+            "entity_code": code,
+            "latest_year": int(latest_year),
+            "previous_year": int(previous_year),
+            "formats": list(formats),
+            "out_dir": str(out_dir),
+            "amount_unit": amount_unit,
+            "sections": list(sections),
+            "db_path": str(db.DB_PATH),
+        }
+        for code in entity_codes
+    ]
+    if not tasks:
+        return []
+
+    workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context()) as pool:
+            return list(pool.map(_report_task, tasks))
+    return [_report_task(task) for task in tasks]
@@ -0,0 +1,244 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from modules.lead_numeric.export_xlsx import iter_frame_rows
+from modules.lead_numeric.mapping import MAPPING_CTE
+
+SAMPLING_METHODS = {
+    "mus": "Unità monetaria (MUS)",
+    "stratificato": "Stratificato per valore",
+}
+
+# Poisson reliability factors for zero expected errors and AICPA expansion
+# factors for the expected misstatement, by confidence level (%)
+CONFIDENCE_FACTORS = {80: 1.61, 90: 2.31, 95: 3.00, 99: 4.61}
+EXPANSION_FACTORS = {80: 1.3, 90: 1.5, 95: 1.6, 99: 1.9}
+
+DEFAULT_STRATA = 5
+SELECTION_COLS = ["line_id", "importo", "strato", "selezioni", "motivo"]
+DETAIL_COLS = ["entity_code", "fiscal_year", "account_code", "account_name", "lead", "sublead"]
+
+
+def load_population(conn, fiscal_year, lead=None, sublead=None, legal_entity_id=None) -> pd.DataFrame:
+    """
+    Popolazione da campionare: righe trial_balance_line non a zero dell'esercizio,
+    mappate su una lead o una sublead dello schema primario (line_id, importo).
+    Solo colonne numeriche, in ordine di id: la selezione è riproducibile a
+    parità di seme e di dati.
+    """
+    if not lead and not sublead:
+        raise ValueError("Indicare una lead o una sublead per definire la popolazione.")
+    filters = "".join(
+        [
+            " AND ls.lead = :lead" if lead else "",
+            " AND ls.sublead = :sublead" if sublead else "",
+        ]
+    )
+    entity_filter = " AND tbh.legal_entity_id = :entity_id" if legal_entity_id is not None else ""
+    df = pd.read_sql(
+        MAPPING_CTE.rstrip()
+        + f""",
+        population_sublead AS (
+            SELECT ls.sublead
+            FROM lead_structure ls
+            JOIN latest_schema s ON ls.schema_version_id = s.id
+            WHERE 1 = 1{filters}
+        )
+        SELECT tbl.id AS line_id, tbl.closing_balance AS importo
+        FROM population_sublead ps
+        JOIN valid_mapping vm ON vm.sublead = ps.sublead
+        JOIN trial_balance_line tbl ON tbl.gl_account_id = vm.gl_account_id
+        JOIN trial_balance_header tbh
+          ON tbh.id = tbl.trial_balance_id
+         AND tbh.fiscal_year = :fiscal_year{entity_filter}
+        WHERE tbl.closing_balance <> 0
+        ORDER BY tbl.id
+        """,
+        conn,
+        params={"fiscal_year": int(fiscal_year), "lead": lead, "sublead": sublead, "entity_id": legal_entity_id},
+    )
+    df["line_id"] = df["line_id"].astype("int64")
+    df["importo"] = df["importo"].astype("float64")
+    return df
+
+
+def sample_size(book_value, tolerable_misstatement, confidence=95, expected_misstatement=0.0) -> int:
+    """
+    Dimensione del campione MUS: valore contabile * fattore di affidabilità /
+    (errore tollerabile - errore atteso * fattore di espansione).
+    """
+    if confidence not in CONFIDENCE_FACTORS:
+        raise ValueError(f"Livello di confidenza non supportato: {confidence}. Ammessi: {list(CONFIDENCE_FACTORS)}")
+    if tolerable_misstatement is None or tolerable_misstatement <= 0:
+        raise ValueError("L'errore tollerabile deve essere maggiore di zero.")
+    margin = tolerable_misstatement - (expected_misstatement or 0) * EXPANSION_FACTORS[confidence]
+    if margin <= 0:
+        raise ValueError("Errore atteso troppo alto rispetto all'errore tollerabile.")
+    if book_value <= 0:
+        return 0
+    return int(math.ceil(book_value * CONFIDENCE_FACTORS[confidence] / margin))
+
+
+def _mus_positions(values, n, rng):
+    # Systematic selection on the cumulative value: one random start, then a
+    # fixed interval; a line is hit once per selection point it spans
+    cumulative = np.cumsum(values)
+    interval = cumulative[-1] / n
+    points = rng.uniform(0, interval) + interval * np.arange(n)
+    hits = np.searchsorted(cumulative, points, side="right")
+    positions, counts = np.unique(np.minimum(hits, len(values) - 1), return_counts=True)
+    return positions, counts, interval
+
+
+def _stratified_positions(values, n, strata, rng):
+    # Equal-value strata on the amount-sorted population: each stratum is a
+    # contiguous slice of the sort order. The sample is split in proportion to
+    # each stratum's value and drawn without replacement inside the slice
+    order = np.argsort(values, kind="stable")
+    cumulative = np.cumsum(values[order])
+    bounds = cumulative[-1] * np.arange(1, strata) / strata
+    sorted_stratum = np.searchsorted(bounds, cumulative, side="left")
+
+    counts = np.bincount(sorted_stratum, minlength=strata)
+    totals = np.bincount(sorted_stratum, weights=values[order], minlength=strata)
+    allocation = np.ceil(n * totals / totals.sum()).astype("int64")
+    allocation = np.minimum(np.where(counts > 0, np.maximum(allocation, 1), 0), counts)
+
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    picks = [
+        start + rng.choice(count, size=size, replace=False)
+        for start, count, size in zip(starts, counts, allocation)
+        if size
+    ]
+    sorted_positions = np.sort(np.concatenate(picks))
+    return order[sorted_positions], sorted_stratum[sorted_positions] + 1
+
+
+def draw_sample(
+    df_population,
+    method="mus",
+    tolerable_misstatement=None,
+    confidence=95,
+    expected_misstatement=0.0,
+    seed=0,
+    strata=DEFAULT_STRATA,
+):
+    """
+    Estrae il campione dalla popolazione di load_population. Le righe con valore
+    assoluto oltre la soglia (intervallo MUS o errore tollerabile) sono voci
+    chiave e sempre selezionate; il resto è campionato con il seme indicato.
+    Ritorna (selezione con SELECTION_COLS, dict dei parametri).
+    """
+    if method not in SAMPLING_METHODS:
+        raise ValueError(f"Metodo di campionamento non valido: {method}. Ammessi: {list(SAMPLING_METHODS)}")
+    rng = np.random.default_rng(int(seed))
+    amounts = df_population["importo"].to_numpy(dtype="float64")
+    values = np.abs(amounts)
+    book_value = float(values.sum())
+    n = sample_size(book_value, tolerable_misstatement, confidence, expected_misstatement)
+
+    if n == 0:
+        positions = np.empty(0, dtype="int64")
+        strata_col = selections = np.empty(0, dtype="int64")
+        key_items = np.zeros(0, dtype=bool)
+        threshold = None
+    elif method == "mus":
+        positions, selections, threshold = _mus_positions(values, n, rng)
+        strata_col = np.zeros(len(positions), dtype="int64")
+        key_items = values[positions] >= threshold
+    else:
+        threshold = float(tolerable_misstatement)
+        key_mask = values >= threshold
+        rest = np.flatnonzero(~key_mask)
+        rest_value = float(values[rest].sum())
+        n_rest = min(sample_size(rest_value, tolerable_misstatement, confidence, expected_misstatement), len(rest))
+        if n_rest:
+            rest_selected, rest_strata = _stratified_positions(values[rest], n_rest, strata, rng)
+        else:
+            rest_selected = rest_strata = np.empty(0, dtype="int64")
+        key_positions = np.flatnonzero(key_mask)
+        positions = np.concatenate([key_positions, rest[rest_selected]])
+        strata_col = np.concatenate([np.zeros(len(key_positions), dtype="int64"), rest_strata])
+        key_items = np.concatenate([np.ones(len(key_positions), dtype=bool), np.zeros(len(rest_selected), dtype=bool)])
+        selections = np.ones(len(positions), dtype="int64")
+        order = np.argsort(positions, kind="stable")
+        positions, strata_col, key_items = positions[order], strata_col[order], key_items[order]
+
+    df_selection = pd.DataFrame(
+        {
+            "line_id": df_population["line_id"].to_numpy()[positions],
+            "importo": amounts[positions],
+            "strato": strata_col,
+            "selezioni": selections,
+            "motivo": np.where(key_items, "voce chiave", "campione"),
+        },
+        columns=SELECTION_COLS,
+    )
+    selected_value = float(values[positions].sum())
+    params = {
+        "metodo": SAMPLING_METHODS[method],
+        "seme": int(seed),
+        "confidenza": confidence,
+        "fattore_affidabilita": CONFIDENCE_FACTORS[confidence],
+        "errore_tollerabile": float(tolerable_misstatement),
+        "errore_atteso": float(expected_misstatement or 0),
+        "righe_popolazione": int(len(values)),
+        "valore_popolazione": book_value,
+        "dimensione_campione": n,
+        "soglia_voci_chiave": threshold,
+        "strati": strata if method == "stratificato" else None,
+        "righe_selezionate": int(len(df_selection)),
+        "voci_chiave": int(key_items.sum()),
+        "valore_selezionato": selected_value,
+        "copertura_percentuale": selected_value / book_value * 100 if book_value else None,
+    }
+    return df_selection, params
+
+
+def load_selection_details(conn, df_selection) -> pd.DataFrame:
+    """
+    Selezione con entità, conto e lead/sublead: le descrizioni sono lette solo
+    per le righe estratte, tramite una tabella temporanea di id.
+    """
+    conn.execute("DROP TABLE IF EXISTS temp.sample_line")
+    conn.execute("CREATE TEMP TABLE sample_line (line_id INTEGER PRIMARY KEY)")
+    conn.executemany(
+        "INSERT INTO sample_line (line_id) VALUES (?)",
+        ((int(line_id),) for line_id in df_selection["line_id"]),
+    )
+    df_details = pd.read_sql(
+        MAPPING_CTE
+        + """
+        SELECT sl.line_id, le.entity_code, tbh.fiscal_year, ga.account_code, ga.account_name, ls.lead, ls.sublead
+        FROM sample_line sl
+        JOIN trial_balance_line tbl ON tbl.id = sl.line_id
+        JOIN trial_balance_header tbh ON tbh.id = tbl.trial_balance_id
+        JOIN legal_entity le ON le.id = tbh.legal_entity_id
+        JOIN gl_account ga ON ga.id = tbl.gl_account_id
+        LEFT JOIN valid_mapping vm ON vm.gl_account_id = tbl.gl_account_id
+        LEFT JOIN latest_schema s ON 1=1
+        LEFT JOIN lead_structure ls
+          ON ls.schema_version_id = s.id
+         AND ls.sublead = vm.sublead
+        """,
+        conn,
+    )
+    conn.execute("DROP TABLE temp.sample_line")
+    return df_selection.merge(df_details, on="line_id", how="left")[DETAIL_COLS + SELECTION_COLS]
+
+
+def sampling_excel_sheets(df_details, params, population_label):
+    """
+    Fogli per write_bilancio_xlsx: selezione e parametri (seme compreso) per
+    ripetere l'estrazione.
+    """
+    df_params = pd.DataFrame(
+        [{"voce": "popolazione", "valore": population_label}]
+        + [{"voce": key, "valore": value} for key, value in params.items() if value is not None]
+    )
+    return [
+        ("Campione", DETAIL_COLS + SELECTION_COLS, iter_frame_rows(df_details)),
+        ("Parametri", ["voce", "valore"], iter_frame_rows(df_params)),
+    ]
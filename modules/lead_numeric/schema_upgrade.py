@@ -0,0 +1,350 @@
+import pandas as pd
+
+from modules.lead_numeric.db import bump_data_version, get_conn
+from modules.lead_numeric.ddl import init_db, latest_primary_schema_id
+from modules.lead_numeric.import_schema import read_schema_excel, write_schema_version
+
+# Position of a sublead in the hierarchy (a change = moved) and its other attributes
+HIERARCHY_COLS = ["tipo", "group_lead", "lead"]
+DETAIL_COLS = ["gruppo", "descrizione_cee", "segno_rpt"]
+STRUCTURE_COLS = ["sublead"] + HIERARCHY_COLS + DETAIL_COLS
+
+DIFF_STATES = ["invariata", "modificata", "spostata", "rinominata", "aggiunta", "rimossa"]
+RENAME_COLS = ["sublead_old", "sublead_new"]
+
+# Accounts with a valid mapping in a given schema version: latest active row per
+# account (up to that version) whose sublead exists in the version
+VERSION_MAPPING_CTE = """
+WITH version_latest AS (
+    SELECT gl_account_id, sublead, note
+    FROM (
+        SELECT m.*,
+               ROW_NUMBER() OVER (
+                   PARTITION BY m.gl_account_id
+                   ORDER BY m.schema_version_id DESC, m.id DESC
+               ) AS rn
+        FROM account_lead_mapping m
+        WHERE m.is_active = 1
+          AND m.schema_version_id <= :version_id
+    )
+    WHERE rn = 1
+),
+version_mapping AS (
+    SELECT vl.gl_account_id, vl.sublead, vl.note
+    FROM version_latest vl
+    JOIN lead_structure ls
+      ON ls.schema_version_id = :version_id
+     AND ls.sublead = vl.sublead
+)
+"""
+
+
+def load_schema_structure(conn, schema_version_id) -> pd.DataFrame:
+    return pd.read_sql(
+        f"SELECT {', '.join(STRUCTURE_COLS)} FROM lead_structure WHERE schema_version_id = ? ORDER BY gruppo, sublead",
+        conn,
+        params=(schema_version_id,),
+    )
+
+
+def mapped_accounts_by_sublead(conn, schema_version_id) -> pd.Series:
+    """
+    Numero di conti con mapping valido per sublead della versione indicata.
+    """
+    df = pd.read_sql(
+        VERSION_MAPPING_CTE + "SELECT sublead, COUNT(*) AS conti FROM version_mapping GROUP BY sublead",
+        conn,
+        params={"version_id": int(schema_version_id)},
+    )
+    return df.set_index("sublead")["conti"]
+
+
+def read_rename_table(excel_file, sheet_name=0) -> pd.DataFrame:
+    """
+    Tabella rinomine da Excel (colonne sublead_old, sublead_new); righe vuote ignorate.
+    """
+    df = pd.read_excel(excel_file, sheet_name=sheet_name, dtype=str)
+    df.columns = [str(c).strip() for c in df.columns]
+    missing = [c for c in RENAME_COLS if c not in df.columns]
+    if missing:
+        raise ValueError(f"Colonne mancanti nella tabella rinomine: {missing}")
+    df = df[RENAME_COLS].fillna("")
+    for col in RENAME_COLS:
+        df[col] = df[col].str.strip()
+    return df[(df["sublead_old"] != "") | (df["sublead_new"] != "")].reset_index(drop=True)
+
+
+def _validate_renames(df_renames, old_codes, new_codes):
+    errors = []
+    incomplete = df_renames[(df_renames["sublead_old"] == "") | (df_renames["sublead_new"] == "")]
+    if not incomplete.empty:
+        errors.append(f"righe incomplete: {len(incomplete)}")
+    duplicated = df_renames.loc[df_renames["sublead_old"].duplicated(), "sublead_old"].unique().tolist()
+    if duplicated:
+        errors.append(f"sublead di origine ripetute: {duplicated[:30]}")
+    unknown_old = sorted(set(df_renames["sublead_old"]) - set(old_codes) - {""})
+    if unknown_old:
+        errors.append(f"sublead inesistenti nella versione attuale: {unknown_old[:30]}")
+    unknown_new = sorted(set(df_renames["sublead_new"]) - set(new_codes) - {""})
+    if unknown_new:
+        errors.append(f"sublead inesistenti nella nuova versione: {unknown_new[:30]}")
+    if errors:
+        raise ValueError("Tabella rinomine non valida: " + "; ".join(errors))
+
+
+def _description_key(df):
+    return df["tipo"].fillna("").str.upper() + "|" + df["descrizione_cee"].fillna("").str.strip().str.upper()
+
+
+def _detect_renames(df_removed, df_added):
+    # 1:1 matches only: same tipo and description, unique on both sides
+    old_keys = _description_key(df_removed)
+    new_keys = _description_key(df_added)
+    old_unique = old_keys[~old_keys.duplicated(keep=False)]
+    new_unique = new_keys[~new_keys.duplicated(keep=False)]
+    pairs = pd.DataFrame({"key": old_unique.to_numpy(), "sublead_old": df_removed.loc[old_unique.index, "sublead"].to_numpy()}).merge(
+        pd.DataFrame({"key": new_unique.to_numpy(), "sublead_new": df_added.loc[new_unique.index, "sublead"].to_numpy()}),
+        on="key",
+    )
+    return pairs[RENAME_COLS]
+
+
+def _differs(df, cols):
+    changed = pd.Series(False, index=df.index)
+    for col in cols:
+        old, new = df[f"{col}_old"], df[f"{col}_new"]
+        changed |= ~((old == new) | (old.isna() & new.isna()))
+    return changed
+
+
+def diff_schema(df_old, df_new, df_renames=None, detect_renames=True, mapped_counts=None) -> pd.DataFrame:
+    """
+    Confronto tra due versioni dello schema (righe lead_structure), una riga per
+    sublead: invariata, modificata (descrizione/segno/gruppo), spostata (tipo,
+    group lead o lead), rinominata (da tabella rinomine o, con detect_renames, per
+    stessa descrizione), aggiunta o rimossa. mapped_counts: conti mappati per sublead old.
+    """
+    df_old = df_old[STRUCTURE_COLS].reset_index(drop=True)
+    df_new = df_new[STRUCTURE_COLS].reset_index(drop=True)
+    if df_renames is None:
+        df_renames = pd.DataFrame(columns=RENAME_COLS)
+    df_renames = df_renames[RENAME_COLS].astype(str)
+    _validate_renames(df_renames, df_old["sublead"], df_new["sublead"])
+
+    # Explicit renames first; then subleads keeping their code; then description matches
+    explicit = df_renames.assign(origine="tabella")
+    same_code = pd.DataFrame({"sublead_old": df_old["sublead"]})
+    same_code = same_code[same_code["sublead_old"].isin(df_new["sublead"]) & ~same_code["sublead_old"].isin(explicit["sublead_old"])]
+    same_code = same_code.assign(sublead_new=same_code["sublead_old"], origine="codice")
+    pairs = pd.concat([explicit, same_code], ignore_index=True)
+
+    if detect_renames:
+        df_removed = df_old[~df_old["sublead"].isin(pairs["sublead_old"])]
+        df_added = df_new[~df_new["sublead"].isin(pairs["sublead_new"])]
+        detected = _detect_renames(df_removed, df_added).assign(origine="descrizione")
+        pairs = pd.concat([pairs, detected], ignore_index=True)
+
+    df_pairs = (
+        pairs.merge(df_old.add_suffix("_old"), on="sublead_old", how="left")
+        .merge(df_new.add_suffix("_new"), on="sublead_new", how="left")
+    )
+    moved = _differs(df_pairs, HIERARCHY_COLS)
+    df_pairs["stato"] = "invariata"
+    df_pairs.loc[_differs(df_pairs, DETAIL_COLS), "stato"] = "modificata"
+    df_pairs.loc[moved, "stato"] = "spostata"
+    df_pairs.loc[df_pairs["origine"] != "codice", "stato"] = "rinominata"
+    df_pairs["posizione_cambiata"] = moved
+
+    df_removed = df_old[~df_old["sublead"].isin(pairs["sublead_old"])].add_suffix("_old")
+    df_removed = df_removed.assign(stato="rimossa", origine="", posizione_cambiata=False)
+    df_added = df_new[~df_new["sublead"].isin(pairs["sublead_new"])].add_suffix("_new")
+    df_added = df_added.assign(stato="aggiunta", origine="", posizione_cambiata=False)
+
+    df = pd.concat([df_pairs, df_removed, df_added], ignore_index=True)
+    counts = mapped_counts if mapped_counts is not None else pd.Series(dtype="int64")
+    df["conti_mappati"] = df["sublead_old"].map(counts).fillna(0).astype(int)
+    df["stato"] = pd.Categorical(df["stato"], categories=DIFF_STATES, ordered=True)
+
+    value_cols = [f"{col}_{side}" for col in HIERARCHY_COLS + DETAIL_COLS for side in ("old", "new")]
+    columns = ["stato", "sublead_old", "sublead_new", "origine", "posizione_cambiata", "conti_mappati"] + value_cols
+    return df[columns].sort_values(["stato", "sublead_old", "sublead_new"], na_position="last").reset_index(drop=True)
+
+
+def rename_pairs(df_diff) -> pd.DataFrame:
+    """
+    Coppie (sublead_old, sublead_new) con codice diverso da riportare nel mapping.
+    """
+    renamed = df_diff[df_diff["stato"] == "rinominata"]
+    return renamed[RENAME_COLS].reset_index(drop=True)
+
+
+def carry_forward_mappings(conn, old_schema_version_id, new_schema_version_id, df_renames=None) -> dict:
+    """
+    Riporta alla nuova versione schema il mapping valido di ogni conto nella versione
+    precedente, in un'unica INSERT ... SELECT: stessa sublead, oppure quella della
+    tabella rinomine. I conti già mappati nella nuova versione restano invariati.
+    Le crosswalk degli schemi derivati seguono le rinomine (ValueError se una
+    sublead risultante punterebbe a due destinazioni dello stesso schema).
+    Non esegue il commit. Ritorna i conteggi.
+    """
+    if df_renames is None:
+        df_renames = pd.DataFrame(columns=RENAME_COLS)
+    conn.execute("DROP TABLE IF EXISTS temp.schema_rename")
+    conn.execute("CREATE TEMP TABLE schema_rename (sublead_old TEXT PRIMARY KEY, sublead_new TEXT NOT NULL)")
+    conn.executemany(
+        "INSERT INTO schema_rename (sublead_old, sublead_new) VALUES (?, ?)",
+        df_renames[RENAME_COLS].itertuples(index=False, name=None),
+    )
+
+    params = {"version_id": int(old_schema_version_id), "new_version_id": int(new_schema_version_id)}
+    targets = """
+        FROM version_mapping vm
+        LEFT JOIN schema_rename r ON r.sublead_old = vm.sublead
+        LEFT JOIN lead_structure ls
+          ON ls.schema_version_id = :new_version_id
+         AND ls.sublead = COALESCE(r.sublead_new, vm.sublead)
+    """
+    mapped, renamed, lost = conn.execute(
+        VERSION_MAPPING_CTE
+        + """
+        SELECT COUNT(*),
+               COALESCE(SUM(r.sublead_old IS NOT NULL AND ls.id IS NOT NULL), 0),
+               COALESCE(SUM(ls.id IS NULL), 0)
+        """
+        + targets,
+        params,
+    ).fetchone()
+    cur = conn.execute(
+        """
+        INSERT OR IGNORE INTO account_lead_mapping
+        (gl_account_id, sublead, schema_version_id, is_active, note)
+        """
+        + VERSION_MAPPING_CTE
+        + """
+        SELECT vm.gl_account_id, ls.sublead, :new_version_id, 1, vm.note
+        """
+        + targets
+        + " WHERE ls.id IS NOT NULL",
+        params,
+    )
+    carried = cur.rowcount
+    crosswalk = _move_crosswalk(conn)
+    return {
+        "conti_mappati": mapped,
+        "riportati": carried,
+        "rinominati": renamed,
+        "gia_mappati": mapped - lost - carried,
+        "da_rimappare": lost,
+        "crosswalk_aggiornate": crosswalk,
+    }
+
+
+def _move_crosswalk(conn):
+    # Crosswalk rows are keyed by primary sublead code: rewrite the renamed ones
+    # under the new code. Renamed rows are staged first, so chains (A -> B,
+    # B -> C) do not collide; merged codes with the same destination collapse
+    conn.execute("DROP TABLE IF EXISTS temp.crosswalk_moved")
+    conn.execute(
+        """
+        CREATE TEMP TABLE crosswalk_moved AS
+        SELECT DISTINCT cw.target_schema_version_id, r.sublead_new AS source_sublead, cw.target_sublead
+        FROM schema_crosswalk cw
+        JOIN schema_rename r ON r.sublead_old = cw.source_sublead
+        """
+    )
+    conflicts = conn.execute(
+        """
+        WITH result AS (
+            SELECT target_schema_version_id, source_sublead, target_sublead FROM crosswalk_moved
+            UNION
+            SELECT target_schema_version_id, source_sublead, target_sublead
+            FROM schema_crosswalk
+            WHERE source_sublead NOT IN (SELECT sublead_old FROM schema_rename)
+        )
+        SELECT lsv.schema_name, lsv.version, res.source_sublead, GROUP_CONCAT(res.target_sublead, ' / ')
+        FROM result res
+        JOIN lead_schema_version lsv ON lsv.id = res.target_schema_version_id
+        GROUP BY res.target_schema_version_id, res.source_sublead
+        HAVING COUNT(*) > 1
+        ORDER BY lsv.schema_name, lsv.version, res.source_sublead
+        """
+    ).fetchall()
+    if conflicts:
+        labels = [f"{name} {version}: {source} -> {targets}" for name, version, source, targets in conflicts]
+        raise ValueError(
+            "Rinomine in conflitto con le crosswalk degli schemi derivati (stessa sublead primaria "
+            f"verso destinazioni diverse): {labels[:30]}. Correggere la crosswalk o la tabella rinomine."
+        )
+    moved = conn.execute(
+        "DELETE FROM schema_crosswalk WHERE source_sublead IN (SELECT sublead_old FROM schema_rename)"
+    ).rowcount
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO schema_crosswalk (target_schema_version_id, source_sublead, target_sublead)
+        SELECT target_schema_version_id, source_sublead, target_sublead FROM crosswalk_moved
+        """
+    )
+    conn.execute("DROP TABLE temp.crosswalk_moved")
+    return moved
+
+
+def preview_schema_upgrade(df_new, df_renames=None, detect_renames=True) -> pd.DataFrame:
+    """
+    Diff tra l'ultima versione schema nel DB e lo schema df_new (read_schema_excel),
+    con i conti mappati per sublead. Nessuna scrittura.
+    """
+    init_db()
+    conn = get_conn()
+    try:
+        old_id = latest_primary_schema_id(conn)
+        if old_id is None:
+            raise RuntimeError("Nessuna versione schema trovata: usare l'import iniziale.")
+        df_old = load_schema_structure(conn, old_id)
+        mapped_counts = mapped_accounts_by_sublead(conn, old_id)
+    finally:
+        conn.close()
+    return diff_schema(df_old, df_new, df_renames, detect_renames=detect_renames, mapped_counts=mapped_counts)
+
+
+def upgrade_schema(
+    df_new,
+    schema_name,
+    version,
+    df_renames=None,
+    detect_renames=True,
+    source_file="",
+    note="Aggiornamento versione schema",
+):
+    """
+    Nuova versione schema a partire dall'ultima: diff, import delle righe di df_new
+    e riporto del mapping (rinomine comprese), in una sola transazione: se il
+    riporto fallisce la nuova versione non viene registrata.
+    Ritorna (schema_version_id, diff, conteggi).
+    """
+    df_diff = preview_schema_upgrade(df_new, df_renames, detect_renames=detect_renames)
+    conn = get_conn()
+    try:
+        old_id = latest_primary_schema_id(conn)
+        new_id = write_schema_version(
+            conn, df_new, schema_name, version, source_file=source_file, note=note, kind="primario"
+        )
+        counts = carry_forward_mappings(conn, old_id, new_id, rename_pairs(df_diff))
+        bump_data_version(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return new_id, df_diff, counts
+
+
+def upgrade_schema_from_excel(excel_path, schema_name, version, rename_file=None, detect_renames=True, sheet_name=0):
+    """
+    Come upgrade_schema, leggendo schema e (opzionale) tabella rinomine da Excel.
+    """
+    df_new = read_schema_excel(excel_path, sheet_name=sheet_name)
+    df_renames = read_rename_table(rename_file) if rename_file is not None else None
+    return upgrade_schema(
+        df_new, schema_name, version, df_renames, detect_renames=detect_renames, source_file=excel_path
+    )
@@ -0,0 +1,218 @@
+import pandas as pd
+
+from modules.lead_numeric.db import bump_data_version, get_conn
+from modules.lead_numeric.ddl import LATEST_PRIMARY_SCHEMA_SQL, init_db, latest_primary_schema_id
+from modules.lead_numeric.import_schema import read_schema_excel, write_schema_version
+from modules.lead_numeric.mapping import MAPPING_CTE
+
+# Accounts are mapped to the primary schema only; a derived schema re-totals
+# primary subleads onto its own subleads through schema_crosswalk
+SCHEMA_KINDS = {"primario": "Primario (mapping conti)", "derivato": "Derivato (crosswalk)"}
+CROSSWALK_COLS = ["source_sublead", "target_sublead"]
+
+
+def report_sublead_cte(derived=False, param="?"):
+    """
+    CTE `report_sublead`: righe lead_structure dello schema di reporting, ognuna con
+    la sublead primaria (source_sublead) a cui sono mappati i conti. Un solo
+    parametro (`param`, posizionale o con nome): l'id della versione (None =
+    ultimo schema primario). Per uno schema derivato la crosswalk è risolta qui,
+    una volta: le query restano un'unica aggregazione con join su
+    m.sublead = source_sublead.
+    """
+    if not derived:
+        return f"""report_sublead AS (
+            SELECT ls.*, ls.sublead AS source_sublead
+            FROM lead_structure ls
+            WHERE ls.schema_version_id = COALESCE({param}, ({LATEST_PRIMARY_SCHEMA_SQL}))
+        )"""
+    return f"""report_sublead AS (
+            SELECT ls.*, x.source_sublead
+            FROM schema_crosswalk x
+            JOIN lead_structure ls
+              ON ls.schema_version_id = x.target_schema_version_id
+             AND ls.sublead = x.target_sublead
+            JOIN lead_structure ps
+              ON ps.schema_version_id = ({LATEST_PRIMARY_SCHEMA_SQL})
+             AND ps.sublead = x.source_sublead
+            WHERE x.target_schema_version_id = {param}
+        )"""
+
+
+def schema_kind(conn, schema_version_id):
+    row = conn.execute("SELECT kind FROM lead_schema_version WHERE id = ?", (int(schema_version_id),)).fetchone()
+    if row is None:
+        raise ValueError(f"Versione schema non trovata: {schema_version_id}")
+    return row[0]
+
+
+def report_schema_params(conn, schema_version_id=None):
+    """
+    (derived, parametro) per report_sublead_cte dallo schema scelto (None = primario).
+    """
+    if schema_version_id is None:
+        return False, None
+    return schema_kind(conn, schema_version_id) == "derivato", int(schema_version_id)
+
+
+def load_report_schemas(conn) -> pd.DataFrame:
+    """
+    Schemi selezionabili nei report: ultimo schema primario e ultima versione di
+    ogni schema derivato, con etichetta per la selezione.
+    """
+    df = pd.read_sql(
+        f"""
+        SELECT v.id, v.schema_name, v.version, v.kind
+        FROM lead_schema_version v
+        WHERE v.id = ({LATEST_PRIMARY_SCHEMA_SQL})
+           OR (v.kind = 'derivato'
+               AND v.id = (SELECT MAX(d.id) FROM lead_schema_version d
+                           WHERE d.kind = 'derivato' AND d.schema_name = v.schema_name))
+        ORDER BY v.kind = 'primario' DESC, v.schema_name
+        """,
+        conn,
+    )
+    df["label"] = (
+        df["schema_name"] + " " + df["version"].astype(str)
+        + df["kind"].map({"primario": " (primario)", "derivato": " (derivato)"})
+    )
+    return df
+
+
+def read_crosswalk_excel(excel_file, sheet_name=0) -> pd.DataFrame:
+    """
+    Crosswalk da Excel: colonne source_sublead (schema primario) e target_sublead
+    (schema derivato). Righe vuote ignorate.
+    """
+    df = pd.read_excel(excel_file, sheet_name=sheet_name, dtype=str)
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    missing = [c for c in CROSSWALK_COLS if c not in df.columns]
+    if missing:
+        raise ValueError(f"Colonne mancanti nella crosswalk: {missing}")
+    df = df[CROSSWALK_COLS].apply(lambda s: s.fillna("").str.strip())
+    return df[(df != "").any(axis=1)].reset_index(drop=True)
+
+
+def _validate_crosswalk(conn, df_crosswalk, target_subleads):
+    # Every primary sublead lands in exactly one derived sublead: no double counting
+    incomplete = df_crosswalk[(df_crosswalk[CROSSWALK_COLS] == "").any(axis=1)]
+    if not incomplete.empty:
+        raise ValueError(f"Crosswalk con righe incomplete: {len(incomplete)}")
+    duplicated = df_crosswalk.loc[df_crosswalk["source_sublead"].duplicated(), "source_sublead"].unique().tolist()
+    if duplicated:
+        raise ValueError(f"Sublead primarie assegnate a più sublead derivate: {duplicated[:30]}")
+
+    primary_id = latest_primary_schema_id(conn)
+    if primary_id is None:
+        raise RuntimeError("Nessuno schema primario trovato. Importa prima lo schema in pagina 01.")
+    primary_subleads = {
+        r[0] for r in conn.execute("SELECT sublead FROM lead_structure WHERE schema_version_id = ?", (primary_id,))
+    }
+    unknown_source = sorted(set(df_crosswalk["source_sublead"]) - primary_subleads)
+    if unknown_source:
+        raise ValueError(f"Sublead non presenti nello schema primario: {unknown_source[:30]}")
+    unknown_target = sorted(set(df_crosswalk["target_sublead"]) - set(target_subleads))
+    if unknown_target:
+        raise ValueError(f"Sublead non presenti nello schema derivato: {unknown_target[:30]}")
+
+
+def _write_crosswalk(conn, target_schema_version_id, df_crosswalk):
+    conn.execute("DELETE FROM schema_crosswalk WHERE target_schema_version_id = ?", (int(target_schema_version_id),))
+    conn.executemany(
+        "INSERT INTO schema_crosswalk (target_schema_version_id, source_sublead, target_sublead) VALUES (?, ?, ?)",
+        [(int(target_schema_version_id), s, t) for s, t in df_crosswalk[CROSSWALK_COLS].itertuples(index=False)],
+    )
+    bump_data_version(conn)
+
+
+def replace_crosswalk(target_schema_version_id, df_crosswalk) -> int:
+    """
+    Sostituisce la crosswalk di uno schema derivato. Ritorna il numero di righe.
+    """
+    init_db()
+    conn = get_conn()
+    try:
+        if schema_kind(conn, target_schema_version_id) != "derivato":
+            raise ValueError("La crosswalk si definisce solo per uno schema derivato.")
+        target_subleads = [
+            r[0]
+            for r in conn.execute(
+                "SELECT sublead FROM lead_structure WHERE schema_version_id = ?", (int(target_schema_version_id),)
+            )
+        ]
+        _validate_crosswalk(conn, df_crosswalk, target_subleads)
+        _write_crosswalk(conn, target_schema_version_id, df_crosswalk)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return len(df_crosswalk)
+
+
+def import_derived_schema(df_schema, df_crosswalk, schema_name, version, source_file="", note="Schema derivato") -> int:
+    """
+    Importa uno schema derivato (righe di read_schema_excel) con la sua crosswalk,
+    validata prima dell'import. Versione, righe e crosswalk in una sola
+    transazione. Ritorna schema_version_id.
+    """
+    init_db()
+    conn = get_conn()
+    try:
+        _validate_crosswalk(conn, df_crosswalk, df_schema["sublead"])
+        schema_version_id = write_schema_version(
+            conn, df_schema, schema_name, version, source_file=source_file, note=note, kind="derivato"
+        )
+        _write_crosswalk(conn, schema_version_id, df_crosswalk)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return schema_version_id
+
+
+def import_derived_schema_from_excel(excel_path, crosswalk_file, schema_name, version, sheet_name=0) -> int:
+    """
+    Come import_derived_schema, leggendo schema e crosswalk da Excel.
+    """
+    df_schema = read_schema_excel(excel_path, sheet_name=sheet_name)
+    df_crosswalk = read_crosswalk_excel(crosswalk_file)
+    return import_derived_schema(df_schema, df_crosswalk, schema_name, version, source_file=excel_path)
+
+
+def load_crosswalk(conn, target_schema_version_id) -> pd.DataFrame:
+    return pd.read_sql(
+        "SELECT source_sublead, target_sublead FROM schema_crosswalk "
+        "WHERE target_schema_version_id = ? ORDER BY target_sublead, source_sublead",
+        conn,
+        params=(int(target_schema_version_id),),
+    )
+
+
+def crosswalk_gaps(conn, target_schema_version_id) -> pd.DataFrame:
+    """
+    Sublead primarie con conti mappati ma senza riga di crosswalk: i loro saldi
+    restano fuori dai report nello schema derivato.
+    """
+    return pd.read_sql(
+        MAPPING_CTE
+        + """
+        SELECT ls.sublead, ls.lead, ls.descrizione_cee, COUNT(*) AS conti
+        FROM valid_mapping vm
+        JOIN latest_schema s ON 1=1
+        JOIN lead_structure ls
+          ON ls.schema_version_id = s.id
+         AND ls.sublead = vm.sublead
+        LEFT JOIN schema_crosswalk x
+          ON x.target_schema_version_id = ?
+         AND x.source_sublead = vm.sublead
+        WHERE x.id IS NULL
+        GROUP BY ls.sublead, ls.lead, ls.descrizione_cee
+        ORDER BY ls.sublead
+        """,
+        conn,
+        params=(int(target_schema_version_id),),
+    )
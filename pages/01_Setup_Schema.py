@@ -3,7 +3,16 @@ import streamlit as st
 
 from modules.lead_numeric.db import get_conn
 from modules.lead_numeric.ddl import init_db
-from modules.lead_numeric.import_schema import import_schema_from_excel
+from modules.lead_numeric.import_schema import import_schema_from_excel, read_schema_excel
+from modules.lead_numeric.schema_upgrade import preview_schema_upgrade, read_rename_table, upgrade_schema
+from modules.lead_numeric.schemas import (
+    crosswalk_gaps,
+    import_derived_schema,
+    load_crosswalk,
+    load_report_schemas,
+    read_crosswalk_excel,
+    replace_crosswalk,
+)
 
 st.title("01 - Setup Schema Bilancio")
 
@@ -18,6 +27,7 @@ def _load_schema_table(schema_version_id=None) -> pd.DataFrame:
                 """
                 SELECT id AS schema_version_id
                 FROM lead_schema_version
+                WHERE kind = 'primario'
                 ORDER BY id DESC
                 LIMIT 1
                 """,
@@ -76,6 +86,168 @@ if uploaded:
         except Exception as e:
             st.error(str(e))
 
+
+def _latest_schema_name():
+    conn = get_conn()
+    try:
+        row = conn.execute(
+            "SELECT schema_name FROM lead_schema_version WHERE kind = 'primario' ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+    finally:
+        conn.close()
+    return None if row is None else row[0]
+
+
+latest_schema_name = _latest_schema_name()
+if latest_schema_name is not None:
+    st.subheader("Aggiornamento versione schema")
+    st.caption(
+        "Confronta la nuova versione con l'ultima importata (sublead aggiunte, rimosse, rinominate, "
+        "spostate) e riporta il mapping dei conti sulla nuova versione in un'unica operazione. "
+        "Le rinomine si indicano in un Excel con colonne sublead_old, sublead_new."
+    )
+    upgrade_name = st.text_input("Nome schema", value=latest_schema_name, key="upgrade_schema_name")
+    upgrade_version = st.text_input("Nuova versione", value="", key="upgrade_schema_version")
+    uploaded_upgrade = st.file_uploader("Carica Excel nuova versione schema", type=["xlsx"], key="upgrade_schema_file")
+    uploaded_renames = st.file_uploader("Tabella rinomine (opzionale)", type=["xlsx"], key="upgrade_rename_file")
+    detect_renames = st.checkbox(
+        "Riconosci come rinominate le sublead con stessa descrizione e tipo",
+        value=True,
+        key="upgrade_detect_renames",
+    )
+
+    if uploaded_upgrade:
+        df_diff = None
+        try:
+            sheet_name = 0 if sheet.strip() == "" else sheet.strip()
+            df_upgrade = read_schema_excel(uploaded_upgrade, sheet_name=sheet_name)
+            df_renames = read_rename_table(uploaded_renames) if uploaded_renames else None
+            df_diff = preview_schema_upgrade(df_upgrade, df_renames, detect_renames=detect_renames)
+        except Exception as e:
+            st.error(str(e))
+
+        if df_diff is not None:
+            df_summary = (
+                df_diff.groupby("stato", observed=False)
+                .agg(sublead=("stato", "size"), conti_mappati=("conti_mappati", "sum"))
+                .reset_index()
+            )
+            st.dataframe(df_summary, use_container_width=True, hide_index=True)
+            lost = int(df_diff.loc[df_diff["stato"] == "rimossa", "conti_mappati"].sum())
+            if lost:
+                st.warning(
+                    f"{lost} conti sono mappati su sublead rimosse: indicare la rinomina "
+                    "oppure rimapparli in pagina 03 dopo l'aggiornamento."
+                )
+            df_changes = df_diff[df_diff["stato"] != "invariata"]
+            if not df_changes.empty:
+                st.dataframe(df_changes, use_container_width=True, hide_index=True)
+
+            if st.button("Importa nuova versione e riporta mapping"):
+                if upgrade_version.strip() == "":
+                    st.error("Indicare la nuova versione.")
+                else:
+                    try:
+                        schema_version_id, _, counts = upgrade_schema(
+                            df_upgrade,
+                            schema_name=upgrade_name,
+                            version=upgrade_version.strip(),
+                            df_renames=df_renames,
+                            detect_renames=detect_renames,
+                            source_file=getattr(uploaded_upgrade, "name", "uploaded.xlsx"),
+                        )
+                        imported_schema_version_id = schema_version_id
+                        st.success(
+                            f"Schema aggiornato (schema_version_id={schema_version_id}): "
+                            f"{counts['riportati']} conti riportati, di cui {counts['rinominati']} su sublead rinominate; "
+                            f"{counts['da_rimappare']} da rimappare; "
+                            f"{counts['crosswalk_aggiornate']} righe di crosswalk aggiornate."
+                        )
+                    except Exception as e:
+                        st.error(str(e))
+
+
+def _derived_schemas():
+    conn = get_conn()
+    try:
+        df = load_report_schemas(conn)
+    finally:
+        conn.close()
+    return df[df["kind"] == "derivato"]
+
+
+def _show_crosswalk_gaps(schema_version_id):
+    conn = get_conn()
+    try:
+        df_gaps = crosswalk_gaps(conn, schema_version_id)
+    finally:
+        conn.close()
+    if df_gaps.empty:
+        st.success("Tutte le sublead primarie con conti mappati sono nella crosswalk.")
+    else:
+        st.warning(
+            f"{len(df_gaps)} sublead primarie con {int(df_gaps['conti'].sum())} conti mappati non sono "
+            "nella crosswalk: i loro saldi restano fuori dai report in questo schema."
+        )
+        st.dataframe(df_gaps, use_container_width=True, hide_index=True)
+
+
+if latest_schema_name is not None:
+    st.subheader("Schemi derivati (crosswalk)")
+    st.caption(
+        "Uno schema derivato (es. IFRS, gestionale) non ha mapping proprio: i conti restano mappati "
+        "sullo schema primario e una crosswalk (Excel con colonne source_sublead, target_sublead) "
+        "riporta ogni sublead primaria su una sublead dello schema derivato. "
+        "Le pagine 04 e 05 permettono di scegliere lo schema di reporting."
+    )
+    derived_name = st.text_input("Nome schema derivato", value="", key="derived_schema_name")
+    derived_version = st.text_input("Versione", value="1.0", key="derived_schema_version")
+    uploaded_derived = st.file_uploader("Carica Excel schema derivato", type=["xlsx"], key="derived_schema_file")
+    uploaded_crosswalk = st.file_uploader("Carica Excel crosswalk", type=["xlsx"], key="derived_crosswalk_file")
+
+    if uploaded_derived and uploaded_crosswalk and st.button("Importa schema derivato"):
+        if derived_name.strip() == "" or derived_version.strip() == "":
+            st.error("Indicare nome e versione dello schema derivato.")
+        else:
+            try:
+                sheet_name = 0 if sheet.strip() == "" else sheet.strip()
+                schema_version_id = import_derived_schema(
+                    read_schema_excel(uploaded_derived, sheet_name=sheet_name),
+                    read_crosswalk_excel(uploaded_crosswalk),
+                    schema_name=derived_name.strip(),
+                    version=derived_version.strip(),
+                    source_file=getattr(uploaded_derived, "name", "uploaded.xlsx"),
+                    note="Import da UI Streamlit",
+                )
+                imported_schema_version_id = schema_version_id
+                st.success(f"Schema derivato importato (schema_version_id={schema_version_id})")
+                _show_crosswalk_gaps(schema_version_id)
+            except Exception as e:
+                st.error(str(e))
+
+    df_derived = _derived_schemas()
+    if not df_derived.empty:
+        derived_labels = dict(zip(df_derived["label"], df_derived["id"].astype(int)))
+        selected_derived = st.selectbox("Schema derivato", list(derived_labels), key="derived_schema_select")
+        selected_derived_id = derived_labels[selected_derived]
+        _show_crosswalk_gaps(selected_derived_id)
+        uploaded_replacement = st.file_uploader(
+            "Nuova crosswalk (sostituisce quella attuale)", type=["xlsx"], key="derived_crosswalk_replace"
+        )
+        if uploaded_replacement and st.button("Sostituisci crosswalk"):
+            try:
+                rows = replace_crosswalk(selected_derived_id, read_crosswalk_excel(uploaded_replacement))
+                st.success(f"Crosswalk sostituita: {rows} righe.")
+            except Exception as e:
+                st.error(str(e))
+        conn = get_conn()
+        try:
+            df_crosswalk = load_crosswalk(conn, selected_derived_id)
+        finally:
+            conn.close()
+        with st.expander(f"Crosswalk ({len(df_crosswalk)} righe)"):
+            st.dataframe(df_crosswalk, use_container_width=True, hide_index=True)
+
 st.subheader("Tabella schema bilancio")
 df_schema = _load_schema_table(imported_schema_version_id)
 if df_schema.empty:
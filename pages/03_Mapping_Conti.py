@@ -3,13 +3,21 @@ import io
 import pandas as pd
 import streamlit as st
 
-from modules.lead_numeric.db import get_conn
-from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.db import bump_data_version, get_conn, get_data_version
+from modules.lead_numeric.ddl import init_db, latest_primary_schema_id
+from modules.lead_numeric.mapping import (
+    MappingImportError,
+    export_mapping_to_excel,
+    import_mapping_from_excel,
+    load_tb_accounts,
+)
+from modules.lead_numeric.profiling import finish_page_run, render_diagnostics_panel, stage, start_page_run
 
 st.set_page_config(page_title="Mapping conti -> Sublead", layout="wide")
 st.title("03 - Mapping conti -> Sublead")
 
 init_db()
+page_run = start_page_run("03_Mapping_Conti")
 
 
 def do_rerun():
@@ -19,16 +27,6 @@ def do_rerun():
         st.experimental_rerun()
 
 
-def _latest_schema_id(conn):
-    value = pd.read_sql(
-        "SELECT MAX(id) AS schema_version_id FROM lead_schema_version",
-        conn,
-    ).iloc[0]["schema_version_id"]
-    if pd.isna(value):
-        return None
-    return int(value)
-
-
 def _tb_list(conn):
     return pd.read_sql(
         """
@@ -41,163 +39,63 @@ def _tb_list(conn):
     )
 
 
-MAPPING_CTE = """
-WITH latest_schema AS (
-    SELECT MAX(id) AS id FROM lead_schema_version
-),
-latest_mapping AS (
-    SELECT gl_account_id, sublead
-    FROM (
-        SELECT m.*,
-               ROW_NUMBER() OVER (
-                   PARTITION BY m.gl_account_id
-                   ORDER BY m.schema_version_id DESC, m.id DESC
-               ) AS rn
-        FROM account_lead_mapping m
-        WHERE m.is_active = 1
-    )
-    WHERE rn = 1
-),
-valid_mapping AS (
-    SELECT lm.gl_account_id, lm.sublead
-    FROM latest_mapping lm
-    JOIN latest_schema s ON 1=1
-    JOIN lead_structure ls
-      ON ls.schema_version_id = s.id
-     AND ls.sublead = lm.sublead
-)
-"""
+@st.cache_data(show_spinner=False)
+def _load_sublead_table(data_version, schema_version_id):
+    conn = get_conn()
+    try:
+        return pd.read_sql(
+            """
+            SELECT ls.sublead, ls.lead, ls.group_lead, ls.descrizione_cee, ls.tipo
+            FROM lead_structure ls
+            WHERE ls.schema_version_id = ?
+            ORDER BY ls.tipo, ls.gruppo, ls.sublead
+            """,
+            conn,
+            params=(schema_version_id,),
+        )
+    finally:
+        conn.close()
 
 
-try:
+@st.cache_data(show_spinner=False)
+def _load_tb_accounts(data_version, tb_id):
     conn = get_conn()
+    try:
+        return load_tb_accounts(conn, tb_id)
+    finally:
+        conn.close()
 
-    latest_schema_id = _latest_schema_id(conn)
-    if latest_schema_id is None:
-        st.error("Nessuna versione schema trovata. Importa prima lo schema in pagina 01.")
-        st.stop()
 
-    tb_headers = _tb_list(conn)
-    if tb_headers.empty:
-        st.warning("Nessun Trial Balance importato. Vai in pagina 02 per importare un TB.")
-        st.stop()
+def _build_mapped_excel(df_mapped):
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        df_mapped.to_excel(writer, index=False, sheet_name="Mapping")
+    return output.getvalue()
 
-    tb_options = [
-        f"{int(r.id)} | {r.entity_code} | {int(r.fiscal_year)} | {r.chart_of_accounts} | {r.import_date}"
-        for _, r in tb_headers.iterrows()
-    ]
-    selected_tb_opt = st.selectbox(
-        "Perimetro mapping (Trial Balance)",
-        options=tb_options,
-        index=0,
-        help="La pagina mostra solo i conti presenti nel Trial Balance selezionato.",
-    )
-    selected_tb_id = int(selected_tb_opt.split("|")[0].strip())
 
-    df_sublead = pd.read_sql(
-        """
-        SELECT ls.sublead, ls.lead, ls.group_lead, ls.descrizione_cee, ls.tipo
-        FROM lead_structure ls
-        WHERE ls.schema_version_id = ?
-        ORDER BY ls.tipo, ls.gruppo, ls.sublead
-        """,
-        conn,
-        params=(latest_schema_id,),
-    )
-    if df_sublead.empty:
-        st.error("Non trovo sublead nello schema. Hai importato lo schema bilancio in pagina 01?")
-        st.stop()
+@st.fragment
+def _mapping_editor(data_version, selected_tb_id, latest_schema_id):
+    # Partial rerun: selecting a sublead or ticking accounts reruns only this block
+    df_sublead = _load_sublead_table(data_version, latest_schema_id)
+    df_all = _load_tb_accounts(data_version, selected_tb_id)
 
     sublead_options = [
         f"{r.sublead} | {r.lead} | {r.descrizione_cee}"
-        for _, r in df_sublead.iterrows()
+        for r in df_sublead.itertuples(index=False)
     ]
     opt_to_sublead = dict(zip(sublead_options, df_sublead["sublead"].tolist()))
 
-    df_unmapped = pd.read_sql(
-        MAPPING_CTE
-        + """
-        SELECT ga.id AS gl_account_id, ga.account_code, ga.account_name
-        FROM trial_balance_line tbl
-        JOIN gl_account ga ON ga.id = tbl.gl_account_id
-        LEFT JOIN valid_mapping vm ON vm.gl_account_id = ga.id
-        WHERE tbl.trial_balance_id = ?
-          AND vm.gl_account_id IS NULL
-        GROUP BY ga.id, ga.account_code, ga.account_name
-        ORDER BY ga.account_code
-        """,
-        conn,
-        params=(selected_tb_id,),
-    )
-
-    st.caption("Assegna i conti non mappati a una Sublead. Dopo il salvataggio spariscono dalla lista.")
-    if df_unmapped.empty:
-        st.success("Nessun conto da mappare nel Trial Balance selezionato.")
-    else:
-        st.warning(f"Conti da mappare nel TB selezionato: {len(df_unmapped)}")
-
-    with st.expander("Riepilogo conti mappati", expanded=False):
-        df_mapped = pd.read_sql(
-            MAPPING_CTE
-            + """
-            SELECT ga.account_code, ga.account_name, vm.sublead, ls.lead, ls.descrizione_cee
-            FROM trial_balance_line tbl
-            JOIN gl_account ga ON ga.id = tbl.gl_account_id
-            JOIN valid_mapping vm ON vm.gl_account_id = ga.id
-            JOIN lead_structure ls
-              ON ls.schema_version_id = ?
-             AND ls.sublead = vm.sublead
-            WHERE tbl.trial_balance_id = ?
-            GROUP BY ga.id, ga.account_code, ga.account_name, vm.sublead, ls.lead, ls.descrizione_cee
-            ORDER BY ga.account_code
-            """,
-            conn,
-            params=(latest_schema_id, selected_tb_id),
-        )
-
-        if df_mapped.empty:
-            st.info("Nessun conto mappato.")
-        else:
-            st.dataframe(df_mapped, use_container_width=True)
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-                df_mapped.to_excel(writer, index=False, sheet_name="Mapping")
-            st.download_button(
-                label="Esporta in Excel",
-                data=output.getvalue(),
-                file_name="riepilogo_mapping.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            )
-
     st.subheader("Allinea o modifica conti a Sublead (selezione multipla)")
     col1, col2 = st.columns(2)
 
-    df_all = pd.read_sql(
-        MAPPING_CTE
-        + """
-        SELECT ga.id AS gl_account_id, ga.account_code, ga.account_name, vm.sublead AS mapped_sublead
-        FROM trial_balance_line tbl
-        JOIN gl_account ga ON ga.id = tbl.gl_account_id
-        LEFT JOIN valid_mapping vm ON vm.gl_account_id = ga.id
-        WHERE tbl.trial_balance_id = ?
-        GROUP BY ga.id, ga.account_code, ga.account_name, vm.sublead
-        ORDER BY ga.account_code
-        """,
-        conn,
-        params=(selected_tb_id,),
-    )
-    df_all["account_name"] = df_all["account_name"].fillna("")
-    df_all["label"] = df_all["account_code"] + " - " + df_all["account_name"]
-
     with col2:
         st.caption("Seleziona la Sublead a cui allineare i conti:")
         selected_sublead_opt = st.selectbox("Sublead", options=sublead_options)
         selected_sublead = opt_to_sublead[selected_sublead_opt]
 
-        df_assigned = df_all[df_all["mapped_sublead"] == selected_sublead].copy()
+        df_assigned = df_all[df_all["mapped_sublead"] == selected_sublead]
         if not df_assigned.empty:
             st.write(f"Conti gia assegnati a Sublead {selected_sublead}:")
-            df_assigned["label"] = df_assigned["account_code"] + " - " + df_assigned["account_name"]
             assigned_labels = df_assigned["label"].tolist()
             label_to_id = dict(zip(df_assigned["label"], df_assigned["gl_account_id"]))
             remove_accounts = st.multiselect(
@@ -207,23 +105,28 @@ try:
             )
             if remove_accounts and st.button("Rimuovi conti selezionati da Sublead"):
                 error_count = 0
-                for acc_label in remove_accounts:
-                    try:
-                        acc_id = int(label_to_id[acc_label])
-                        res = conn.execute(
-                            """
-                            DELETE FROM account_lead_mapping
-                              WHERE gl_account_id = ?
-                                AND sublead = ?
-                                AND is_active = 1
-                            """,
-                            (acc_id, selected_sublead),
-                        )
-                        if res.rowcount == 0:
+                conn = get_conn()
+                try:
+                    for acc_label in remove_accounts:
+                        try:
+                            acc_id = int(label_to_id[acc_label])
+                            res = conn.execute(
+                                """
+                                DELETE FROM account_lead_mapping
+                                  WHERE gl_account_id = ?
+                                    AND sublead = ?
+                                    AND is_active = 1
+                                """,
+                                (acc_id, selected_sublead),
+                            )
+                            if res.rowcount == 0:
+                                error_count += 1
+                        except Exception:
                             error_count += 1
-                    except Exception:
-                        error_count += 1
-                conn.commit()
+                    bump_data_version(conn)
+                    conn.commit()
+                finally:
+                    conn.close()
                 if error_count == 0:
                     st.success("Conti rimossi dalla Sublead.")
                 else:
@@ -239,20 +142,122 @@ try:
         selected_accounts = st.multiselect("Conti", options=account_options, default=[])
 
     if selected_accounts and st.button("Allinea conti selezionati alla Sublead"):
-        for acc_label in selected_accounts:
-            acc_id = int(account_ids[acc_label])
-            conn.execute(
+        conn = get_conn()
+        try:
+            conn.executemany(
                 """
                 INSERT INTO account_lead_mapping
                 (gl_account_id, sublead, schema_version_id, is_active)
                 VALUES (?, ?, ?, 1)
                 """,
-                (acc_id, selected_sublead, latest_schema_id),
+                [(int(account_ids[acc_label]), selected_sublead, latest_schema_id) for acc_label in selected_accounts],
             )
-        conn.commit()
+            bump_data_version(conn)
+            conn.commit()
+        finally:
+            conn.close()
         st.success(f"Conti allineati a Sublead {selected_sublead}")
         do_rerun()
 
+
+try:
+    conn = get_conn()
+
+    latest_schema_id = latest_primary_schema_id(conn)
+    if latest_schema_id is None:
+        st.error("Nessuna versione schema trovata. Importa prima lo schema in pagina 01.")
+        st.stop()
+
+    tb_headers = _tb_list(conn)
+    if tb_headers.empty:
+        st.warning("Nessun Trial Balance importato. Vai in pagina 02 per importare un TB.")
+        st.stop()
+
+    data_version = get_data_version(conn)
+
+    tb_options = [
+        f"{int(r.id)} | {r.entity_code} | {int(r.fiscal_year)} | {r.chart_of_accounts} | {r.import_date}"
+        for _, r in tb_headers.iterrows()
+    ]
+    selected_tb_opt = st.selectbox(
+        "Perimetro mapping (Trial Balance)",
+        options=tb_options,
+        index=0,
+        help="La pagina mostra solo i conti presenti nel Trial Balance selezionato.",
+    )
+    selected_tb_id = int(selected_tb_opt.split("|")[0].strip())
+    selected_coa = tb_headers.loc[tb_headers["id"] == selected_tb_id, "chart_of_accounts"].iloc[0]
+
+    df_sublead = _load_sublead_table(data_version, latest_schema_id)
+    if df_sublead.empty:
+        st.error("Non trovo sublead nello schema. Hai importato lo schema bilancio in pagina 01?")
+        st.stop()
+
+    with stage("conti_tb"):
+        df_all = _load_tb_accounts(data_version, selected_tb_id)
+    df_unmapped = df_all[df_all["mapped_sublead"].isnull()]
+
+    st.caption("Assegna i conti non mappati a una Sublead. Dopo il salvataggio spariscono dalla lista.")
+    if df_unmapped.empty:
+        st.success("Nessun conto da mappare nel Trial Balance selezionato.")
+    else:
+        st.warning(f"Conti da mappare nel TB selezionato: {len(df_unmapped)}")
+
+    with st.expander("Riepilogo conti mappati", expanded=False):
+        df_mapped = (
+            df_all[df_all["mapped_sublead"].notnull()]
+            .rename(columns={"mapped_sublead": "sublead"})
+            .merge(df_sublead[["sublead", "lead", "descrizione_cee"]], on="sublead", how="inner")
+            [["account_code", "account_name", "sublead", "lead", "descrizione_cee"]]
+        )
+
+        if df_mapped.empty:
+            st.info("Nessun conto mappato.")
+        else:
+            st.dataframe(df_mapped, use_container_width=True)
+            st.download_button(
+                label="Esporta in Excel",
+                data=lambda: _build_mapped_excel(df_mapped),
+                file_name="riepilogo_mapping.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore",
+            )
+
+    with st.expander("Import / export mapping da Excel", expanded=False):
+        st.caption(
+            f"Mapping completo del piano dei conti '{selected_coa}'. "
+            "Modifica la colonna sublead (vuota = conto da smappare) e reimporta il file: "
+            "tutte le righe sono validate insieme e applicate in un'unica transazione."
+        )
+        st.download_button(
+            label="Esporta mapping piano dei conti",
+            data=lambda: export_mapping_to_excel(selected_coa),
+            file_name=f"mapping_{selected_coa}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
+        )
+        import_result = st.session_state.pop("mapping_import_result", None)
+        if import_result is not None:
+            st.success(
+                f"Mapping importato: {import_result['aggiornati']} conti aggiornati, "
+                f"{import_result['rimossi']} rimossi, {import_result['invariati']} invariati."
+            )
+        uploaded_mapping = st.file_uploader("Carica Excel mapping", type=["xlsx"], key="mapping_import_file")
+        if uploaded_mapping and st.button("Importa mapping"):
+            try:
+                with stage("import_mapping"):
+                    result = import_mapping_from_excel(uploaded_mapping, chart_of_accounts=selected_coa)
+                st.session_state["mapping_import_result"] = result
+                do_rerun()
+            except MappingImportError as e:
+                st.error(str(e))
+                st.dataframe(e.errors, use_container_width=True, hide_index=True)
+            except Exception as e:
+                st.error(str(e))
+
+    with stage("editor_mapping"):
+        _mapping_editor(data_version, selected_tb_id, latest_schema_id)
+
 except Exception as e:
     st.error("Errore nella pagina Mapping (03). Dettaglio:")
     st.exception(e)
@@ -262,3 +267,5 @@ finally:
         conn.close()
     except Exception:
         pass
+    finish_page_run(page_run)
+    render_diagnostics_panel(page_run)
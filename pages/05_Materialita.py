@@ -1,9 +1,30 @@
+import altair as alt
 import pandas as pd
 import streamlit as st
 import io
 
-from modules.lead_numeric.db import get_conn
+from modules.lead_numeric.db import get_conn, get_data_version
 from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.export_materiality import MATERIALITY_EXPORT_BUILDERS, materiality_export_frames
+from modules.lead_numeric.formatting import format_int
+from modules.lead_numeric.materiality import (
+    ALLOCATION_METHODS,
+    DEFAULT_OPERATING_PCT,
+    DEFAULT_TRIVIAL_PCT,
+    TRIVIAL_PCTS,
+    allocate_component_materiality,
+    criteria_table,
+    default_criteria,
+    load_benchmark_values,
+    load_benchmarks,
+    load_latest_decision,
+    materiality_results,
+    materiality_scenarios,
+    normalize_criteria,
+    save_decision,
+)
+from modules.lead_numeric.profiling import finish_page_run, render_diagnostics_panel, stage, start_page_run
+from modules.lead_numeric.schemas import load_report_schemas
 
 st.set_page_config(page_title="05 - Materialita", layout="wide")
 st.title("05 - Materialita")
@@ -33,15 +54,7 @@ st.markdown(
 )
 
 init_db()
-
-DEFAULT_ROWS = pd.DataFrame(
-    [
-        {"Voce": "A1) Ricavi delle vendite e delle prestazioni", "Valore base": 0, "% min": 1, "% max": 3, "% selezionata": 2, "Importo calcolato": 0, "Selezione": False},
-        {"Voce": "Totale attivo", "Valore base": 0, "% min": 1, "% max": 3, "% selezionata": 2, "Importo calcolato": 0, "Selezione": False},
-        {"Voce": "Patrimonio netto", "Valore base": 0, "% min": 3, "% max": 5, "% selezionata": 4, "Importo calcolato": 0, "Selezione": False},
-        {"Voce": "Reddito ante imposte", "Valore base": 0, "% min": 3, "% max": 7, "% selezionata": 5, "Importo calcolato": 0, "Selezione": False},
-    ]
-)
+page_run = start_page_run("05_Materialita")
 
 SECTION_OPTIONS = {
     "Materialita preliminare": "preliminare",
@@ -49,155 +62,443 @@ SECTION_OPTIONS = {
 }
 
 
-def _to_int_series(series, default_value):
-    return pd.to_numeric(series, errors="coerce").fillna(default_value).round(0).astype(int)
-
-
-def _load_basi_per_anno(conn):
-    return pd.read_sql(
-        """
-        WITH latest_schema AS (
-            SELECT MAX(id) AS id FROM lead_schema_version
-        ),
-        latest_mapping AS (
-            SELECT *
-            FROM (
-                SELECT m.*,
-                       ROW_NUMBER() OVER (
-                           PARTITION BY m.gl_account_id
-                           ORDER BY m.schema_version_id DESC, m.id DESC
-                       ) AS rn
-                FROM account_lead_mapping m
-                WHERE m.is_active = 1
-            )
-            WHERE rn = 1
-        ),
-        base_data AS (
-            SELECT
-                tbh.fiscal_year,
-                UPPER(TRIM(COALESCE(ls.tipo, ''))) AS tipo_norm,
-                UPPER(TRIM(COALESCE(ls.lead, ''))) AS lead_norm,
-                UPPER(TRIM(COALESCE(ls.sublead, ''))) AS sublead_norm,
-                tbl.closing_balance AS importo
-            FROM latest_mapping m
-            JOIN latest_schema s ON 1 = 1
-            JOIN lead_structure ls
-              ON ls.schema_version_id = s.id
-             AND ls.sublead = m.sublead
-            JOIN trial_balance_line tbl ON tbl.gl_account_id = m.gl_account_id
-            JOIN trial_balance_header tbh ON tbh.id = tbl.trial_balance_id
-        )
-        SELECT
-            fiscal_year,
-            SUM(CASE WHEN sublead_norm = 'U0100' THEN importo ELSE 0 END) AS ricavi_u0100,
-            SUM(CASE WHEN tipo_norm = 'ATTIVO' THEN importo ELSE 0 END) AS totale_attivo,
-            SUM(CASE WHEN lead_norm = 'L PATRIMONIO NETTO' THEN importo ELSE 0 END) AS patrimonio_netto_exact,
-            SUM(CASE WHEN lead_norm = 'L' THEN importo ELSE 0 END) AS patrimonio_netto_fallback,
-            SUM(CASE WHEN tipo_norm = 'CE' AND lead_norm <> 'YF' THEN importo ELSE 0 END) AS reddito_ante_imposte
-        FROM base_data
-        GROUP BY fiscal_year
-        ORDER BY fiscal_year DESC
-        """,
-        conn,
-    )
+def _build_components_excel(df_components, df_params):
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        df_components.to_excel(writer, index=False, sheet_name="Componenti")
+        df_params.to_excel(writer, index=False, sheet_name="Parametri")
+    return output.getvalue()
 
 
-def _format_int_it(value):
-    return f"{int(abs(round(value, 0))):,}".replace(",", ".")
+def _module_available(module_name):
+    import importlib.util
+    return importlib.util.find_spec(module_name) is not None
 
 
-def _build_excel_export(df_export, df_summary):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        df_export.to_excel(writer, index=False, sheet_name="Criteri")
-        df_summary.to_excel(writer, index=False, sheet_name="Riepilogo")
-    return output.getvalue()
+@st.cache_data(show_spinner=False, max_entries=16)
+def _cached_materialita_export(export_format, df_export, df_summary):
+    return MATERIALITY_EXPORT_BUILDERS[export_format](df_export, df_summary)
+
+
+@st.cache_data(show_spinner=False)
+def _cached_benchmarks(data_version):
+    conn = get_conn()
+    try:
+        return load_benchmarks(conn)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False)
+def _cached_perimetro(data_version):
+    # Years and entities for the selectors: two small indexed reads, no benchmark query
+    conn = get_conn()
+    try:
+        years = [int(r[0]) for r in conn.execute("SELECT DISTINCT fiscal_year FROM trial_balance_header ORDER BY fiscal_year DESC")]
+        entities = pd.read_sql("SELECT id, entity_code, entity_name FROM legal_entity ORDER BY entity_code", conn)
+        return years, entities
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False)
+def _cached_report_schemas(data_version):
+    conn = get_conn()
+    try:
+        return load_report_schemas(conn)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False)
+def _cached_basi_per_anno(data_version, schema_version_id, adjusted):
+    # Benchmark values per year (all entities), from one compiled query
+    benchmarks = _cached_benchmarks(data_version)
+    conn = get_conn()
+    try:
+        return load_benchmark_values(conn, benchmarks, schema_version_id=schema_version_id, adjusted=adjusted)
+    finally:
+        conn.close()
 
 
-def _build_word_export(df_export, df_summary):
+@st.cache_data(show_spinner=False, max_entries=64)
+def _cached_decision(legal_entity_id, fiscal_year, section_key, schema_version_id, adjusted):
+    conn = get_conn()
     try:
-        from docx import Document
-        import io as _io
-    except ImportError:
-        return None
-
-    doc = Document()
-    doc.add_heading("Determinazione Materialita", level=1)
-
-    doc.add_heading("Riepilogo", level=2)
-    for _, row in df_summary.iterrows():
-        doc.add_paragraph(f"{row['Voce']}: {row['Valore']}")
-
-    doc.add_heading("Criteri", level=2)
-    table = doc.add_table(rows=1, cols=len(df_export.columns))
-    table.style = "Table Grid"
-    for i, c in enumerate(df_export.columns):
-        table.rows[0].cells[i].text = str(c)
-    for _, row in df_export.iterrows():
-        cells = table.add_row().cells
-        for i, c in enumerate(df_export.columns):
-            cells[i].text = str(row[c])
-
-    buffer = _io.BytesIO()
-    doc.save(buffer)
-    return buffer.getvalue()
-
-
-def _build_pdf_export(df_export, df_summary):
+        return load_latest_decision(
+            conn, legal_entity_id, fiscal_year, section_key, schema_version_id=schema_version_id, adjusted=adjusted
+        )
+    finally:
+        conn.close()
+
+
+def _seed_decision_state(section_key, decision):
+    # A saved decision fills the editor, sliders and note once per loaded version
+    loaded_key = f"materialita_decisione_{section_key}"
+    identity = (decision["legal_entity_id"], decision["fiscal_year"], decision["version"])
+    if st.session_state.get(loaded_key) == identity:
+        return
+    st.session_state[loaded_key] = identity
+    st.session_state[f"materialita_editable_{section_key}"] = pd.DataFrame(
+        decision["criteria"], columns=["Voce", "% selezionata", "Selezione"]
+    )
+    if decision["pct_materialita_operativa"] is not None:
+        st.session_state[f"slider_materialita_operativa_{section_key}"] = int(decision["pct_materialita_operativa"])
+    if decision["pct_errori_trascurabili"] is not None:
+        st.session_state[f"slider_errori_trascurabili_{section_key}"] = int(decision["pct_errori_trascurabili"])
+    st.session_state[f"nota_materialita_store_{section_key}"] = decision["note"] or ""
+    st.session_state[f"nota_materialita_input_{section_key}"] = decision["note"] or ""
+
+
+def _reset_decision_state(section_key, legal_entity_id, fiscal_year, schema_version_id, adjusted):
+    # Editor, sliders and note belong to one (entity, year, schema, adjusted): a new
+    # key starts from the defaults, so settings without a saved decision do not
+    # show the previous one
+    context_key = f"materialita_contesto_{section_key}"
+    context = (legal_entity_id, int(fiscal_year), int(schema_version_id), bool(adjusted))
+    if st.session_state.get(context_key) == context:
+        return
+    st.session_state[context_key] = context
+    for key in (
+        f"materialita_editable_{section_key}",
+        f"slider_materialita_operativa_{section_key}",
+        f"slider_errori_trascurabili_{section_key}",
+        f"nota_materialita_store_{section_key}",
+        f"nota_materialita_input_{section_key}",
+        f"materialita_decisione_{section_key}",
+    ):
+        st.session_state.pop(key, None)
+
+
+@st.cache_data(show_spinner=False)
+def _cached_basi_per_entita(data_version, schema_version_id, adjusted):
+    # Same compiled query, grouped by (entity, year) in the same pass
+    benchmarks = _cached_benchmarks(data_version)
+    conn = get_conn()
     try:
-        from reportlab.lib import colors
-        from reportlab.lib.pagesizes import A4, landscape
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-        from reportlab.lib.styles import getSampleStyleSheet
-        import io as _io
-    except ImportError:
-        return None
-
-    buffer = _io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=landscape(A4))
-    styles = getSampleStyleSheet()
-    elements = [Paragraph("Determinazione Materialita", styles["Heading2"]), Spacer(1, 8)]
-
-    elements.append(Paragraph("Riepilogo", styles["Heading3"]))
-    summary_data = [["Voce", "Valore"]]
-    for _, row in df_summary.iterrows():
-        voce_text = Paragraph(str(row["Voce"]), styles["BodyText"])
-        valore_text = Paragraph(str(row["Valore"]), styles["BodyText"])
-        summary_data.append([voce_text, valore_text])
-    summary_table = Table(summary_data, colWidths=[220, 420])
-    summary_table.setStyle(TableStyle([
-        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("VALIGN", (0, 0), (-1, -1), "TOP"),
-        ("LEFTPADDING", (0, 0), (-1, -1), 4),
-        ("RIGHTPADDING", (0, 0), (-1, -1), 4),
-        ("TOPPADDING", (0, 0), (-1, -1), 3),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
-    ]))
-    elements.append(summary_table)
-    elements.append(Spacer(1, 10))
-
-    elements.append(Paragraph("Criteri", styles["Heading3"]))
-    criteria_data = [df_export.columns.tolist()] + df_export.values.tolist()
-    criteria_table = Table(criteria_data, repeatRows=1)
-    criteria_table.setStyle(TableStyle([
-        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#EEEEEE")),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("FONTSIZE", (0, 0), (-1, -1), 8),
-    ]))
-    elements.append(criteria_table)
-
-    doc.build(elements)
-    return buffer.getvalue()
+        return load_benchmark_values(conn, benchmarks, by_entity=True, schema_version_id=schema_version_id, adjusted=adjusted)
+    finally:
+        conn.close()
+
+
+def _basi_correnti(data_version, schema_version_id, adjusted, legal_entity_id):
+    # Bases from the current data: all entities, or one entity of the grouped query
+    if legal_entity_id is None:
+        return _cached_basi_per_anno(data_version, schema_version_id, adjusted)
+    df_entities = _cached_basi_per_entita(data_version, schema_version_id, adjusted)
+    return df_entities[df_entities["legal_entity_id"] == legal_entity_id]
+
+
+def _render_component_allocation(data_version, schema_version_id, adjusted, section_key, selected_year, group_materiality, benchmarks, default_code):
+    df_year = _cached_basi_per_entita(data_version, schema_version_id, adjusted)
+    df_year = df_year[df_year["fiscal_year"].astype(int) == int(selected_year)]
+    if df_year.empty:
+        st.info("Nessuna entita con dati per l'esercizio selezionato.")
+        return
+
+    labels = {b["code"]: b["label"] for b in benchmarks}
+    col_base, col_method, col_cap = st.columns([2, 1.4, 1])
+    with col_base:
+        base_code = st.selectbox(
+            "Base di allocazione",
+            options=list(labels),
+            index=list(labels).index(default_code),
+            format_func=labels.get,
+            key=f"componenti_base_{section_key}",
+        )
+    with col_method:
+        method = st.radio(
+            "Metodo",
+            options=list(ALLOCATION_METHODS),
+            format_func=ALLOCATION_METHODS.get,
+            horizontal=True,
+            key=f"componenti_metodo_{section_key}",
+        )
+    with col_cap:
+        cap_pct = st.slider("Tetto % su gruppo", min_value=10, max_value=100, value=90, step=5, format="%d%%", key=f"componenti_tetto_{section_key}")
+    fixed_pct = 50
+    if method == "fixed":
+        fixed_pct = st.slider("% fissa su gruppo", min_value=10, max_value=100, value=50, step=5, format="%d%%", key=f"componenti_fissa_{section_key}")
+
+    df_alloc = allocate_component_materiality(
+        df_year[["entity_code", "entity_name", "fiscal_year", base_code]],
+        base_code,
+        group_materiality,
+        method=method,
+        cap_pct=cap_pct,
+        fixed_pct=fixed_pct,
+    ).rename(columns={"entity_code": "Entita", "entity_name": "Denominazione", "fiscal_year": "Esercizio", base_code: "Valore base"})
+    df_alloc["Valore base"] = df_alloc["Valore base"].fillna(0).abs().round(0).astype(int)
+    df_alloc["Quota %"] = df_alloc["Quota %"].round(2)
+
+    st.caption(
+        f"Componenti: {len(df_alloc)} | Materialita di gruppo: {format_int(abs(group_materiality))} | "
+        f"Somma materialita componenti: {format_int(int(df_alloc['Materialita componente'].sum()))}"
+    )
+    st.dataframe(
+        df_alloc,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Valore base": st.column_config.NumberColumn("Valore base", format="%d"),
+            "Quota %": st.column_config.NumberColumn("Quota %", format="%.2f"),
+            "Materialita di gruppo": st.column_config.NumberColumn("Materialita di gruppo", format="%d"),
+            "Materialita componente": st.column_config.NumberColumn("Materialita componente", format="%d"),
+        },
+    )
+    df_params = pd.DataFrame(
+        [
+            {"Voce": "Esercizio", "Valore": int(selected_year)},
+            {"Voce": "Materialita di gruppo", "Valore": int(group_materiality)},
+            {"Voce": "Base di allocazione", "Valore": labels[base_code]},
+            {"Voce": "Metodo", "Valore": ALLOCATION_METHODS[method]},
+            {"Voce": "Tetto % su gruppo", "Valore": cap_pct},
+            {"Voce": "% fissa su gruppo", "Valore": fixed_pct if method == "fixed" else ""},
+        ]
+    )
+    st.download_button(
+        label="Esporta componenti in Excel",
+        data=lambda: _build_components_excel(df_alloc, df_params),
+        file_name=f"materialita_componenti_{section_key}_{selected_year}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        on_click="ignore",
+        key=f"componenti_export_{section_key}",
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _cached_scenario_grid(df_values, benchmarks):
+    # Keyed on the (small) bases frame: no SQL, one vectorized pass for every year in it
+    return materiality_scenarios(df_values, benchmarks)
+
+
+@st.fragment
+def _scenario_explorer(df_values, benchmarks, selected_year):
+    # Partial rerun: the widgets only slice the cached grid
+    df_grid = _cached_scenario_grid(df_values, benchmarks)
+    df_year = df_grid[df_grid["fiscal_year"] == int(selected_year)]
+    if df_year.empty:
+        st.info("Nessuno scenario disponibile per l'esercizio selezionato.")
+        return
+
+    col_voce, col_et = st.columns([2, 1])
+    with col_voce:
+        voce = st.selectbox("Benchmark", options=list(dict.fromkeys(df_year["Voce"])), key="scenario_benchmark")
+    with col_et:
+        pct_et = st.slider(
+            "% Errori trascurabili",
+            min_value=min(TRIVIAL_PCTS),
+            max_value=max(TRIVIAL_PCTS),
+            value=10,
+            step=1,
+            format="%d%%",
+            key="scenario_errori_trascurabili",
+        )
+    df_view = df_year[(df_year["Voce"] == voce) & (df_year["% trascurabili"] == pct_et)]
+
+    df_chart = df_view.rename(columns={
+        "% selezionata": "pct_generale",
+        "% operativa": "pct_operativa",
+        "Materialita generale": "materialita_generale",
+        "Materialita operativa": "materialita_operativa",
+        "Errori trascurabili": "errori_trascurabili",
+    })
+    heatmap = alt.Chart(df_chart).mark_rect().encode(
+        x=alt.X("pct_generale:O", title="% materialita"),
+        y=alt.Y("pct_operativa:O", title="% materialita operativa", sort="descending"),
+        color=alt.Color("materialita_operativa:Q", title="Materialita operativa", scale=alt.Scale(scheme="blues")),
+        tooltip=[
+            alt.Tooltip("pct_generale:O", title="% materialita"),
+            alt.Tooltip("pct_operativa:O", title="% operativa"),
+            alt.Tooltip("materialita_generale:Q", title="Materialita generale", format=",d"),
+            alt.Tooltip("materialita_operativa:Q", title="Materialita operativa", format=",d"),
+            alt.Tooltip("errori_trascurabili:Q", title="Errori trascurabili", format=",d"),
+        ],
+    )
+    st.altair_chart(heatmap, use_container_width=True)
+
+    # Sensitivity table: operating materiality per (% operativa, % materialita)
+    df_table = df_view.pivot(index="% operativa", columns="% selezionata", values="Materialita operativa").sort_index(ascending=False)
+    df_table = df_table.apply(format_int)
+    df_table.columns = [f"{int(c)}%" for c in df_table.columns]
+    df_table.index = [f"{int(i)}%" for i in df_table.index]
+    st.dataframe(df_table, use_container_width=True)
+
+
+@st.fragment
+def _materialita_editor(data_version, schema_version_id, adjusted, section_key, selected_section_label, selected_year, basi_map, benchmarks, legal_entity_id):
+    # Partial rerun: editor, sliders and note only recompute the metrics below
+    editable_key = f"materialita_editable_{section_key}"
+    if editable_key not in st.session_state:
+        st.session_state[editable_key] = default_criteria(benchmarks)[["Voce", "% selezionata", "Selezione"]].copy()
+
+    table_df = criteria_table(benchmarks, basi_map, st.session_state[editable_key])
+
+    pct_options = list(range(int(table_df["% min"].min()), int(table_df["% max"].max()) + 1))
+    edited = st.data_editor(
+        table_df,
+        use_container_width=True,
+        hide_index=True,
+        row_height=24,
+        column_config={
+            "Voce": st.column_config.TextColumn("Voce"),
+            "Valore base": st.column_config.NumberColumn("Valore base", format="%d"),
+            "% min": st.column_config.NumberColumn("% min", min_value=0, max_value=100, step=1, format="%d"),
+            "% max": st.column_config.NumberColumn("% max", min_value=0, max_value=100, step=1, format="%d"),
+            "% selezionata": st.column_config.SelectboxColumn("% selezionata", options=pct_options, required=True),
+            "Importo calcolato": st.column_config.NumberColumn("Importo calcolato", format="%d"),
+            "Selezione": st.column_config.CheckboxColumn("Selezione"),
+        },
+        disabled=["Voce", "% min", "% max", "Valore base", "Importo calcolato"],
+    )
+
+    edited = normalize_criteria(edited, basi_map)
+
+    # Compared with the rendered table, not the stored state: a seeded or default
+    # state only differs by normalization, so full-page runs never rerun here and
+    # only an edit (always a fragment rerun) rebuilds the table
+    new_editable = edited[["Voce", "% selezionata", "Selezione"]].copy()
+    prev_editable = table_df[["Voce", "% selezionata", "Selezione"]]
+    st.session_state[editable_key] = new_editable
+    if not new_editable.equals(prev_editable):
+        # Rebuild the calculated amounts: rerun this fragment, not the page
+        st.rerun(scope="fragment")
+
+    results = None
+    note_default_text = (
+        "Inserire una descrizione del criterio selezionato per la determinazione della materialita, "
+        "specificando le ragioni professionali della scelta delle percentuali applicate ai benchmark "
+        "considerati e gli elementi qualitativi/quantitativi rilevanti emersi nell'analisi."
+    )
+    note_state_key = f"nota_materialita_store_{section_key}"
+    note_widget_key = f"nota_materialita_input_{section_key}"
+    if note_state_key not in st.session_state:
+        st.session_state[note_state_key] = note_default_text
+    if note_widget_key not in st.session_state:
+        st.session_state[note_widget_key] = st.session_state[note_state_key]
+
+    # Defaults through session state, so a saved decision can preset them; the
+    # slider values are read from it up front so the results are computed once
+    operativa_key = f"slider_materialita_operativa_{section_key}"
+    trascurabili_key = f"slider_errori_trascurabili_{section_key}"
+    st.session_state.setdefault(operativa_key, DEFAULT_OPERATING_PCT)
+    st.session_state.setdefault(trascurabili_key, DEFAULT_TRIVIAL_PCT)
+    results = materiality_results(edited, st.session_state[operativa_key], st.session_state[trascurabili_key])
+    if results is None:
+        st.warning("E' necessario selezionare almeno un criterio di determinazione")
+    else:
+        st.metric("Materialita generale", format_int(abs(results["materialita_generale"])))
+
+        col_mo_slider, col_mo_metric = st.columns([1, 2.2])
+        with col_mo_slider:
+            st.slider(
+                "% Materialita operativa",
+                min_value=60,
+                max_value=80,
+                step=1,
+                format="%d%%",
+                key=operativa_key,
+            )
+        with col_mo_metric:
+            st.metric("Materialita operativa", format_int(abs(results["materialita_operativa"])))
+
+        col_et_slider, col_et_metric = st.columns([1, 2.2])
+        with col_et_slider:
+            st.slider(
+                "% Errori trascurabili",
+                min_value=5,
+                max_value=15,
+                step=1,
+                format="%d%%",
+                key=trascurabili_key,
+            )
+        with col_et_metric:
+            st.metric("Errori trascurabili", format_int(abs(results["errori_trascurabili"])))
+
+    if results is not None and legal_entity_id is None:
+        with st.expander("Materialita delle componenti (ISA 600)", expanded=False):
+            # Default base: the first benchmark selected for group materiality
+            codes = {b["label"]: b["code"] for b in benchmarks}
+            default_code = codes.get(edited.loc[edited["Selezione"], "Voce"].iloc[0], benchmarks[0]["code"])
+            _render_component_allocation(data_version, schema_version_id, adjusted, section_key, selected_year, results["materialita_generale"], benchmarks, default_code)
+
+    nota_text = st.text_area(
+        "Spiegazione del criterio utilizzato e relative motivazioni",
+        height=140,
+        key=note_widget_key,
+    )
+    st.session_state[note_state_key] = nota_text
+
+    if results is not None and st.button("Salva decisione", key=f"salva_decisione_{section_key}"):
+        conn = get_conn()
+        try:
+            version = save_decision(
+                conn,
+                legal_entity_id,
+                selected_year,
+                section_key,
+                criteria=[
+                    {"Voce": str(r["Voce"]), "% selezionata": int(r["% selezionata"]), "Selezione": bool(r["Selezione"])}
+                    for r in new_editable.to_dict("records")
+                ],
+                bases={label: float(value) for label, value in basi_map.items()},
+                results=results,
+                note=nota_text,
+                data_version=data_version,
+                schema_version_id=schema_version_id,
+                adjusted=adjusted,
+            )
+        finally:
+            conn.close()
+        _cached_decision.clear()
+        st.session_state[f"materialita_decisione_{section_key}"] = (legal_entity_id, int(selected_year), version)
+        st.success(f"Decisione salvata (versione {version}).")
+
+    df_export, df_summary = materiality_export_frames(edited, results, selected_section_label, selected_year, nota_text)
+
+    # Export generati solo al download, in cache sul contenuto (anno, sezione, criteri, nota)
+    col_ex, col_wd, col_pdf = st.columns(3)
+    with col_ex:
+        st.download_button(
+            label="Esporta in Excel",
+            data=lambda: _cached_materialita_export("xlsx", df_export, df_summary),
+            file_name=f"materialita_{section_key}_{selected_year}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
+        )
+    with col_wd:
+        if not _module_available("docx"):
+            st.warning("Export Word non disponibile: installare `python-docx`.")
+        else:
+            st.download_button(
+                label="Esporta in Word",
+                data=lambda: _cached_materialita_export("docx", df_export, df_summary),
+                file_name=f"materialita_{section_key}_{selected_year}.docx",
+                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                on_click="ignore",
+            )
+    with col_pdf:
+        if not _module_available("reportlab"):
+            st.warning("Export PDF non disponibile: installare `reportlab`.")
+        else:
+            st.download_button(
+                label="Esporta in PDF",
+                data=lambda: _cached_materialita_export("pdf", df_export, df_summary),
+                file_name=f"materialita_{section_key}_{selected_year}.pdf",
+                mime="application/pdf",
+                on_click="ignore",
+            )
 
 
 try:
     conn = get_conn()
-    df_basi = _load_basi_per_anno(conn)
+    data_version = get_data_version(conn)
+    benchmarks = _cached_benchmarks(data_version)
+    fiscal_years, df_entities = _cached_perimetro(data_version)
 
-    if df_basi.empty:
+    if not benchmarks:
+        st.warning("Nessun benchmark di materialita configurato.")
+    elif not fiscal_years:
         st.warning("Nessun valore disponibile per i criteri di materialita.")
     else:
         with st.sidebar.expander("📘 Determinazione della Materialita – Riferimenti ISA", expanded=False):
@@ -237,9 +538,29 @@ try:
             index=0,
         )
         section_key = SECTION_OPTIONS[selected_section_label]
+        entity_labels = {None: "Tutte le entita (aggregato)"}
+        entity_labels.update({int(r.id): f"{r.entity_code} - {r.entity_name}" for r in df_entities.itertuples()})
+        legal_entity_id = st.sidebar.selectbox(
+            "Perimetro",
+            options=list(entity_labels),
+            format_func=entity_labels.get,
+            key="materialita_perimetro",
+        )
+        # Bases in the chosen reporting schema; benchmark filters use that schema's codes
+        df_schemas = _cached_report_schemas(data_version)
+        schema_labels = dict(zip(df_schemas["label"], df_schemas["id"].astype(int)))
+        schema_version_id = schema_labels[
+            st.sidebar.selectbox("Schema di reporting", options=list(schema_labels), key="materialita_schema")
+        ]
+        # Basi al netto delle rettifiche registrate dalla direzione (pagina 07)
+        adjusted = st.sidebar.toggle(
+            "Importi rettificati",
+            value=False,
+            key="materialita_rettificati",
+            help="Calcola le basi includendo le rettifiche di revisione registrate (pagina 07).",
+        )
         st.subheader(selected_section_label)
 
-        fiscal_years = [int(y) for y in df_basi["fiscal_year"].dropna().astype(int).tolist()]
         default_index = 1 if section_key == "preliminare" and len(fiscal_years) > 1 else 0
         selected_year = st.selectbox(
             "Bilancio da considerare",
@@ -248,199 +569,49 @@ try:
             key=f"{section_key}_bilancio_anno",
         )
 
-        df_selected = df_basi[df_basi["fiscal_year"].astype(int) == int(selected_year)]
-        if df_selected.empty:
-            st.warning("Nessun dato disponibile per l'esercizio selezionato.")
-            st.stop()
-
-        row = df_selected.iloc[0]
-        patrimonio_netto_exact = float(row["patrimonio_netto_exact"] or 0)
-        patrimonio_netto_fallback = float(row["patrimonio_netto_fallback"] or 0)
-        patrimonio_netto = patrimonio_netto_exact if patrimonio_netto_exact != 0 else patrimonio_netto_fallback
-        basi_map = {
-            "A1) Ricavi delle vendite e delle prestazioni": float(row["ricavi_u0100"] or 0),
-            "Totale attivo": float(row["totale_attivo"] or 0),
-            "Patrimonio netto": patrimonio_netto,
-            "Reddito ante imposte": float(row["reddito_ante_imposte"] or 0),
-        }
-
-        editable_key = f"materialita_editable_{section_key}"
-        if editable_key not in st.session_state:
-            st.session_state[editable_key] = DEFAULT_ROWS[["Voce", "% selezionata", "Selezione"]].copy()
-
-        table_df = DEFAULT_ROWS.copy()
-        editable_prev = st.session_state[editable_key].copy()
-        if not editable_prev.empty and "Voce" in editable_prev.columns:
-            editable_prev = editable_prev.set_index("Voce")
-            for col in ["% selezionata", "Selezione"]:
-                if col in editable_prev.columns:
-                    table_df[col] = table_df["Voce"].map(editable_prev[col]).fillna(table_df[col])
-
-        table_df["% min"] = _to_int_series(table_df["% min"], 0)
-        table_df["% max"] = _to_int_series(table_df["% max"], 100)
-        table_df["% selezionata"] = pd.to_numeric(table_df["% selezionata"], errors="coerce")
-        table_df["% selezionata"] = table_df["% selezionata"].fillna(table_df["% min"])
-        table_df["% selezionata"] = table_df["% selezionata"].clip(lower=table_df["% min"], upper=table_df["% max"]).round(0).astype(int)
-        table_df["Valore base"] = table_df["Voce"].map(basi_map).fillna(0.0).abs().round(0).astype(int)
-        table_df["Importo calcolato"] = (table_df["Valore base"] * table_df["% selezionata"] / 100).round(0).astype(int)
-        table_df = table_df[["Voce", "Valore base", "% min", "% max", "% selezionata", "Importo calcolato", "Selezione"]]
-
-        edited = st.data_editor(
-            table_df,
-            use_container_width=True,
-            hide_index=True,
-            row_height=24,
-            column_config={
-                "Voce": st.column_config.TextColumn("Voce"),
-                "Valore base": st.column_config.NumberColumn("Valore base", format="%d"),
-                "% min": st.column_config.NumberColumn("% min", min_value=0, max_value=100, step=1, format="%d"),
-                "% max": st.column_config.NumberColumn("% max", min_value=0, max_value=100, step=1, format="%d"),
-                "% selezionata": st.column_config.SelectboxColumn("% selezionata", options=[1, 2, 3, 4, 5, 6, 7], required=True),
-                "Importo calcolato": st.column_config.NumberColumn("Importo calcolato", format="%d"),
-                "Selezione": st.column_config.CheckboxColumn("Selezione"),
-            },
-            disabled=["Voce", "% min", "% max", "Valore base", "Importo calcolato"],
+        _reset_decision_state(section_key, legal_entity_id, selected_year, schema_version_id, adjusted)
+        # Saved decision for these settings (schema, adjusted): one keyed lookup;
+        # its bases snapshot replaces the benchmark query
+        decision = _cached_decision(legal_entity_id, int(selected_year), section_key, schema_version_id, adjusted)
+        ricalcola = decision is not None and st.sidebar.toggle(
+            "Ricalcola basi dai dati correnti",
+            value=False,
+            key=f"materialita_ricalcola_{section_key}",
         )
-
-        edited["% min"] = _to_int_series(edited["% min"], 0)
-        edited["% max"] = _to_int_series(edited["% max"], 100)
-        edited["% selezionata"] = pd.to_numeric(edited["% selezionata"], errors="coerce")
-        edited["% selezionata"] = edited["% selezionata"].fillna(edited["% min"])
-        edited["% selezionata"] = edited["% selezionata"].clip(lower=edited["% min"], upper=edited["% max"]).round(0).astype(int)
-        edited["Selezione"] = edited["Selezione"].fillna(False).astype(bool)
-        edited["Valore base"] = edited["Voce"].map(basi_map).fillna(0.0).abs().round(0).astype(int)
-        edited["Importo calcolato"] = (edited["Valore base"] * edited["% selezionata"] / 100).round(0).astype(int)
-
-        new_editable = edited[["Voce", "% selezionata", "Selezione"]].copy()
-        prev_editable = st.session_state[editable_key].copy()
-        st.session_state[editable_key] = new_editable
-        if not new_editable.equals(prev_editable):
-            st.rerun()
-
-        media_materialita = None
-        materialita_operativa = None
-        errori_trascurabili = None
-        pct_materialita_operativa = None
-        pct_errori_trascurabili = None
-        note_default_text = (
-            "Inserire una descrizione del criterio selezionato per la determinazione della materialita, "
-            "specificando le ragioni professionali della scelta delle percentuali applicate ai benchmark "
-            "considerati e gli elementi qualitativi/quantitativi rilevanti emersi nell'analisi."
-        )
-        note_state_key = f"nota_materialita_store_{section_key}"
-        note_widget_key = f"nota_materialita_input_{section_key}"
-        if note_state_key not in st.session_state:
-            st.session_state[note_state_key] = note_default_text
-        if note_widget_key not in st.session_state:
-            st.session_state[note_widget_key] = st.session_state[note_state_key]
-
-        importi_selezionati = edited.loc[edited["Selezione"], "Importo calcolato"]
-        if importi_selezionati.empty:
-            st.warning("E' necessario selezionare almeno un criterio di determinazione")
-        else:
-            media_materialita = int(round(importi_selezionati.mean(), 0))
-            st.metric("Materialita generale", _format_int_it(media_materialita))
-
-            col_mo_slider, col_mo_metric = st.columns([1, 2.2])
-            with col_mo_slider:
-                pct_materialita_operativa = st.slider(
-                    "% Materialita operativa",
-                    min_value=60,
-                    max_value=80,
-                    value=75,
-                    step=1,
-                    format="%d%%",
-                    key=f"slider_materialita_operativa_{section_key}",
-                )
-            materialita_operativa = int(round(media_materialita * pct_materialita_operativa / 100, 0))
-            with col_mo_metric:
-                st.metric("Materialita operativa", _format_int_it(materialita_operativa))
-
-            col_et_slider, col_et_metric = st.columns([1, 2.2])
-            with col_et_slider:
-                pct_errori_trascurabili = st.slider(
-                    "% Errori trascurabili",
-                    min_value=5,
-                    max_value=15,
-                    value=10,
-                    step=1,
-                    format="%d%%",
-                    key=f"slider_errori_trascurabili_{section_key}",
-                )
-            errori_trascurabili = int(round(materialita_operativa * pct_errori_trascurabili / 100, 0))
-            with col_et_metric:
-                st.metric("Errori trascurabili", _format_int_it(errori_trascurabili))
-
-        nota_text = st.text_area(
-            "Spiegazione del criterio utilizzato e relative motivazioni",
-            height=140,
-            key=note_widget_key,
-        )
-        st.session_state[note_state_key] = nota_text
-
-        df_export = edited.copy()
-        df_export["Selezione"] = df_export["Selezione"].map(lambda x: "Si" if bool(x) else "No")
-        for col in ["Valore base", "Importo calcolato"]:
-            df_export[col] = df_export[col].astype(int)
-
-        df_summary = pd.DataFrame(
-            [
-                {"Voce": "Sezione", "Valore": selected_section_label},
-                {"Voce": "Esercizio selezionato", "Valore": int(selected_year)},
-                {"Voce": "Materialita generale", "Valore": _format_int_it(media_materialita) if media_materialita is not None else ""},
-                {"Voce": "% Materialita operativa", "Valore": f"{pct_materialita_operativa}%" if pct_materialita_operativa is not None else ""},
-                {"Voce": "Materialita operativa", "Valore": _format_int_it(materialita_operativa) if materialita_operativa is not None else ""},
-                {"Voce": "% Errori trascurabili", "Valore": f"{pct_errori_trascurabili}%" if pct_errori_trascurabili is not None else ""},
-                {"Voce": "Errori trascurabili", "Valore": _format_int_it(errori_trascurabili) if errori_trascurabili is not None else ""},
-                {"Voce": "Nota", "Valore": nota_text},
-            ]
-        )
-
-        excel_data = _build_excel_export(df_export, df_summary)
-        word_data = _build_word_export(df_export, df_summary)
-        pdf_data = _build_pdf_export(df_export, df_summary)
-
-        col_ex, col_wd, col_pdf = st.columns(3)
-        with col_ex:
-            st.download_button(
-                label="Esporta in Excel",
-                data=excel_data,
-                file_name=f"materialita_{section_key}_{selected_year}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        if decision is not None and not ricalcola:
+            _seed_decision_state(section_key, decision)
+            basi_map = {b["label"]: float(decision["bases"].get(b["label"], 0) or 0) for b in benchmarks}
+            df_values = pd.DataFrame([{"fiscal_year": int(selected_year), **{b["code"]: basi_map[b["label"]] for b in benchmarks}}])
+            st.info(
+                f"Decisione salvata: versione {decision['version']} del {decision['created_at']} "
+                "(basi dall'istantanea salvata)."
             )
-        with col_wd:
-            if word_data is None:
-                st.warning("Export Word non disponibile: installare `python-docx`.")
-            else:
-                st.download_button(
-                    label="Esporta in Word",
-                    data=word_data,
-                    file_name=f"materialita_{section_key}_{selected_year}.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                )
-        with col_pdf:
-            if pdf_data is None:
-                st.warning("Export PDF non disponibile: installare `reportlab`.")
-            else:
-                st.download_button(
-                    label="Esporta in PDF",
-                    data=pdf_data,
-                    file_name=f"materialita_{section_key}_{selected_year}.pdf",
-                    mime="application/pdf",
-                )
+        else:
+            if decision is not None:
+                _seed_decision_state(section_key, decision)
+            with stage("basi_materialita"):
+                df_values = _basi_correnti(data_version, schema_version_id, adjusted, legal_entity_id)
+            df_selected = df_values[df_values["fiscal_year"].astype(int) == int(selected_year)]
+            if df_selected.empty:
+                st.warning("Nessun dato disponibile per l'esercizio selezionato.")
+                st.stop()
+            row = df_selected.iloc[0]
+            basi_map = {b["label"]: float(row[b["code"]] or 0) for b in benchmarks}
+
+        with stage("editor_materialita"):
+            _materialita_editor(data_version, schema_version_id, adjusted, section_key, selected_section_label, selected_year, basi_map, benchmarks, legal_entity_id)
 
         st.caption(
             " | ".join(
-                [
-                    f"Esercizio selezionato: {int(selected_year)}",
-                    f"Ricavi: {_format_int_it(basi_map['A1) Ricavi delle vendite e delle prestazioni'])}",
-                    f"Totale attivo: {_format_int_it(basi_map['Totale attivo'])}",
-                    f"Patrimonio netto: {_format_int_it(basi_map['Patrimonio netto'])}",
-                    f"Reddito ante imposte: {_format_int_it(basi_map['Reddito ante imposte'])}",
-                ]
+                [f"Esercizio selezionato: {int(selected_year)}"]
+                + [f"{label}: {format_int(abs(value))}" for label, value in basi_map.items()]
             )
         )
 
+        with st.expander("Analisi di sensitivita (tutti gli scenari)", expanded=False):
+            with stage("analisi_sensitivita"):
+                _scenario_explorer(df_values, benchmarks, selected_year)
+
 except Exception as e:
     st.error("Errore nella pagina Materialita.")
     st.exception(e)
@@ -450,3 +621,5 @@ finally:
         conn.close()
     except Exception:
         pass
+    finish_page_run(page_run)
+    render_diagnostics_panel(page_run)
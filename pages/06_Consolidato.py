@@ -0,0 +1,299 @@
+import streamlit as st
+
+from modules.lead_numeric.consolidation import (
+    CONSOLIDATED_AMOUNT_COLS,
+    CONSOLIDATION_METHODS,
+    ELIMINATION_COLS,
+    IC_PAIR_COLS,
+    consolidated_trial_balance,
+    create_perimeter,
+    intercompany_reconciliation,
+    load_eliminations,
+    load_ic_pairs,
+    load_perimeter_entities,
+    load_perimeters,
+    save_eliminations,
+    save_ic_pairs,
+    save_perimeter_entities,
+)
+from modules.lead_numeric.db import get_conn, get_data_version
+from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.export_xlsx import iter_frame_rows, write_bilancio_xlsx
+from modules.lead_numeric.formatting import amount_unit_params, format_amount
+from modules.lead_numeric.profiling import finish_page_run, render_diagnostics_panel, stage, start_page_run
+from modules.lead_numeric.schemas import load_report_schemas
+
+st.set_page_config(page_title="06 — Consolidato", layout="wide")
+st.title("06 — Consolidato di gruppo")
+
+init_db()
+page_run = start_page_run("06_Consolidato")
+
+TABLE_ROW_HEIGHT = 24
+CONSOLIDATED_TEXT_COLS = ["tipo", "group_lead", "lead", "sublead", "descr_sublead"]
+AMOUNT_LABELS = {
+    "aggregato": "Aggregato",
+    "elisioni_intercompany": "Elisioni intercompany",
+    "elisioni_manuali": "Elisioni manuali",
+    "consolidato": "Consolidato",
+    "quota_terzi": "di cui quota terzi",
+}
+
+
+@st.cache_data(show_spinner=False)
+def _cached_report_schemas(data_version):
+    conn = get_conn()
+    try:
+        return load_report_schemas(conn)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False)
+def _cached_years(data_version):
+    conn = get_conn()
+    try:
+        return [int(r[0]) for r in conn.execute("SELECT DISTINCT fiscal_year FROM trial_balance_header ORDER BY fiscal_year DESC")]
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _cached_consolidato(data_version, perimeter_id, fiscal_year, schema_version_id):
+    # One grouped query over the perimeter; cleared on every save of this page
+    conn = get_conn()
+    try:
+        return consolidated_trial_balance(conn, perimeter_id, fiscal_year, schema_version_id)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _cached_riconciliazione(data_version, perimeter_id, fiscal_year):
+    conn = get_conn()
+    try:
+        return intercompany_reconciliation(conn, perimeter_id, fiscal_year)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_excel_export(data_version, perimeter_id, fiscal_year, schema_version_id, amount_unit):
+    df = _cached_consolidato(data_version, perimeter_id, fiscal_year, schema_version_id)
+    amount_scale, amount_decimals = amount_unit_params(amount_unit)
+    with stage("export_xlsx"):
+        return write_bilancio_xlsx(
+            [("Consolidato", CONSOLIDATED_TEXT_COLS + CONSOLIDATED_AMOUNT_COLS, iter_frame_rows(df))],
+            amount_cols=CONSOLIDATED_AMOUNT_COLS,
+            amount_scale=amount_scale,
+            amount_decimals=amount_decimals,
+        )
+
+
+def _saved(message):
+    # Saved data invalidate the cached results; the message survives the rerun
+    _cached_consolidato.clear()
+    _cached_riconciliazione.clear()
+    st.session_state["consolidato_messaggio"] = message
+    st.rerun()
+
+
+def _format_total(value, amount_unit):
+    return format_amount(value, amount_unit)
+
+
+def _render_consolidato(data_version, perimeter_id, fiscal_year, schema_version_id, amount_unit):
+    df = _cached_consolidato(data_version, perimeter_id, fiscal_year, schema_version_id)
+    if df.empty:
+        st.info("Nessun saldo mappato per le entità del perimetro nell'esercizio selezionato.")
+        return
+    totals = df[CONSOLIDATED_AMOUNT_COLS].sum()
+    col_aggr, col_elim, col_cons, col_terzi = st.columns(4)
+    col_aggr.metric("Aggregato", _format_total(totals["aggregato"], amount_unit))
+    col_elim.metric("Elisioni", _format_total(totals["elisioni_intercompany"] + totals["elisioni_manuali"], amount_unit))
+    col_cons.metric("Consolidato (quadratura)", _format_total(totals["consolidato"], amount_unit))
+    col_terzi.metric("Quota terzi", _format_total(totals["quota_terzi"], amount_unit))
+
+    df_text = df[CONSOLIDATED_TEXT_COLS].copy()
+    for col in CONSOLIDATED_AMOUNT_COLS:
+        df_text[AMOUNT_LABELS[col]] = format_amount(df[col], amount_unit)
+    st.dataframe(
+        df_text,
+        use_container_width=True,
+        hide_index=True,
+        row_height=TABLE_ROW_HEIGHT,
+        column_config={label: st.column_config.TextColumn(alignment="right") for label in AMOUNT_LABELS.values()},
+    )
+    st.download_button(
+        label="Esporta in Excel",
+        data=lambda: _cached_excel_export(data_version, perimeter_id, fiscal_year, schema_version_id, amount_unit),
+        file_name=f"consolidato_{fiscal_year}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        on_click="ignore",
+    )
+
+
+def _render_perimetro(conn, data_version, perimeter_id):
+    st.caption(
+        "Integrale: saldi al 100% con evidenza della quota di terzi; "
+        "proporzionale: saldi alla % di possesso."
+    )
+    df_entities = load_perimeter_entities(conn, perimeter_id)
+    edited = st.data_editor(
+        df_entities,
+        use_container_width=True,
+        hide_index=True,
+        disabled=["legal_entity_id", "entity_code", "entity_name"],
+        column_order=["incluso", "entity_code", "entity_name", "ownership_pct", "method"],
+        column_config={
+            "incluso": st.column_config.CheckboxColumn("Incluso"),
+            "entity_code": "Entità",
+            "entity_name": "Denominazione",
+            "ownership_pct": st.column_config.NumberColumn("% possesso", min_value=0.01, max_value=100.0, format="%.2f"),
+            "method": st.column_config.SelectboxColumn("Metodo", options=list(CONSOLIDATION_METHODS), required=True),
+        },
+        key=f"consolidato_perimetro_{perimeter_id}_{data_version}",
+    )
+    st.caption(f"Entità incluse: {int(edited['incluso'].sum())} di {len(edited)}")
+    if st.button("Salva perimetro"):
+        try:
+            count = save_perimeter_entities(conn, perimeter_id, edited[edited["incluso"]])
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            _saved(f"Perimetro salvato: {count} entità.")
+
+
+def _render_intercompany(conn, data_version, perimeter_id, fiscal_year, entity_codes):
+    st.caption(
+        "Coppie di conti reciproci (crediti/debiti, ricavi/costi) eliminate per intero. "
+        "La differenza di quadratura resta nel consolidato, salvo indicare una sublead differenza."
+    )
+    df_pairs = load_ic_pairs(conn, perimeter_id)
+    edited = st.data_editor(
+        df_pairs.reindex(columns=IC_PAIR_COLS),
+        use_container_width=True,
+        hide_index=True,
+        num_rows="dynamic",
+        column_config={
+            "entity_a": st.column_config.SelectboxColumn("Entità A", options=entity_codes),
+            "account_code_a": st.column_config.TextColumn("Conto A"),
+            "entity_b": st.column_config.SelectboxColumn("Entità B", options=entity_codes),
+            "account_code_b": st.column_config.TextColumn("Conto B"),
+            "difference_sublead": st.column_config.TextColumn("Sublead differenza"),
+            "description": st.column_config.TextColumn("Descrizione"),
+        },
+        key=f"consolidato_ic_{perimeter_id}_{data_version}",
+    )
+    if st.button("Salva coppie intercompany"):
+        try:
+            count = save_ic_pairs(conn, perimeter_id, edited)
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            _saved(f"Coppie intercompany salvate: {count}.")
+
+    df_rec = _cached_riconciliazione(data_version, perimeter_id, fiscal_year)
+    if df_rec.empty:
+        return
+    st.markdown(f"**Quadratura intercompany {fiscal_year}**")
+    open_diff = df_rec.loc[df_rec["difference_sublead"].isna(), "differenza"].fillna(0)
+    if (open_diff.abs() > 0.01).any():
+        st.warning(
+            f"{int((open_diff.abs() > 0.01).sum())} coppie non quadrano senza sublead differenza: "
+            f"{_format_total(open_diff.sum(), 'euro')} restano nel consolidato."
+        )
+    st.dataframe(df_rec, use_container_width=True, hide_index=True)
+
+
+def _render_elisioni(conn, data_version, perimeter_id, fiscal_year):
+    st.caption(
+        f"Scritture di elisione {fiscal_year} a livello sublead dello schema primario; "
+        "le righe con lo stesso riferimento devono quadrare a zero."
+    )
+    df_entries = load_eliminations(conn, perimeter_id, fiscal_year)
+    edited = st.data_editor(
+        df_entries.reindex(columns=ELIMINATION_COLS),
+        use_container_width=True,
+        hide_index=True,
+        num_rows="dynamic",
+        column_config={
+            "entry_ref": st.column_config.TextColumn("Riferimento"),
+            "sublead": st.column_config.TextColumn("Sublead"),
+            "amount": st.column_config.NumberColumn("Importo", format="%.2f"),
+            "description": st.column_config.TextColumn("Descrizione"),
+        },
+        key=f"consolidato_elisioni_{perimeter_id}_{fiscal_year}_{data_version}",
+    )
+    if st.button("Salva scritture di elisione"):
+        try:
+            count = save_eliminations(conn, perimeter_id, fiscal_year, edited)
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            _saved(f"Scritture di elisione salvate: {count} righe.")
+
+
+try:
+    conn = get_conn()
+    data_version = get_data_version(conn)
+
+    with st.sidebar.expander("Nuovo perimetro", expanded=False):
+        new_name = st.text_input("Nome perimetro", key="consolidato_nuovo_nome")
+        if st.button("Crea perimetro"):
+            try:
+                create_perimeter(conn, new_name)
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                _saved(f"Perimetro creato: {new_name.strip()}")
+
+    message = st.session_state.pop("consolidato_messaggio", None)
+    if message is not None:
+        st.success(message)
+
+    df_perimeters = load_perimeters(conn)
+    years = _cached_years(data_version)
+    if df_perimeters.empty:
+        st.info("Crea un perimetro di consolidamento dalla barra laterale.")
+    elif not years:
+        st.info("Nessun dato di bilancio disponibile.")
+    else:
+        perimeter_labels = dict(zip(df_perimeters["name"], df_perimeters["id"].astype(int)))
+        perimeter_id = perimeter_labels[st.sidebar.selectbox("Perimetro", options=list(perimeter_labels))]
+        fiscal_year = st.sidebar.selectbox("Esercizio", options=years)
+        df_schemas = _cached_report_schemas(data_version)
+        schema_labels = dict(zip(df_schemas["label"], df_schemas["id"].astype(int)))
+        schema_version_id = schema_labels[st.sidebar.selectbox("Schema di reporting", options=list(schema_labels))]
+        amount_unit = st.sidebar.radio(
+            "Unità importi",
+            options=["euro", "euro_1000"],
+            format_func=lambda x: "Euro" if x == "euro" else "Euro/1000 (1 decimale)",
+            index=0,
+        )
+
+        tab_consolidato, tab_perimetro, tab_ic, tab_elisioni = st.tabs(
+            ["Bilancio consolidato", "Perimetro", "Intercompany", "Elisioni manuali"]
+        )
+        with tab_perimetro:
+            _render_perimetro(conn, data_version, perimeter_id)
+        with tab_ic:
+            entity_codes = [r[0] for r in conn.execute("SELECT entity_code FROM legal_entity ORDER BY entity_code")]
+            _render_intercompany(conn, data_version, perimeter_id, fiscal_year, entity_codes)
+        with tab_elisioni:
+            _render_elisioni(conn, data_version, perimeter_id, fiscal_year)
+        with tab_consolidato:
+            with stage("consolidato"):
+                _render_consolidato(data_version, perimeter_id, fiscal_year, schema_version_id, amount_unit)
+
+except Exception as e:
+    st.error("Errore nella pagina Consolidato.")
+    st.exception(e)
+
+finally:
+    try:
+        conn.close()
+    except Exception:
+        pass
+    finish_page_run(page_run)
+    render_diagnostics_panel(page_run)
@@ -0,0 +1,251 @@
+import pandas as pd
+import streamlit as st
+
+from modules.lead_numeric.adjustments import (
+    ADJUSTED_AMOUNT_COLS,
+    ADJUSTMENT_COLS,
+    ADJUSTMENT_STATUSES,
+    ADJUSTMENT_TYPES,
+    SUD_AMOUNT_COLS,
+    adjusted_trial_balance,
+    evaluate_unadjusted_differences,
+    load_adjustments,
+    save_adjustments,
+    unadjusted_differences,
+)
+from modules.lead_numeric.db import get_conn, get_data_version
+from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.formatting import format_amount, format_percent
+from modules.lead_numeric.materiality import load_reference_decision
+from modules.lead_numeric.profiling import finish_page_run, render_diagnostics_panel, stage, start_page_run
+
+st.set_page_config(page_title="07 — Rettifiche di revisione", layout="wide")
+st.title("07 — Rettifiche di revisione")
+
+init_db()
+page_run = start_page_run("07_Rettifiche")
+
+TABLE_ROW_HEIGHT = 24
+LEVEL_OPTIONS = {"account": "Per conto", "sublead": "Per sublead"}
+AMOUNT_LABELS = {
+    "saldo": "Saldo importato",
+    "rettifiche_registrate": "Rettifiche registrate",
+    "saldo_rettificato": "Saldo rettificato",
+    "rettifiche_non_registrate": "Non registrate",
+}
+SUD_LABELS = {
+    "attivo": "Attivo",
+    "passivo": "Passivo",
+    "conto_economico": "Conto economico",
+    "non_mappato": "Non mappato",
+    "effetto_risultato": "Effetto sul risultato",
+}
+
+
+@st.cache_data(show_spinner=False)
+def _cached_trial_balances(data_version):
+    conn = get_conn()
+    try:
+        return pd.read_sql(
+            """
+            SELECT tbh.id, tbh.legal_entity_id, tbh.fiscal_year, tbh.chart_of_accounts, le.entity_code
+            FROM trial_balance_header tbh
+            JOIN legal_entity le ON le.id = tbh.legal_entity_id
+            ORDER BY tbh.fiscal_year DESC, le.entity_code, tbh.chart_of_accounts
+            """,
+            conn,
+        )
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _cached_adjusted_tb(data_version, trial_balance_id, level):
+    # One grouped query over the TB lines plus its adjustments
+    conn = get_conn()
+    try:
+        return adjusted_trial_balance(conn, trial_balance_id, level)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _cached_sud(data_version, fiscal_year, legal_entity_id):
+    conn = get_conn()
+    try:
+        return unadjusted_differences(conn, fiscal_year, legal_entity_id)
+    finally:
+        conn.close()
+
+
+def _saved(message):
+    _cached_adjusted_tb.clear()
+    _cached_sud.clear()
+    st.session_state["rettifiche_messaggio"] = message
+    st.rerun()
+
+
+def _render_rettifiche(conn, data_version, trial_balance_id):
+    st.caption(
+        "Righe con lo stesso riferimento formano una scrittura e devono quadrare a zero (dare positivo). "
+        "Solo le scritture registrate dalla direzione entrano negli importi rettificati delle pagine 04 e 05."
+    )
+    df_adjustments = load_adjustments(conn, trial_balance_id)
+    edited = st.data_editor(
+        df_adjustments.reindex(columns=ADJUSTMENT_COLS),
+        use_container_width=True,
+        hide_index=True,
+        num_rows="dynamic",
+        column_config={
+            "entry_ref": st.column_config.TextColumn("Riferimento"),
+            "account_code": st.column_config.TextColumn("Conto"),
+            "amount": st.column_config.NumberColumn("Importo", format="%.2f"),
+            "adj_type": st.column_config.SelectboxColumn(
+                "Tipo", options=list(ADJUSTMENT_TYPES), default="fattuale"
+            ),
+            "status": st.column_config.SelectboxColumn(
+                "Stato", options=list(ADJUSTMENT_STATUSES), default="proposta"
+            ),
+            "description": st.column_config.TextColumn("Descrizione"),
+        },
+        key=f"rettifiche_{trial_balance_id}_{data_version}",
+    )
+    if st.button("Salva rettifiche"):
+        try:
+            count = save_adjustments(conn, trial_balance_id, edited)
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            _saved(f"Rettifiche salvate: {count} righe.")
+
+
+def _render_tb_rettificato(data_version, trial_balance_id):
+    level = st.radio(
+        "Livello",
+        options=list(LEVEL_OPTIONS),
+        format_func=LEVEL_OPTIONS.get,
+        horizontal=True,
+        key="rettifiche_livello",
+    )
+    df = _cached_adjusted_tb(data_version, trial_balance_id, level)
+    only_adjusted = st.toggle("Solo righe con rettifiche", value=True, key="rettifiche_solo_movimentate")
+    if only_adjusted:
+        df = df[(df["rettifiche_registrate"] != 0) | (df["rettifiche_non_registrate"] != 0)]
+    if df.empty:
+        st.info("Nessuna rettifica sul trial balance selezionato.")
+        return
+    df_text = df.drop(columns=ADJUSTED_AMOUNT_COLS)
+    for col in ADJUSTED_AMOUNT_COLS:
+        df_text[AMOUNT_LABELS[col]] = format_amount(df[col], "euro")
+    st.dataframe(
+        df_text,
+        use_container_width=True,
+        hide_index=True,
+        row_height=TABLE_ROW_HEIGHT,
+        column_config={label: st.column_config.TextColumn(alignment="right") for label in AMOUNT_LABELS.values()},
+    )
+
+
+def _render_riepilogo_sud(conn, data_version, fiscal_year, legal_entity_id, entity_code):
+    df_sud = _cached_sud(data_version, fiscal_year, legal_entity_id)
+    if df_sud.empty:
+        st.info(f"Nessuna differenza non rettificata per {entity_code} nel {fiscal_year}.")
+        return
+
+    df_text = df_sud.drop(columns=SUD_AMOUNT_COLS).assign(
+        adj_type=df_sud["adj_type"].map(ADJUSTMENT_TYPES),
+        status=df_sud["status"].map(ADJUSTMENT_STATUSES),
+    )
+    for col in SUD_AMOUNT_COLS:
+        df_text[SUD_LABELS[col]] = format_amount(df_sud[col], "euro")
+    st.dataframe(
+        df_text,
+        use_container_width=True,
+        hide_index=True,
+        row_height=TABLE_ROW_HEIGHT,
+        column_config={label: st.column_config.TextColumn(alignment="right") for label in SUD_LABELS.values()},
+    )
+
+    # Thresholds from page 05: final decision if present, otherwise the preliminary one
+    decision = load_reference_decision(conn, legal_entity_id, fiscal_year)
+    if decision is None:
+        st.warning(
+            f"Nessuna decisione di materialità salvata per {entity_code} nel {fiscal_year}: "
+            "definirla in pagina 05 per la valutazione."
+        )
+        return
+
+    st.markdown(
+        f"**Valutazione rispetto alla materialità {decision['section']} (versione {decision['version']})**"
+    )
+    col_mg, col_mo, col_et = st.columns(3)
+    col_mg.metric("Materialità generale", format_amount(decision["materialita_generale"], "euro"))
+    col_mo.metric("Materialità operativa", format_amount(decision["materialita_operativa"], "euro"))
+    col_et.metric("Errori trascurabili", format_amount(decision["errori_trascurabili"], "euro"))
+
+    df_eval = evaluate_unadjusted_differences(df_sud, decision)
+    st.dataframe(
+        df_eval.assign(
+            **{
+                "Totale non rettificato": format_amount(df_eval["Totale non rettificato"], "euro"),
+                "% materialità generale": format_percent(df_eval["% materialità generale"]),
+            }
+        ),
+        use_container_width=True,
+        hide_index=True,
+    )
+    st.caption(
+        f"Scritture con effetto sul risultato sopra la soglia di errore trascurabile: "
+        f"{df_eval.attrs['scritture_sopra_trascurabile']} di {len(df_sud)}."
+    )
+    if (df_eval["Esito"] == "Supera la materialità generale").any():
+        st.error("Le differenze non rettificate superano la materialità generale.")
+
+
+try:
+    conn = get_conn()
+    data_version = get_data_version(conn)
+
+    message = st.session_state.pop("rettifiche_messaggio", None)
+    if message is not None:
+        st.success(message)
+
+    df_tbs = _cached_trial_balances(data_version)
+    if df_tbs.empty:
+        st.info("Nessun trial balance disponibile. Importarlo in pagina 02.")
+    else:
+        years = sorted(df_tbs["fiscal_year"].astype(int).unique().tolist(), reverse=True)
+        fiscal_year = st.sidebar.selectbox("Esercizio", options=years, key="rettifiche_anno")
+        df_year = df_tbs[df_tbs["fiscal_year"] == fiscal_year]
+        tb_labels = dict(
+            zip(df_year["entity_code"] + " — " + df_year["chart_of_accounts"], df_year["id"].astype(int))
+        )
+        trial_balance_id = tb_labels[
+            st.sidebar.selectbox("Trial balance", options=list(tb_labels), key="rettifiche_tb")
+        ]
+        tb_row = df_year[df_year["id"] == trial_balance_id].iloc[0]
+        legal_entity_id = int(tb_row["legal_entity_id"])
+
+        tab_rettifiche, tab_tb, tab_sud = st.tabs(
+            ["Scritture di rettifica", "TB rettificato", "Differenze non rettificate (ISA 450)"]
+        )
+        with tab_rettifiche:
+            _render_rettifiche(conn, data_version, trial_balance_id)
+        with tab_tb:
+            with stage("tb_rettificato"):
+                _render_tb_rettificato(data_version, trial_balance_id)
+        with tab_sud:
+            with stage("riepilogo_differenze"):
+                _render_riepilogo_sud(conn, data_version, fiscal_year, legal_entity_id, tb_row["entity_code"])
+
+except Exception as e:
+    st.error("Errore nella pagina Rettifiche di revisione.")
+    st.exception(e)
+
+finally:
+    try:
+        conn.close()
+    except Exception:
+        pass
+    finish_page_run(page_run)
+    render_diagnostics_panel(page_run)
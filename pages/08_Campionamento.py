@@ -0,0 +1,223 @@
+import pandas as pd
+import streamlit as st
+
+from modules.lead_numeric.db import get_conn, get_data_version
+from modules.lead_numeric.ddl import LATEST_PRIMARY_SCHEMA_SQL, init_db
+from modules.lead_numeric.export_xlsx import write_bilancio_xlsx
+from modules.lead_numeric.formatting import format_amount, format_int, format_percent
+from modules.lead_numeric.materiality import load_reference_decision
+from modules.lead_numeric.profiling import finish_page_run, render_diagnostics_panel, stage, start_page_run
+from modules.lead_numeric.sampling import (
+    CONFIDENCE_FACTORS,
+    DEFAULT_STRATA,
+    SAMPLING_METHODS,
+    draw_sample,
+    load_population,
+    load_selection_details,
+    sampling_excel_sheets,
+)
+
+st.set_page_config(page_title="08 — Campionamento", layout="wide")
+st.title("08 — Campionamento di revisione")
+
+init_db()
+page_run = start_page_run("08_Campionamento")
+
+TABLE_ROW_HEIGHT = 24
+ALL_SUBLEADS = "Tutte le sublead della lead"
+DEFAULT_SEED = 12345
+
+
+@st.cache_data(show_spinner=False)
+def _cached_perimetro(data_version):
+    conn = get_conn()
+    try:
+        years = [int(r[0]) for r in conn.execute("SELECT DISTINCT fiscal_year FROM trial_balance_header ORDER BY fiscal_year DESC")]
+        entities = pd.read_sql("SELECT id, entity_code, entity_name FROM legal_entity ORDER BY entity_code", conn)
+        structure = pd.read_sql(
+            f"""
+            SELECT lead, sublead, descrizione_cee
+            FROM lead_structure
+            WHERE schema_version_id = ({LATEST_PRIMARY_SCHEMA_SQL})
+            ORDER BY lead, sublead
+            """,
+            conn,
+        )
+        return years, entities, structure
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_population(data_version, fiscal_year, lead, sublead, legal_entity_id):
+    # Numeric columns only: millions of lines stay a few arrays in memory
+    conn = get_conn()
+    try:
+        return load_population(conn, fiscal_year, lead=lead, sublead=sublead, legal_entity_id=legal_entity_id)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _cached_sample(data_version, fiscal_year, lead, sublead, legal_entity_id, sampling_args):
+    df_population = _cached_population(data_version, fiscal_year, lead, sublead, legal_entity_id)
+    df_selection, params = draw_sample(df_population, **dict(sampling_args))
+    conn = get_conn()
+    try:
+        return load_selection_details(conn, df_selection), params
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_excel_export(df_details, params, population_label):
+    return write_bilancio_xlsx(sampling_excel_sheets(df_details, params, population_label), amount_cols=["importo"])
+
+
+def _default_tolerable(conn, legal_entity_id, fiscal_year):
+    # Operating materiality of page 05 as tolerable misstatement, when saved
+    decision = load_reference_decision(conn, legal_entity_id, fiscal_year)
+    if decision is None or not decision["materialita_operativa"]:
+        return None, None
+    return float(abs(decision["materialita_operativa"])), decision
+
+
+def _render_sample(df_details, params, population_label):
+    col_pop, col_n, col_sel, col_cov = st.columns(4)
+    col_pop.metric("Righe popolazione", format_int(params["righe_popolazione"]))
+    col_n.metric("Dimensione campione", format_int(params["dimensione_campione"]))
+    col_sel.metric("Righe selezionate", format_int(params["righe_selezionate"]))
+    col_cov.metric("Copertura valore", format_percent(params["copertura_percentuale"]))
+    caption = f"Valore popolazione (assoluto): {format_amount(params['valore_popolazione'], 'euro')}"
+    if params["soglia_voci_chiave"] is not None:
+        caption += (
+            f" — voci chiave (oltre {format_amount(params['soglia_voci_chiave'], 'euro')}): "
+            f"{params['voci_chiave']}"
+        )
+    st.caption(caption)
+
+    if df_details.empty:
+        st.info("Nessuna riga selezionata.")
+        return
+    df_text = df_details.assign(importo=format_amount(df_details["importo"], "euro"))
+    st.dataframe(
+        df_text,
+        use_container_width=True,
+        hide_index=True,
+        row_height=TABLE_ROW_HEIGHT,
+        column_config={"importo": st.column_config.TextColumn("importo", alignment="right")},
+    )
+    st.download_button(
+        label="Esporta selezione in Excel",
+        data=lambda: _cached_excel_export(df_details, params, population_label),
+        file_name=f"campione_{params['seme']}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        on_click="ignore",
+    )
+
+
+try:
+    conn = get_conn()
+    data_version = get_data_version(conn)
+    years, df_entities, df_structure = _cached_perimetro(data_version)
+
+    if not years or df_structure.empty:
+        st.info("Servono uno schema primario (pagina 01) e almeno un trial balance (pagina 02).")
+    else:
+        fiscal_year = st.sidebar.selectbox("Esercizio", options=years, key="campionamento_anno")
+        entity_labels = {None: "Tutte le entita (aggregato)"}
+        entity_labels.update({int(r.id): f"{r.entity_code} - {r.entity_name}" for r in df_entities.itertuples()})
+        legal_entity_id = st.sidebar.selectbox(
+            "Perimetro",
+            options=list(entity_labels),
+            format_func=entity_labels.get,
+            key="campionamento_perimetro",
+        )
+        leads = df_structure["lead"].dropna().drop_duplicates().tolist()
+        lead = st.sidebar.selectbox("Lead", options=leads, key="campionamento_lead")
+        subleads = df_structure.loc[df_structure["lead"] == lead, "sublead"].tolist()
+        sublead = st.sidebar.selectbox("Sublead", options=[ALL_SUBLEADS] + subleads, key="campionamento_sublead")
+        sublead = None if sublead == ALL_SUBLEADS else sublead
+
+        st.subheader("Parametri di campionamento")
+        default_tolerable, decision = _default_tolerable(conn, legal_entity_id, fiscal_year)
+        col_method, col_conf, col_seed = st.columns(3)
+        method = col_method.radio(
+            "Metodo", options=list(SAMPLING_METHODS), format_func=SAMPLING_METHODS.get, key="campionamento_metodo"
+        )
+        confidence = col_conf.selectbox(
+            "Livello di confidenza (%)",
+            options=list(CONFIDENCE_FACTORS),
+            index=list(CONFIDENCE_FACTORS).index(95),
+            key="campionamento_confidenza",
+        )
+        seed = int(
+            col_seed.number_input(
+                "Seme",
+                min_value=0,
+                value=DEFAULT_SEED,
+                step=1,
+                help="Stesso seme e stessi dati: stessa selezione. Il seme è riportato nell'export.",
+                key="campionamento_seme",
+            )
+        )
+        col_tm, col_em, col_strata = st.columns(3)
+        tolerable = col_tm.number_input(
+            "Errore tollerabile",
+            min_value=0.0,
+            value=default_tolerable or 0.0,
+            step=1000.0,
+            key=f"campionamento_tollerabile_{legal_entity_id}_{fiscal_year}",
+        )
+        expected = col_em.number_input(
+            "Errore atteso", min_value=0.0, value=0.0, step=1000.0, key="campionamento_atteso"
+        )
+        strata = DEFAULT_STRATA
+        if method == "stratificato":
+            strata = int(
+                col_strata.number_input("Strati", min_value=1, max_value=20, value=DEFAULT_STRATA, key="campionamento_strati")
+            )
+        if decision is not None:
+            st.caption(
+                f"Errore tollerabile proposto: materialità operativa {decision['section']} "
+                f"(versione {decision['version']}) della pagina 05."
+            )
+        else:
+            st.caption("Nessuna decisione di materialità salvata per il perimetro: indicare l'errore tollerabile.")
+
+        if tolerable <= 0:
+            st.info("Indicare un errore tollerabile maggiore di zero.")
+        else:
+            population_label = f"{fiscal_year} — {entity_labels[legal_entity_id]} — {lead}" + (
+                f" / {sublead}" if sublead else ""
+            )
+            sampling_args = (
+                ("method", method),
+                ("tolerable_misstatement", float(tolerable)),
+                ("confidence", int(confidence)),
+                ("expected_misstatement", float(expected)),
+                ("seed", seed),
+                ("strata", strata),
+            )
+            try:
+                with stage("campione"):
+                    df_details, params = _cached_sample(
+                        data_version, fiscal_year, lead, sublead, legal_entity_id, sampling_args
+                    )
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                st.subheader("Selezione")
+                _render_sample(df_details, params, population_label)
+
+except Exception as e:
+    st.error("Errore nella pagina Campionamento.")
+    st.exception(e)
+
+finally:
+    try:
+        conn.close()
+    except Exception:
+        pass
+    finish_page_run(page_run)
+    render_diagnostics_panel(page_run)
@@ -0,0 +1,275 @@
+import streamlit as st
+
+from modules.lead_numeric.db import get_conn, get_data_version
+from modules.lead_numeric.ddl import init_db
+from modules.lead_numeric.formatting import format_amount, format_int, format_percent
+from modules.lead_numeric.journal import (
+    JOURNAL_TESTS,
+    benford_first_digit,
+    derive_trial_balance,
+    flag_summary,
+    import_journal,
+    journal_flags,
+    journal_summary,
+    load_flagged_lines,
+    load_journal_columns,
+    load_journal_imports,
+    load_unbalanced_entries,
+    reconcile_journal,
+)
+from modules.lead_numeric.profiling import finish_page_run, render_diagnostics_panel, stage, start_page_run
+
+st.set_page_config(page_title="09 — Libro giornale", layout="wide")
+st.title("09 — Libro giornale")
+
+init_db()
+page_run = start_page_run("09_Libro_Giornale")
+
+TABLE_ROW_HEIGHT = 24
+FLAGGED_LIMIT = 1000
+SUMMARY_LABELS = {
+    "righe": "Righe",
+    "scritture": "Scritture",
+    "conti": "Conti",
+    "totale_dare": "Totale dare",
+    "totale_avere": "Totale avere",
+    "scritture_non_quadrate": "Scritture non quadrate",
+    "righe_fuori_esercizio": "Righe fuori esercizio",
+}
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def _cached_journal_columns(data_version, journal_import_id):
+    # Numeric columns only; every test below is a vectorized pass over them
+    conn = get_conn()
+    try:
+        return load_journal_columns(conn, journal_import_id)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_summary(data_version, journal_import_id):
+    conn = get_conn()
+    try:
+        return journal_summary(conn, journal_import_id)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_reconciliation(data_version, journal_import_id):
+    conn = get_conn()
+    try:
+        return reconcile_journal(conn, journal_import_id)
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _cached_unbalanced(data_version, journal_import_id):
+    conn = get_conn()
+    try:
+        return load_unbalanced_entries(conn, journal_import_id)
+    finally:
+        conn.close()
+
+
+def _saved(message):
+    st.session_state["giornale_messaggio"] = message
+    st.rerun()
+
+
+def _summary_text(summary):
+    return " — ".join(
+        f"{label}: {format_int(summary[key]) if isinstance(summary[key], int) else format_amount(summary[key])}"
+        for key, label in SUMMARY_LABELS.items()
+    )
+
+
+def _render_import():
+    st.caption(
+        "Colonne attese (intestazione, in qualsiasi ordine): registrazione, data, conto, dare, avere; "
+        "facoltative: ora, descrizione_conto, descrizione, utente. Il file è letto a blocchi: "
+        "il re-import sostituisce il giornale della stessa entità, esercizio e piano dei conti."
+    )
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        entity_code = st.text_input("Codice entità", value="ENTITY01", key="giornale_entita")
+        entity_name = st.text_input("Denominazione", value="ENTITY01", key="giornale_denominazione")
+    with col2:
+        fiscal_year = st.number_input("Esercizio", min_value=2000, max_value=2100, value=2024, step=1, key="giornale_anno")
+        currency = st.text_input("Valuta", value="EUR", key="giornale_valuta")
+    with col3:
+        chart_of_accounts = st.text_input("Piano dei conti", value="COA", key="giornale_coa")
+        derive_tb = st.checkbox("Genera il TB dal giornale dopo l'import", value=False, key="giornale_genera_tb")
+    with st.expander("Formato file", expanded=False):
+        col_sep, col_dec, col_thousands, col_enc, col_sheet = st.columns(5)
+        sep = col_sep.text_input("Separatore CSV", value=";")
+        decimal = col_dec.text_input("Decimali", value=",")
+        thousands = col_thousands.text_input("Migliaia", value=".")
+        encoding = col_enc.text_input("Codifica", value="utf-8")
+        sheet = col_sheet.text_input("Foglio xlsx (vuoto = primo)", value="")
+
+    uploaded = st.file_uploader("Carica libro giornale", type=["csv", "txt", "xlsx"], key="giornale_file")
+    if uploaded and st.button("Importa giornale"):
+        try:
+            with stage("import_giornale"):
+                summary = import_journal(
+                    uploaded,
+                    uploaded.name,
+                    entity_code=entity_code.strip(),
+                    entity_name=entity_name.strip(),
+                    fiscal_year=int(fiscal_year),
+                    chart_of_accounts=chart_of_accounts.strip(),
+                    currency=currency.strip(),
+                    sheet_name=0 if sheet.strip() == "" else sheet.strip(),
+                    sep=sep,
+                    decimal=decimal,
+                    thousands=thousands or None,
+                    encoding=encoding,
+                )
+            message = f"Giornale importato. {_summary_text(summary)}"
+            if derive_tb:
+                conn_tb = get_conn()
+                try:
+                    tb_id = derive_trial_balance(conn_tb, summary["journal_import_id"])
+                finally:
+                    conn_tb.close()
+                message += f" — TB generato (trial_balance_id={tb_id})."
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            _saved(message)
+
+
+def _render_quadratura(conn, data_version, journal_import_id):
+    df_rec = _cached_reconciliation(data_version, journal_import_id)
+    differences = df_rec[df_rec["differenza"].abs() > 0.01]
+    if df_rec["saldo_tb"].eq(0).all():
+        st.info("Nessun TB importato per l'entità ed esercizio del giornale: generarlo dal giornale.")
+    elif differences.empty:
+        st.success(f"Giornale e TB quadrano su tutti i {len(df_rec)} conti.")
+    else:
+        st.warning(
+            f"{len(differences)} conti con differenza tra giornale e TB "
+            f"(totale {format_amount(differences['differenza'].sum())})."
+        )
+    only_differences = st.toggle("Solo conti con differenza", value=True, key="giornale_solo_differenze")
+    df_view = differences if only_differences else df_rec
+    df_text = df_view.copy()
+    for col in ["saldo_giornale", "saldo_tb", "differenza"]:
+        df_text[col] = format_amount(df_view[col])
+    st.dataframe(
+        df_text,
+        use_container_width=True,
+        hide_index=True,
+        row_height=TABLE_ROW_HEIGHT,
+        column_config={
+            col: st.column_config.TextColumn(alignment="right") for col in ["saldo_giornale", "saldo_tb", "differenza"]
+        },
+    )
+    if st.button("Genera TB dal giornale", help="Sostituisce il TB dell'entità ed esercizio con i saldi del giornale."):
+        tb_id = derive_trial_balance(conn, journal_import_id)
+        _saved(f"TB generato dal giornale (trial_balance_id={tb_id}).")
+
+    df_unbalanced = _cached_unbalanced(data_version, journal_import_id)
+    if not df_unbalanced.empty:
+        st.markdown(f"**Scritture non quadrate: {len(df_unbalanced)}**")
+        st.dataframe(df_unbalanced.head(FLAGGED_LIMIT), use_container_width=True, hide_index=True)
+
+
+def _render_analisi(conn, data_version, journal_import_id):
+    df_lines = _cached_journal_columns(data_version, journal_import_id)
+    col_start, col_end, col_round = st.columns(3)
+    start_hour = col_start.number_input("Inizio orario", min_value=0, max_value=23, value=8, key="giornale_inizio")
+    end_hour = col_end.number_input("Fine orario", min_value=1, max_value=24, value=19, key="giornale_fine")
+    round_unit = col_round.number_input(
+        "Importo tondo (multiplo di)", min_value=1.0, value=1000.0, step=100.0, key="giornale_tondo"
+    )
+    with stage("analisi_giornale"):
+        df_flags = journal_flags(df_lines, int(start_hour), int(end_hour), float(round_unit))
+        df_summary = flag_summary(df_lines, df_flags)
+        df_benford = benford_first_digit(df_lines["amount"])
+
+    st.dataframe(
+        df_summary.drop(columns="test").assign(
+            righe=format_int(df_summary["righe"]),
+            **{"% righe": format_percent(df_summary["% righe"])},
+            importo_assoluto=format_amount(df_summary["importo_assoluto"]),
+        ),
+        use_container_width=True,
+        hide_index=True,
+    )
+
+    st.markdown("**Legge di Benford — prima cifra**")
+    st.bar_chart(df_benford.set_index("cifra")[["frequenza", "attesa"]], stack=False)
+    if df_benford.attrs["mad"] is not None:
+        st.caption(
+            f"Importi analizzati: {format_int(df_benford.attrs['righe'])} — "
+            f"MAD {df_benford.attrs['mad']:.4f}: {df_benford.attrs['esito']}"
+        )
+
+    test = st.selectbox(
+        "Righe segnalate", options=list(JOURNAL_TESTS), format_func=JOURNAL_TESTS.get, key="giornale_test"
+    )
+    line_ids = df_lines.loc[df_flags[test].to_numpy(), "line_id"]
+    if line_ids.empty:
+        st.info("Nessuna riga segnalata.")
+        return
+    if len(line_ids) > FLAGGED_LIMIT:
+        st.caption(f"Prime {FLAGGED_LIMIT} righe di {len(line_ids)}.")
+    df_detail = load_flagged_lines(conn, line_ids, limit=FLAGGED_LIMIT)
+    st.dataframe(
+        df_detail.assign(amount=format_amount(df_detail["amount"])),
+        use_container_width=True,
+        hide_index=True,
+        row_height=TABLE_ROW_HEIGHT,
+        column_config={"amount": st.column_config.TextColumn("amount", alignment="right")},
+    )
+
+
+try:
+    conn = get_conn()
+    data_version = get_data_version(conn)
+
+    message = st.session_state.pop("giornale_messaggio", None)
+    if message is not None:
+        st.success(message)
+
+    df_imports = load_journal_imports(conn)
+    import_labels = {
+        f"{r.entity_code} {r.fiscal_year} {r.chart_of_accounts} ({r.source_file})": int(r.id)
+        for r in df_imports.itertuples()
+    }
+    journal_import_id = None
+    if import_labels:
+        journal_import_id = import_labels[
+            st.sidebar.selectbox("Giornale", options=list(import_labels), key="giornale_selezionato")
+        ]
+
+    tab_import, tab_quadratura, tab_analisi = st.tabs(["Import", "Quadratura con il TB", "Analisi"])
+    with tab_import:
+        _render_import()
+    if journal_import_id is None:
+        with tab_quadratura:
+            st.info("Nessun giornale importato.")
+    else:
+        st.sidebar.caption(_summary_text(_cached_summary(data_version, journal_import_id)))
+        with tab_quadratura:
+            with stage("quadratura_giornale"):
+                _render_quadratura(conn, data_version, journal_import_id)
+        with tab_analisi:
+            _render_analisi(conn, data_version, journal_import_id)
+
+except Exception as e:
+    st.error("Errore nella pagina Libro giornale.")
+    st.exception(e)
+
+finally:
+    try:
+        conn.close()
+    except Exception:
+        pass
+    finish_page_run(page_run)
+    render_diagnostics_panel(page_run)